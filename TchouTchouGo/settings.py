@@ -147,3 +147,72 @@ EASYCART_CART_CLASS = 'main.views.Cart'
 # Google Maps API
 
 GOOGLE_MAPS_API_KEY = 'YOUR_API_KEY'
+
+# Journey search
+# 'timetable' uses the in-memory timetable engine (main.timetable),
+# 'sql' uses the self-joining SQL queries of main.search.
+
+SEARCH_ENGINE = 'timetable'
+
+# Maximum number of connections in a journey. The 'sql' search engine never
+# finds more than one connection, whatever this setting.
+
+SEARCH_MAX_TRANSFERS = 3
+
+# Number of search results kept in the per-process cache (0 disables it).
+
+SEARCH_CACHE_SIZE = 256
+
+# Lifetime of unbooked travels (search results added to a cart), in seconds.
+# Expired ones are deleted by "manage.py cleansearch --expired".
+
+SEARCH_RESULT_TTL = 24 * 3600
+
+# How long each process reuses the number of the active timetable generation
+# before reading it again, in seconds. In-memory indexes (station names,
+# station positions) are rebuilt at most this long after an import.
+
+TIMETABLE_GENERATION_TTL = 5
+
+# Prebuilt station map (stations.geojson), written by the GTFS import with its
+# gzip version, and its Brotli version when the brotli package is installed.
+
+STATION_ARTIFACTS_DIR = os.path.join(BASE_DIR, 'artifacts')
+
+# Cache lifetime of the versioned station map URL, in seconds.
+
+STATION_ARTIFACTS_MAX_AGE = 365 * 24 * 3600
+
+# GTFS import: trains written per transaction, and rows per INSERT statement
+# (lowered automatically to the database parameter limit).
+
+GTFS_IMPORT_TRIP_BATCH_SIZE = 1000
+
+GTFS_IMPORT_INSERT_BATCH_SIZE = 1000
+
+# Number of worker processes parsing GTFS archives in parallel (1 parses in
+# the importing process). Database writes always happen in that process.
+
+GTFS_IMPORT_WORKERS = os.cpu_count() or 1
+
+# A new timetable generation is only activated if it holds at least this
+# fraction of the trains of the active generation.
+
+GTFS_IMPORT_MIN_TRAIN_RATIO = 0.5
+
+# Measure the peak memory of each GTFS import stage with tracemalloc. This
+# slows the import down noticeably: only enable it when profiling.
+
+GTFS_IMPORT_TRACE_MEMORY = False
+
+# Directory where GTFS archives uploaded from the admin wait for the
+# runimports worker. It must be shared by the web and worker processes. It
+# also holds the lock file that lets only one import run at a time.
+
+GTFS_IMPORT_UPLOAD_DIR = os.path.join(BASE_DIR, 'uploads')
+
+# An import running on another machine is considered interrupted when its
+# progress has not been recorded for this many seconds. Imports running on
+# the same machine are recovered as soon as their process is gone.
+
+GTFS_IMPORT_STALE_AFTER = 3600
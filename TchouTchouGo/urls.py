@@ -21,6 +21,12 @@ from django.views.generic import RedirectView
 urlpatterns = [
     url(r'^admin/', admin_site.urls),
     url(r'^admin/gtfs-import/?$', admin_views.gtfs_import, name="gtfs-import"),
+    url(r'^admin/gtfs-import/([0-9]+)/?$', admin_views.gtfs_import_job,
+        name="gtfs-import-job"),
+    url(r'^admin/gtfs-import/([0-9]+)/progress$',
+        admin_views.gtfs_import_progress, name="gtfs-import-progress"),
+    url(r'^admin/gtfs-import/([0-9]+)/cancel$',
+        admin_views.gtfs_import_cancel, name="gtfs-import-cancel"),
     url(r'^$', RedirectView.as_view(url='/train/', permanent=False)),
     url(r'^train/', include('main.urls')),
 ]
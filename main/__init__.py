@@ -2,3 +2,6 @@
 """
 Application principale.
 """
+
+## Configuration de l'application utilisée par Django.
+default_app_config = 'main.apps.MainConfig'
@@ -4,7 +4,9 @@ from __future__ import unicode_literals
 from django.contrib.admin import AdminSite, ModelAdmin
 from django.contrib.auth.models import User, Group
 from django.conf import settings
+from django.utils.html import format_html, format_html_join
 from . import models
+import json
 
 
 class TicketAdmin(ModelAdmin):
@@ -15,6 +17,51 @@ class TicketAdmin(ModelAdmin):
     raw_id_fields = ('start_halt', 'end_halt',)
 
 
+class TimetableGenerationAdmin(ModelAdmin):
+    """Gestionnaire d'administration des générations des horaires."""
+    ## Colonnes affichées pour décrire une génération.
+    list_display = ('id', 'created', 'status',)
+    ## Filtres disponibles dans la liste des générations.
+    list_filter = ('status',)
+
+
+class ImportRunAdmin(ModelAdmin):
+    """Gestionnaire d'administration des importations GTFS, en lecture
+    seule."""
+    ## Colonnes affichées pour décrire une importation.
+    list_display = ('id', 'started', 'sources', 'generation', 'status',
+                    'percent', 'seconds',)
+    ## Filtres disponibles dans la liste des importations.
+    list_filter = ('status',)
+    ## Champs affichés dans le détail d'une importation.
+    fields = ('started', 'finished', 'sources', 'rebuild', 'generation',
+              'status', 'worker', 'heartbeat', 'stage', 'rows', 'percent',
+              'cancel_requested', 'seconds', 'error', 'delta',
+              'stage_table',)
+    ## Champs non modifiables : tous.
+    readonly_fields = fields
+
+    def stage_table(self, run):
+        """Afficher les mesures des étapes de l'importation sous forme de
+        tableau."""
+        return format_html(
+            '<table><tr><th>Étape</th><th>Archive</th><th>Durée (s)</th>'
+            '<th>Lignes</th><th>Lignes/s</th><th>Pic mémoire (Mio)</th>'
+            '</tr>{}</table>',
+            format_html_join('', '<tr>' + '<td>{}</td>' * 6 + '</tr>', (
+                (s['name'], s['source'] or '', '%.3f' % s['seconds'],
+                 s['rows'], s['rows_per_second'] or '',
+                 '%.1f' % (s['peak_memory'] / 1048576)
+                 if s['peak_memory'] is not None else '')
+                for s in json.loads(run.stages))))
+    stage_table.short_description = "Étapes"
+
+    def has_add_permission(self, request):
+        """Les importations ne sont créées que par l'importation GTFS ou
+        depuis son formulaire."""
+        return False
+
+
 class TchouAdminSite(AdminSite):
     """Paramètres des fonctionnalités d'administration de l'application."""
     ## En-tête du site d'administration.
@@ -33,6 +80,9 @@ admin_site.register(models.PeriodException)
 admin_site.register(models.Train)
 admin_site.register(models.Station)
 admin_site.register(models.Halt)
+admin_site.register(models.TimetableGeneration,
+                    admin_class=TimetableGenerationAdmin)
+admin_site.register(models.ImportRun, admin_class=ImportRunAdmin)
 admin_site.register(models.Ticket, admin_class=TicketAdmin)
 admin_site.register(models.Travel)
 admin_site.register(models.Passenger)
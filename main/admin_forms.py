@@ -16,10 +16,12 @@ class GTFSImportForm(forms.Form):
         help_text="Archive au format ZIP fournie par la SNCF et contenant "
                   "les données d'horaires des Intercités au format GTFS."
     )
-    ## Case à cocher définissant s'il faut nettoyer toute la base de données
-    #  avant d'effectuer l'importation.
+    ## Case à cocher définissant s'il faut réécrire tous les trains plutôt
+    #  que les seules différences avec les horaires actuels.
     clear_everything = forms.BooleanField(
-        label="Effacer tout", required=False,
-        help_text="Effacer l'intégralité des données ferroviaires avant de "
-                  "procéder à l'importation."
+        label="Tout réimporter", required=False,
+        help_text="Réécrire l'intégralité des trains dans la nouvelle "
+                  "génération des horaires, plutôt que les seules "
+                  "différences. Les horaires actuels restent utilisés "
+                  "jusqu'à la fin de l'importation."
     )
@@ -1,37 +1,58 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from os.path import basename
-from django.shortcuts import render
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.views.decorators.http import require_POST
 from .admin_forms import GTFSImportForm
-from main.gtfs_parser import parse_gtfs_sncf
-from main.models import \
-    Train, TrainType, Station, Halt, Period, PeriodException
-
-
-def handle_uploaded_zip(f):
-    with open('/tmp/' + basename(f.name), 'wb+') as destination:
-        for chunk in f.chunks():
-            destination.write(chunk)
-        return '/tmp/' + basename(f.name)
+from main import jobs
+from main.models import ImportRun
+import json
 
 
+@staff_member_required
 def gtfs_import(request):
-    form = GTFSImportForm(request.POST, request.FILES)
+    """Mettre en file d'attente une importation GTFS à partir des archives
+    envoyées, puis afficher son avancement. L'importation est exécutée en
+    tâche de fond par la commande runimports."""
+    form = GTFSImportForm(request.POST or None, request.FILES or None)
     if form.is_valid():
-        ter_path = handle_uploaded_zip(request.FILES['zip_ter'])
-        ic_path = handle_uploaded_zip(request.FILES['zip_ic'])
-        if form.cleaned_data['clear_everything']:
-            Halt.objects.all().delete()
-            Station.objects.all().delete()
-            Train.objects.all().delete()
-            TrainType.objects.all().delete()
-            PeriodException.objects.all().delete()
-            Period.objects.all().delete()
-        parse_gtfs_sncf(ter_path, ic_path)
-        success = True
+        run = jobs.enqueue(
+            [request.FILES['zip_ter'], request.FILES['zip_ic']],
+            rebuild=form.cleaned_data['clear_everything'])
+        return redirect('gtfs-import-job', run.id)
+    runs = ImportRun.objects.order_by('-id')[:10]
 
     site_header = "Administration de TchouTchouGo"
     site_title = "TchouTchouGo Admin"
     title = "Importation GTFS"
     return render(request, 'admin/gtfs_import.html', locals())
+
+
+@staff_member_required
+def gtfs_import_job(request, run_id):
+    """Afficher l'avancement d'une importation GTFS."""
+    run = get_object_or_404(ImportRun, id=run_id)
+
+    site_header = "Administration de TchouTchouGo"
+    site_title = "TchouTchouGo Admin"
+    title = "Importation GTFS " + str(run.id)
+    return render(request, 'admin/gtfs_import_job.html', locals())
+
+
+@staff_member_required
+def gtfs_import_progress(request, run_id):
+    """Obtenir l'avancement d'une importation GTFS au format JSON."""
+    run = get_object_or_404(ImportRun, id=run_id)
+    return HttpResponse(json.dumps(run.progress()),
+                        content_type='application/json')
+
+
+@staff_member_required
+@require_POST
+def gtfs_import_cancel(request, run_id):
+    """Demander l'annulation d'une importation GTFS."""
+    run = get_object_or_404(ImportRun, id=run_id)
+    jobs.cancel(run.id)
+    return redirect('gtfs-import-job', run.id)
@@ -2,9 +2,16 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class MainConfig(AppConfig):
     """Configuration de l'application."""
     ## Nom de l'application.
     name = 'main'
+
+    def ready(self):
+        """Compléter les données existantes après chaque migration de
+        l'application (voir main.upgrade)."""
+        from main.upgrade import upgrade
+        post_migrate.connect(upgrade, sender=self)
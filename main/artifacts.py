@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Fichiers précalculés de la carte des gares (stations.geojson), proposée au
+téléchargement depuis la page de la carte.
+Ces fichiers ne changent qu'à chaque importation GTFS : ils sont alors écrits
+dans le dossier STATION_ARTIFACTS_DIR, accompagnés de versions compressées
+avec gzip et, si le module brotli est installé, avec Brotli. Un manifeste
+associe à chaque fichier l'empreinte de son contenu, utilisée comme ETag et
+dans les adresses versionnées.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import geojson
+from django.conf import settings
+from .models import Station
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+## Nom du manifeste des fichiers précalculés.
+MANIFEST = 'manifest.json'
+
+## Manifeste lu en dernier : (date de modification, contenu).
+_manifest = (None, {})
+
+
+def artifacts_dir():
+    """Obtenir le dossier des fichiers précalculés."""
+    return getattr(settings, 'STATION_ARTIFACTS_DIR',
+                   os.path.join(settings.BASE_DIR, 'artifacts'))
+
+
+def stations_geojson():
+    """Construire la carte des gares au format GeoJSON."""
+    return geojson.dumps(geojson.FeatureCollection([
+        geojson.Feature(geometry=geojson.Point((s[2], s[1])),
+                        properties={"title": s[0]})
+        for s in Station.objects.values_list('name', 'lat', 'lng')]))
+
+
+## Fichiers précalculés : nom -> fonction construisant le contenu.
+ARTIFACTS = {
+    'stations.geojson': stations_geojson,
+}
+
+
+def _write(path, data):
+    """Écrire un fichier de façon atomique, pour qu'une requête concurrente
+    ne lise jamais un fichier incomplet."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def _gzip(data):
+    """Compresser un contenu avec gzip. La date de modification de l'en-tête
+    est nulle, pour que la version compressée reste identique d'une
+    importation à l'autre lorsque le contenu ne change pas."""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def build_artifacts():
+    """Écrire tous les fichiers précalculés et leurs versions compressées,
+    puis le manifeste. Renvoie le manifeste."""
+    directory = artifacts_dir()
+    os.makedirs(directory, exist_ok=True)
+    manifest = {}
+    for name, build in ARTIFACTS.items():
+        data = build().encode('utf-8')
+        manifest[name] = hashlib.sha256(data).hexdigest()[:16]
+        path = os.path.join(directory, name)
+        _write(path, data)
+        _write(path + '.gz', _gzip(data))
+        if brotli is not None:
+            _write(path + '.br', brotli.compress(data))
+        elif os.path.exists(path + '.br'):
+            os.remove(path + '.br')
+    _write(os.path.join(directory, MANIFEST),
+           json.dumps(manifest).encode('utf-8'))
+    return manifest
+
+
+def get_artifact(name):
+    """Obtenir l'empreinte et le chemin d'un fichier précalculé. Les fichiers
+    sont construits s'ils n'existent pas encore.
+    Le manifeste n'est relu que s'il a été modifié, par exemple par une
+    importation dans un autre processus."""
+    global _manifest
+    path = os.path.join(artifacts_dir(), MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if mtime != _manifest[0]:
+            with open(path) as f:
+                _manifest = (mtime, json.load(f))
+    except FileNotFoundError:
+        _manifest = (None, {})
+    if name not in _manifest[1]:
+        _manifest = (None, build_artifacts())
+    return _manifest[1][name], os.path.join(artifacts_dir(), name)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Index des noms de gares pour l'autocomplétion et la validation des
+formulaires.
+Les noms sont normalisés (sans accents, sans casse, sans ponctuation et sans
+le préfixe « Gare de ») puis rangés dans une liste triée de clés, ce qui
+permet de trouver par dichotomie les gares dont le nom ou un des mots du nom
+commence par le texte saisi. Lorsqu'aucun nom ne correspond, les gares
+partageant le plus de trigrammes avec le texte saisi sont proposées, ce qui
+tolère les fautes de frappe.
+L'index est construit une seule fois par processus et reconstruit après
+chaque importation GTFS.
+"""
+
+import re
+import unicodedata
+from bisect import bisect_left
+from .models import Station, TimetableGeneration
+
+## Préfixe retiré des noms de gares, comme lors de l'importation GTFS.
+_PREFIX_REGEX = re.compile(r"^gare (de |d |du |des )?")
+## Caractères autres que les lettres et les chiffres.
+_SEPARATOR_REGEX = re.compile(r"[^0-9a-z]+")
+
+## Similarité minimale pour qu'une gare soit proposée par trigrammes.
+MIN_SIMILARITY = 0.3
+
+## Instance partagée par toutes les recherches du processus.
+_index = None
+
+
+def get_index():
+    """Obtenir l'index des noms de gares du processus, en le chargeant depuis
+    la base de données lors du premier appel ou lorsqu'une nouvelle
+    génération des horaires a été activée. La génération active est lue avec
+    TimetableGeneration.current_cached(), ce qui évite une requête à chaque
+    validation d'un nom de gare."""
+    global _index
+    generation = TimetableGeneration.current_cached()
+    if _index is None or _index.generation != generation:
+        _index = StationNames.load()
+        _index.generation = generation
+    return _index
+
+
+def invalidate():
+    """Oublier l'index des noms de gares chargé, pour qu'il soit reconstruit
+    lors de la prochaine recherche. À appeler après une importation GTFS."""
+    global _index
+    _index = None
+
+
+def normalize(text):
+    """Normaliser un nom de gare pour la comparaison : suppression des
+    accents, de la casse, de la ponctuation et du préfixe « Gare de »."""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join([c for c in text if not unicodedata.combining(c)])
+    text = _SEPARATOR_REGEX.sub(' ', text.lower()).strip()
+    return _PREFIX_REGEX.sub('', text)
+
+
+def _trigrams(text):
+    """Obtenir l'ensemble des trigrammes d'un texte normalisé."""
+    text = '  ' + text + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class StationNames(object):
+    """
+    Noms de toutes les gares, rangés pour l'autocomplétion.
+    Chaque gare est indexée sous son nom normalisé complet, ainsi que sous
+    chaque fin de nom commençant par un mot, pour trouver par exemple
+    « Paris Saint-Lazare » en tapant « lazare ».
+    """
+
+    def __init__(self, stations):
+        """Construire l'index à partir de couples bruts (id, nom)."""
+        ## Nom de chaque gare, indexé par identifiant.
+        self.names = dict(stations)
+        ## Identifiant de gare pour chaque nom exact.
+        self.exact = {}
+        ## Identifiant de gare pour chaque nom normalisé.
+        self.normalized = {}
+        ## Clés triées : (texte normalisé, rang, identifiant de gare). Le
+        #  rang vaut 0 pour le nom complet et 1 pour une fin de nom.
+        self.keys = []
+        ## Gares contenant chaque trigramme.
+        self.trigrams = {}
+
+        for station_id, name in sorted(self.names.items()):
+            self.exact.setdefault(name, station_id)
+            key = normalize(name)
+            self.normalized.setdefault(key, station_id)
+            words = key.split(' ')
+            for i in range(len(words)):
+                self.keys.append((' '.join(words[i:]), min(i, 1), station_id))
+            for trigram in _trigrams(key):
+                self.trigrams.setdefault(trigram, set()).add(station_id)
+        self.keys.sort()
+
+    @classmethod
+    def load(cls):
+        """Charger l'index depuis la base de données."""
+        return cls(Station.objects.values_list('id', 'name'))
+
+    def lookup(self, name):
+        """Obtenir l'identifiant de la gare portant un nom donné, en
+        comparant d'abord les noms exacts puis les noms normalisés.
+        Renvoie None si aucune gare ne correspond."""
+        if name in self.exact:
+            return self.exact[name]
+        return self.normalized.get(normalize(name))
+
+    def complete(self, text, k=10):
+        """Rechercher les k gares correspondant le mieux à un texte saisi.
+        Les gares dont le nom commence par le texte passent en premier, puis
+        celles dont un mot du nom commence par le texte ; à défaut, les gares
+        les plus proches par trigrammes sont proposées. À rang égal, les noms
+        les plus courts sont préférés.
+        Renvoie une liste de couples (identifiant, nom)."""
+        query = normalize(text)
+        if not query or k <= 0:
+            return []
+        found = {}
+        for i in range(bisect_left(self.keys, (query,)), len(self.keys)):
+            key, rank, station_id = self.keys[i]
+            if not key.startswith(query):
+                break
+            if rank < found.get(station_id, (2,))[0]:
+                found[station_id] = (rank, len(self.names[station_id]))
+        if not found:
+            for station_id, similarity in self._similar(query):
+                found.setdefault(station_id, (2, -similarity))
+        best = sorted(found.items(),
+                      key=lambda f: f[1] + (self.names[f[0]],))[:k]
+        return [(station_id, self.names[station_id])
+                for station_id, _ in best]
+
+    def _similar(self, query):
+        """Rechercher les gares partageant suffisamment de trigrammes avec un
+        texte normalisé. Renvoie des couples (identifiant, similarité)."""
+        trigrams = _trigrams(query)
+        shared = {}
+        for trigram in trigrams:
+            for station_id in self.trigrams.get(trigram, ()):
+                shared[station_id] = shared.get(station_id, 0) + 1
+        return [(station_id, count / len(trigrams))
+                for station_id, count in shared.items()
+                if count / len(trigrams) >= MIN_SIMILARITY]
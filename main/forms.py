@@ -3,13 +3,13 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
-from .models import Station
 from .models import Passenger
+from .autocomplete import get_index as get_station_names
 from django.core.exceptions import ValidationError
 
 
 def validate_station(value):
-    if not value or not Station.objects.filter(name=value).exists():
+    if not value or get_station_names().lookup(value) is None:
         raise ValidationError("La gare de %(value)s n'existe pas.",
                               code='notfound', params={'value': value})
 
@@ -1,66 +1,350 @@
 # -*- coding: utf-8 -*-
+"""
+Importation des données GTFS de la SNCF.
+L'importation se déroule en deux phases. Les fichiers de chaque archive sont
+d'abord lus et transformés en données simples (tuples et dictionnaires),
+sans accès à la base de données ; les parties indépendantes de chaque
+archive (calendrier, gares, voyages) peuvent alors être traitées en
+parallèle par GTFS_IMPORT_WORKERS processus. Les voyages, de loin les plus
+volumineux, ne sont pas conservés en mémoire : ils sont écrits par lots dans
+un fichier temporaire, relu lot par lot lors de l'écriture. Les données sont
+ensuite écrites dans la base de données par le processus principal, archive
+par archive dans l'ordre des arguments, ce qui rend le résultat identique à
+une importation séquentielle.
+Les trains et les jours de service sont écrits dans une nouvelle génération
+des horaires, à côté de la génération active utilisée par les recherches.
+La nouvelle génération n'est activée qu'une fois vérifiée ; la génération
+précédente est conservée en réserve pour pouvoir y revenir.
+Chaque étape est mesurée par le module telemetry, et chaque importation est
+enregistrée avec ses mesures dans un objet ImportRun.
+"""
 
 import zipfile
+import hashlib
+import io
+import json
 import os
+import pickle
+import tempfile
+import time
 import csv
 import re
-from datetime import date, time
-from .utility import remove_if_exists
-from .models import Period, PeriodException, TrainType, Station, Train, Halt
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError
+import numpy as np
+import django
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, islice
+from datetime import date
+from .utility import parse_gtfs_time, seconds_to_time, haversine_array, \
+    bulk_batch_size, reset_sequences
+from .timetable import invalidate as invalidate_timetable
+from .spatial import invalidate as invalidate_station_index
+from .autocomplete import invalidate as invalidate_station_names
+from .artifacts import build_artifacts
+from . import telemetry
+from .models import Period, PeriodException, TrainType, Station, Train, \
+    Halt, Ticket, ServiceDay, TimetableGeneration, ImportRun
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import F, Max
 
+## Nombre de trains écrits, avec leurs arrêts, dans chaque transaction lors
+#  de l'importation.
+TRIP_BATCH_SIZE = getattr(settings, 'GTFS_IMPORT_TRIP_BATCH_SIZE', 1000)
+## Nombre maximal de lignes insérées par requête lors de l'importation.
+INSERT_BATCH_SIZE = getattr(settings, 'GTFS_IMPORT_INSERT_BATCH_SIZE', 1000)
+## Proportion minimale des trains de la génération active que doit contenir
+#  une nouvelle génération pour être activée.
+MIN_TRAIN_RATIO = getattr(settings, 'GTFS_IMPORT_MIN_TRAIN_RATIO', 0.5)
 
-def parse_gtfs_sncf(*args):
+## Fichiers devant être présents dans chaque archive GTFS.
+GTFS_FILES = ['calendar.txt', 'calendar_dates.txt', 'routes.txt', 'stops.txt',
+              'stop_times.txt', 'trips.txt']
+
+## Champs des périodes de service lus dans calendar.txt.
+PERIOD_FIELDS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                 'saturday', 'sunday', 'start_date', 'end_date']
+
+## Parties indépendantes d'une archive GTFS, lues séparément.
+GTFS_PARTS = ['calendar', 'stops', 'trips']
+
+## Étapes mesurées de la lecture de chaque archive (voir read_gtfs_part()).
+ARCHIVE_STAGES = ['calendar', 'calendar_dates', 'stops', 'stops_traintype',
+                  'stops_station', 'trips']
+## Autres étapes mesurées de l'importation (voir import_gtfs_feeds()).
+IMPORT_STAGES = ['unzip', 'write_periods', 'write_traintypes',
+                 'write_stations', 'write_trains', 'service_days', 'validate',
+                 'activate', 'purge', 'artifacts']
+
+## Convertit un identifiant d'arrêt SNCF du type
+#  StopPoint:OCETrain TER-87576173
+#  en un type de train ("Train TER" dans l'exemple).
+TRAINTYPE_REGEX = re.compile(r"^.*OCE(.*)-[0-9]+$", re.MULTILINE)
+## Convertit un identifiant d'arrêt SNCF en identifiant de gare
+#  (87576173 dans l'exemple ci-dessus).
+STATION_ID_REGEX = re.compile(r"^.*OCE.*-([0-9]+)$", re.MULTILINE)
+## Retire le préfixe « Gare de » des noms de gares.
+STATION_NAME_REGEX = re.compile(r"^(gare de)? (.*)$",
+                                re.MULTILINE | re.IGNORECASE)
+
+
+def parse_gtfs_sncf(*args, rebuild=False, run=None):
     """
     Prend en charge la conversion de plusieurs archives ZIP contenant des
     données GTFS en provenance de la SNCF.
     Passez en argument des chemins d'accès vers les archives ZIP GTFS.
+    Les fichiers sont lus directement dans les archives, sans extraction.
+    Seules les différences avec la génération active des horaires sont
+    écrites, sauf si rebuild vaut True : tous les trains sont alors réécrits
+    dans la nouvelle génération.
+    L'importation et les mesures de ses étapes sont enregistrées dans l'objet
+    ImportRun run, créé s'il n'est pas fourni, que l'importation réussisse
+    ou non.
+    Lève ValueError, sans modifier la génération active, si la nouvelle
+    génération ne passe pas la vérification de validate_generation().
+    Renvoie, pour les périodes, les gares et les trains, le nombre d'objets
+    insérés, modifiés, inchangés, retirés ou ignorés (voir
+    save_gtfs_feeds()).
     """
     print("Started parsing SNCF GTFS data.")
-    for path in args:
-        assert path.endswith('.zip')
-        assert os.path.isfile(path)
-        archive = zipfile.ZipFile(path, 'r')
-        archive.extractall(path=path.replace('.zip', '/'))
-        archive.close()
-    folders = [p.replace('.zip', '/') for p in args]
-    print("Unzipped archives.")
-    for f in folders:
-        print("Parsing " + f)
-        assert os.path.exists(f + "calendar.txt")
-        assert os.path.exists(f + "calendar_dates.txt")
-        assert os.path.exists(f + "routes.txt")
-        assert os.path.exists(f + "stops.txt")
-        assert os.path.exists(f + "stop_times.txt")
-        assert os.path.exists(f + "trips.txt")
-        remove_if_exists(f + "agency.txt")
-        remove_if_exists(f + "transfers.txt")
-        print("Parsing " + f + "calendar.txt")
-        parse_gtfs_calendar(csv_reader_skip_header(f + 'calendar.txt'))
-        print("Parsing " + f + "calendar_dates.txt")
-        parse_gtfs_calendar_dates(
-            csv_reader_skip_header(f + 'calendar_dates.txt'))
-        print("Parsing " + f + "stops.txt (first pass)")
-        parse_gtfs_stops_traintype(csv_reader_skip_header(f + "stops.txt"))
-        print("Parsing " + f + "stops.txt (second pass)")
-        parse_gtfs_stops_station(csv_reader_skip_header(f + "stops.txt"))
-        print("Parsing " + f + "trips.txt and " + f +
-              "stop_times.txt, writing trains to database")
-        parse_gtfs_trains(
-            csv_reader_skip_header(f + "trips.txt"), f + "stop_times.txt")
-
-
-def csv_reader_skip_header(path):
-    """Ouvrir un fichier CSV en lecture,
-    et passer la ligne d'en-tête s'il y en a une."""
-    file = open(path, "r")
-    has_header = csv.Sniffer().has_header(str(file.read(1024)))
-    file.seek(0)
-    csvreader = csv.reader(file)
-    if has_header:
-        next(csvreader)
-    return csvreader
+    if run is None:
+        run = ImportRun()
+    run.sources = "\n".join([os.path.basename(path) for path in args])
+    run.status = ImportRun.RUNNING
+    # Une importation en tâche de fond peut être annulée à tout moment :
+    # seuls les champs écrits par l'importation sont enregistrés
+    run.save(update_fields=None if run.pk is None else ['sources', 'status'])
+    # Mesures d'une importation précédente dans le même processus
+    telemetry.collect()
+    start = time.perf_counter()
+    try:
+        delta = import_gtfs_feeds(args, rebuild, run)
+        run.delta = json.dumps(delta)
+        run.status = ImportRun.SUCCEEDED
+    except telemetry.Cancelled:
+        run.status = ImportRun.CANCELLED
+        raise
+    except BaseException as e:
+        run.status = ImportRun.FAILED
+        run.error = type(e).__name__ + ": " + str(e)
+        raise
+    finally:
+        run.seconds = time.perf_counter() - start
+        run.finished = timezone.now()
+        run.stages = json.dumps(telemetry.collect())
+        run.save(update_fields=['status', 'error', 'delta', 'seconds',
+                                'finished', 'stages'])
+    for stage in json.loads(run.stages):
+        print(telemetry.format_stage(stage))
+    for name, counts in delta.items():
+        print(name.capitalize() + ": " + ", ".join(
+            [str(n) + " " + state for state, n in counts.items()]))
+    return delta
+
+
+def import_gtfs_feeds(paths, rebuild, run):
+    """Importer des archives GTFS dans une nouvelle génération des horaires,
+    enregistrée dans run, puis l'activer (voir parse_gtfs_sncf())."""
+    with telemetry.stage('unzip') as s:
+        for path in paths:
+            assert path.endswith('.zip')
+            assert os.path.isfile(path)
+            with zipfile.ZipFile(path, 'r') as archive:
+                members = archive.namelist()
+            for member in GTFS_FILES:
+                assert member in members, path + " : " + member + " manquant"
+            s.rows += len(members)
+    # Les voyages lus sont conservés dans le dossier spool jusqu'à leur
+    # écriture
+    with tempfile.TemporaryDirectory(prefix='gtfs-') as spool:
+        feeds = read_gtfs_feeds(paths, spool)
+        base = TimetableGeneration.current()
+        generation = TimetableGeneration.objects.create()
+        run.generation = generation
+        run.save(update_fields=['generation'])
+        print("Writing generation " + str(generation.id) + " to database")
+        try:
+            delta = save_gtfs_feeds(feeds, base, generation.id, rebuild)
+            # Les identifiants ayant été fournis explicitement, les séquences
+            # de la base de données doivent être mises à jour
+            reset_sequences(Period, Station, Train)
+            print("Building service days")
+            with telemetry.stage('service_days') as s:
+                s.rows = build_service_days(generation.id)
+            with telemetry.stage('validate') as s:
+                s.rows = validate_generation(generation.id, base)
+        except BaseException:
+            generation.status = TimetableGeneration.FAILED
+            generation.save(update_fields=['status'])
+            raise
+    # La nouvelle génération invalide les horaires chargés en mémoire et les
+    # résultats de recherche en cache dans tous les processus
+    print("Activating generation " + str(generation.id))
+    with telemetry.stage('activate'):
+        generation.activate()
+        invalidate_timetable()
+        invalidate_station_index()
+        invalidate_station_names()
+    with telemetry.stage('purge') as s:
+        s.rows = purge_generations()
+    print("Writing station artifacts")
+    with telemetry.stage('artifacts') as s:
+        s.rows = len(build_artifacts())
+    return delta
+
+
+def read_gtfs_feeds(paths, spool):
+    """Lire toutes les parties de plusieurs archives GTFS, en parallèle si
+    le paramètre GTFS_IMPORT_WORKERS est supérieur à 1. Les voyages sont
+    écrits dans des fichiers temporaires du dossier spool.
+    Renvoie, dans l'ordre des archives, un dictionnaire par archive
+    associant à chaque partie ses données."""
+    tasks = [(path, part, spool) for path in paths for part in GTFS_PARTS]
+    workers = getattr(settings, 'GTFS_IMPORT_WORKERS', 1)
+    if workers > 1:
+        print("Parsing " + str(len(tasks)) + " parts with " + str(workers) +
+              " processes")
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker) as pool:
+            # map() renvoie les résultats dans l'ordre des tâches
+            results = []
+            for result, stages in pool.map(read_gtfs_part_worker,
+                                           *zip(*tasks)):
+                results.append(result)
+                telemetry.record(stages)
+    else:
+        results = [read_gtfs_part(*task) for task in tasks]
+    return [dict(zip(GTFS_PARTS, results[i:i + len(GTFS_PARTS)]))
+            for i in range(0, len(results), len(GTFS_PARTS))]
+
+
+def init_worker():
+    """Préparer un processus de lecture des archives GTFS."""
+    # django.setup() permet aussi aux processus démarrés sans fork()
+    # d'importer ce module
+    django.setup()
+    # Mesures et suivi hérités du processus principal lors d'un fork()
+    telemetry.collect()
+    telemetry.listen(None)
+
+
+def read_gtfs_part_worker(path, part, spool):
+    """Lire une partie d'une archive GTFS dans un processus de lecture.
+    Renvoie le résultat de read_gtfs_part() et les mesures de ses étapes."""
+    return read_gtfs_part(path, part, spool), telemetry.collect()
+
+
+def read_gtfs_part(path, part, spool):
+    """Lire une partie d'une archive GTFS et la transformer en données
+    simples, sans accès à la base de données. Les voyages sont écrits dans
+    un fichier temporaire du dossier spool, dont le chemin d'accès est
+    renvoyé (voir spool_trains()). Cette fonction peut être exécutée dans un
+    autre processus."""
+    print("Parsing " + path + " (" + part + ")")
+    source = os.path.basename(path)
+    with zipfile.ZipFile(path, 'r') as archive:
+        if part == 'calendar':
+            with telemetry.stage('calendar', source) as s:
+                periods = parse_gtfs_calendar(
+                    s.count(read_gtfs_csv(archive, 'calendar.txt')))
+            with telemetry.stage('calendar_dates', source) as s:
+                exceptions = parse_gtfs_calendar_dates(
+                    s.count(read_gtfs_csv(archive, 'calendar_dates.txt')))
+            return periods, exceptions
+        if part == 'stops':
+            # Le fichier stops.txt n'est décompressé qu'une seule fois
+            with telemetry.stage('stops', source) as s:
+                stops = list(s.count(read_gtfs_csv(archive, 'stops.txt')))
+            with telemetry.stage('stops_traintype', source) as s:
+                traintypes = parse_gtfs_stops_traintype(s.count(stops))
+            with telemetry.stage('stops_station', source) as s:
+                stations = parse_gtfs_stops_station(s.count(stops))
+            return traintypes, stations
+        # Les lignes comptées sont celles de stop_times.txt, bien plus
+        # nombreuses que celles de trips.txt
+        with telemetry.stage('trips', source) as s:
+            return spool_trains(parse_gtfs_trains(
+                read_gtfs_csv(archive, 'trips.txt'),
+                s.count(read_gtfs_csv(archive, 'stop_times.txt'))), spool)
+
+
+def spool_trains(trains, spool):
+    """Écrire des voyages lus par parse_gtfs_trains() dans un fichier
+    temporaire du dossier spool, par lots de TRIP_BATCH_SIZE voyages
+    sérialisés avec pickle. Renvoie le chemin d'accès du fichier."""
+    fd, path = tempfile.mkstemp(suffix='.trips', dir=spool)
+    with os.fdopen(fd, 'wb') as f:
+        for batch in iter(lambda: list(islice(trains, TRIP_BATCH_SIZE)), []):
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_spooled_trains(path):
+    """Relire, lot par lot, les voyages écrits par spool_trains()."""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+def save_gtfs_feeds(feeds, base, generation, rebuild=False):
+    """Fusionner les données de plusieurs archives GTFS lues par
+    read_gtfs_feeds(), puis n'écrire dans la base de données que leurs
+    différences avec la génération des horaires base. Les trains sont écrits
+    dans la génération generation (voir save_trains()).
+    Une période, une exception, une gare ou un voyage présent dans plusieurs
+    archives est pris dans la première d'entre elles. Les voyages sont relus
+    lot par lot dans leurs fichiers temporaires au fil de l'écriture.
+    Renvoie un dictionnaire associant à 'periods', 'stations' et 'trains'
+    le nombre d'objets de chaque état (inséré, modifié, inchangé, retiré,
+    ignoré)."""
+    periods = {}
+    exceptions = {}
+    traintypes = set()
+    stations = {}
+    for feed in feeds:
+        feed_periods, feed_exceptions = feed['calendar']
+        feed_traintypes, feed_stations = feed['stops']
+        for period_id, fields in feed_periods.items():
+            periods.setdefault(period_id, fields)
+        for period_id, day, add_day in feed_exceptions:
+            exceptions.setdefault((period_id, day), add_day)
+        traintypes |= feed_traintypes
+        for station_id, station in feed_stations.items():
+            stations.setdefault(station_id, station)
+    delta = OrderedDict()
+    with telemetry.stage('write_periods') as s:
+        delta['periods'] = save_periods(periods, exceptions)
+        s.rows = len(periods) + len(exceptions)
+    with telemetry.stage('write_traintypes') as s:
+        save_traintypes(traintypes)
+        s.rows = len(traintypes)
+    with telemetry.stage('write_stations') as s:
+        delta['stations'] = save_stations(stations)
+        s.rows = len(stations)
+    with telemetry.stage('write_trains') as s:
+        delta['trains'] = save_trains(
+            (trip for feed in feeds
+             for trip in read_spooled_trains(feed['trips'])),
+            base, generation, rebuild)
+        s.rows = delta['trains']['inserted'] + delta['trains']['unchanged']
+    return delta
+
+
+def read_gtfs_csv(archive, name):
+    """Lire un fichier CSV d'une archive GTFS au fil de sa décompression,
+    sans l'extraire sur le disque.
+    Chaque ligne est renvoyée sous forme de dictionnaire indexé par les noms
+    de colonnes de la ligne d'en-tête, ce qui rend la lecture indépendante
+    de l'ordre des colonnes."""
+    with archive.open(name) as member:
+        # utf-8-sig ignore l'éventuelle marque d'ordre des octets
+        yield from csv.DictReader(
+            io.TextIOWrapper(member, encoding='utf-8-sig', newline=''))
 
 
 def parse_gtfs_date(datestr):
@@ -68,116 +352,449 @@ def parse_gtfs_date(datestr):
     return date(int(datestr[:4]), int(datestr[4:6]), int(datestr[-2:]))
 
 
+###############################################################################
+# Lecture des fichiers GTFS
+###############################################################################
+
+
 def parse_gtfs_calendar(lines):
-    """Créer des objets Period correspondant au fichier calendar
-    du format GTFS."""
-    p = []
+    """Lire les périodes du fichier calendar du format GTFS.
+    Renvoie un dictionnaire associant à chaque identifiant de période les
+    champs d'un objet Period. Si une période apparaît plusieurs fois, sa
+    première occurrence est retenue."""
+    periods = {}
     for line in lines:
-        if Period.objects.filter(id=int(line[0])).exists():
+        period_id = int(line['service_id'])
+        if period_id in periods:
             continue
-        p.append(Period(id=int(line[0]),
-                        monday=(line[1] == '1'),
-                        tuesday=(line[2] == '1'),
-                        wednesday=(line[3] == '1'),
-                        thursday=(line[4] == '1'),
-                        friday=(line[5] == '1'),
-                        saturday=(line[6] == '1'),
-                        sunday=(line[7] == '1'),
-                        start_date=parse_gtfs_date(line[8]),
-                        end_date=parse_gtfs_date(line[9])))
-    print("Writing to database...")
-    Period.objects.bulk_create(p)
+        periods[period_id] = dict(
+            monday=(line['monday'] == '1'),
+            tuesday=(line['tuesday'] == '1'),
+            wednesday=(line['wednesday'] == '1'),
+            thursday=(line['thursday'] == '1'),
+            friday=(line['friday'] == '1'),
+            saturday=(line['saturday'] == '1'),
+            sunday=(line['sunday'] == '1'),
+            start_date=parse_gtfs_date(line['start_date']),
+            end_date=parse_gtfs_date(line['end_date']))
+    return periods
 
 
 def parse_gtfs_calendar_dates(lines):
-    """Créer des objets PeriodException correspondant au fichier
-    calendar_dates du format GTFS."""
-    pex = []
+    """Lire les exceptions du fichier calendar_dates du format GTFS.
+    Renvoie une liste de tuples (période, date, jour ajouté)."""
+    return [(int(line['service_id']), parse_gtfs_date(line['date']),
+             line['exception_type'] == '1') for line in lines]
+
+
+def parse_gtfs_stops_traintype(lines):
+    """Lire les types de trains depuis les données du fichier stops.txt du
+    format GTFS. Renvoie un ensemble de noms."""
+    # Seuls les identifiants commençant par "StopPoint" contiennent un type
+    # de train, StopArea n'en contient pas. Les très nombreux doublons sont
+    # écartés par l'ensemble.
+    return {TRAINTYPE_REGEX.sub('\\1', line['stop_id']) for line in lines
+            if line['stop_id'].startswith("StopPoint")}
+
+
+def parse_gtfs_stops_station(lines):
+    """Lire les gares depuis les données du fichier stops.txt du format
+    GTFS. Renvoie un dictionnaire associant à chaque identifiant de gare un
+    tuple (nom, latitude, longitude) ; si une gare apparaît plusieurs fois,
+    sa dernière occurrence est retenue."""
+    stations = {}
     for line in lines:
-        p = Period.objects.filter(id=int(line[0]))
-        if not p.exists():
+        if not line['stop_id'].startswith("StopPoint"):
             continue
-        else:
-            p = p.get()
-        date = parse_gtfs_date(line[1])
-        if PeriodException.objects.filter(period=p, date=date).exists():
+        stations[int(STATION_ID_REGEX.sub('\\1', line['stop_id']))] = (
+            STATION_NAME_REGEX.sub('\\2', line['stop_name']),
+            float(line['stop_lat']), float(line['stop_lon']))
+    return stations
+
+
+def parse_gtfs_trains(trips, stop_times):
+    """Lire les voyages des fichiers trips.txt et stop_times.txt du format
+    GTFS, lus avec read_gtfs_csv().
+    Le fichier stop_times.txt est lu une seule fois, ses lignes devant être
+    regroupées par trip_id comme dans les données de la SNCF.
+    Renvoie un itérateur de tuples (empreinte, numéro de train, période,
+    type de train, arrêts), chaque arrêt étant un tuple (gare, arrivée en
+    secondes, départ en secondes, numéro de séquence) ; l'empreinte est
+    calculée par trip_fingerprint().
+    Les voyages sont produits au fil de la lecture de stop_times.txt."""
+    trips = {trip['trip_id']: trip for trip in trips}
+    seen = set()
+    for trip_id, trip_stop_times in groupby(
+            stop_times, key=lambda s: s['trip_id']):
+        if trip_id not in trips:
             continue
-        pex.append(PeriodException(date=date,
-                                   add_day=line[2] == '1',
-                                   period=p))
-    print("Writing to database...")
-    PeriodException.objects.bulk_create(pex)
+        if trip_id in seen:
+            raise ValueError("stop_times.txt n'est pas trié par trip_id "
+                             "(voyage " + trip_id + ").")
+        seen.add(trip_id)
+        trip = trips[trip_id]
+        trip_stop_times = list(trip_stop_times)
+        train = (
+            int(trip['trip_headsign']), int(trip['service_id']),
+            TRAINTYPE_REGEX.sub('\\1', trip_stop_times[0]['stop_id']),
+            sorted([(int(STATION_ID_REGEX.sub('\\1', stop_time['stop_id'])),
+                     parse_gtfs_time(stop_time['arrival_time']),
+                     parse_gtfs_time(stop_time['departure_time']),
+                     int(stop_time['stop_sequence']))
+                    for stop_time in trip_stop_times],
+                   key=lambda stop: stop[3]))
+        yield (trip_fingerprint(*train),) + train
 
 
-def parse_gtfs_stops_traintype(lines):
-    """Créer des objets TrainType depuis les données du fichier stops.txt du
-    format GTFS."""
-    # L'expression régulière convertit un identifiant de station SNCF du type
-    # StopPoint:OCETrain TER-87576173
-    # en un type de train ("Train TER" dans l'exemple).
-    regex = re.compile(r"^.*OCE(.*)-[0-9]+$", re.MULTILINE)
-    # Une compréhension de liste utilisant lines va trier et ne récupérer que
-    # les ID commençant par "StopPoint" puisque StopArea ne contient pas de
-    # types de trains. Une seconde compréhension de liste va ensuite exécuter
-    # l'expression régulière.
-    # set() permet de supprimer les très nombreux doublons.
-    # On reconvertit ensuite en liste avec list() pour créer des TrainTypes,
-    # dans une troisième compréhension de liste, en évitant les doublons.
-    traintypes = [TrainType(name=name) for name in list(set(
-        [regex.sub('\\1', stopid) for stopid in
-            [line[0] for line in lines if line[0].startswith("StopPoint")]]))
-        if not TrainType.objects.filter(name=name).exists()]
-    print("Writing to database...")
-    [tt.save() for tt in traintypes]
+def trip_fingerprint(number, period_id, traintype, stops):
+    """Calculer l'empreinte d'un voyage à partir de son numéro de train, de
+    son identifiant de période GTFS, de son type de train et de ses arrêts
+    triés par numéro de séquence."""
+    return hashlib.sha1(repr(
+        (number, period_id, traintype, stops)).encode('utf-8')).hexdigest()
 
 
-def parse_gtfs_stops_station(lines):
-    """Créer des objets Station depuis les données du fichier stops.txt du
-    format GTFS."""
-    id_regex = re.compile(r"^.*OCE.*-([0-9]+)$", re.MULTILINE)
-    name_regex = re.compile(r"^(gare de)? (.*)$", re.MULTILINE | re.IGNORECASE)
-    stations = [Station(id=int(id_regex.sub('\\1', line[0])),
-                        name=name_regex.sub('\\2', line[1]),
-                        lat=line[3], lng=line[4])
-                for line in lines
-                if line[0].startswith("StopPoint") and not Station.objects
-                .filter(id=int(id_regex.sub('\\1', line[0]))).exists()]
-    print("Writing to database...")
-    [s.save() for s in stations]
-
-
-def parse_gtfs_trains(trips, stop_times_path):
-    """Créer des objets Train et Halt correspondant aux données des fichiers
-    trips.txt et stop_times.txt du format GTFS.
-    Attention : Cette méthode prend en paramètre un lecteur de fichiers CSV
-    pour trips.txt et un chemin d'accès seulement pour stop_times.txt."""
-    station_id_regex = re.compile(r"^.*OCE.*-([0-9]+)$", re.MULTILINE)
-    stop_times_file = open(stop_times_path)
-    stop_times = csv.reader(stop_times_file)
-    # Permet de trouver le type de train
-    tt_regex = re.compile(r"^.*OCE(.*)-[0-9]+$", re.MULTILINE)
-    halts = []
-    period_ids = Period.objects.values_list("id", flat=True)
+###############################################################################
+# Écriture dans la base de données
+###############################################################################
+
+
+def bulk_insert(model, objs):
+    """Insérer des objets dans la base de données par lots d'au plus
+    INSERT_BATCH_SIZE lignes."""
+    model.objects.bulk_create(
+        objs, batch_size=bulk_batch_size(model, objs, INSERT_BATCH_SIZE))
+
+
+def save_periods(periods, exceptions):
+    """Créer ou mettre à jour les objets Period et PeriodException lus par
+    parse_gtfs_calendar() et parse_gtfs_calendar_dates().
+    periods associe à chaque identifiant de période ses champs, exceptions
+    associe à chaque couple (période, date) le booléen add_day.
+    Une période déjà connue n'est réécrite, avec ses exceptions, que si ses
+    jours de circulation ou ses exceptions ont changé. Les exceptions des
+    périodes absentes de calendar.txt ne sont ajoutées que si la période
+    existe déjà.
+    Renvoie le nombre de périodes insérées, modifiées et inchangées."""
+    current = {p.pop('id'): p for p in Period.objects.values(
+        'id', *PERIOD_FIELDS)}
+    current_exceptions = {}
+    for period_id, day, add_day in PeriodException.objects.values_list(
+            'period_id', 'date', 'add_day'):
+        current_exceptions.setdefault(period_id, {})[day] = add_day
+    wanted_exceptions = {}
+    for (period_id, day), add_day in exceptions.items():
+        wanted_exceptions.setdefault(period_id, {})[day] = add_day
+
+    inserted = [period_id for period_id in periods if period_id not in current]
+    updated = [period_id for period_id in periods if period_id in current and
+               (periods[period_id] != current[period_id] or
+                wanted_exceptions.get(period_id, {}) !=
+                current_exceptions.get(period_id, {}))]
+    pex = [PeriodException(period_id=period_id, date=day, add_day=add_day)
+           for period_id in inserted + updated
+           for day, add_day in wanted_exceptions.get(period_id, {}).items()]
+    # Exceptions de périodes connues mais absentes de calendar.txt
+    pex += [PeriodException(period_id=period_id, date=day, add_day=add_day)
+            for (period_id, day), add_day in exceptions.items()
+            if period_id in current and period_id not in periods and
+            day not in current_exceptions.get(period_id, {})]
+    print("Writing " + str(len(inserted)) + " new and " + str(len(updated)) +
+          " changed periods to database...")
+    with transaction.atomic():
+        bulk_insert(Period, [Period(id=period_id, **periods[period_id])
+                             for period_id in inserted])
+        for period_id in updated:
+            Period.objects.filter(id=period_id).update(**periods[period_id])
+        PeriodException.objects.filter(period_id__in=updated).delete()
+        bulk_insert(PeriodException, pex)
+    return OrderedDict([
+        ('inserted', len(inserted)), ('updated', len(updated)),
+        ('unchanged', len(periods) - len(inserted) - len(updated))])
+
+
+def save_traintypes(names):
+    """Créer les objets TrainType lus par parse_gtfs_stops_traintype(). Les
+    types de trains déjà connus sont ignorés."""
+    names = set(names) - set(TrainType.objects.values_list('name', flat=True))
+    print("Writing " + str(len(names)) + " train types to database...")
+    with transaction.atomic():
+        bulk_insert(TrainType,
+                    [TrainType(name=name) for name in sorted(names)])
+
+
+def save_stations(stations):
+    """Créer les objets Station lus par parse_gtfs_stops_station(). Les
+    gares déjà connues sont ignorées.
+    Renvoie le nombre de gares insérées et inchangées."""
+    existing = set(Station.objects.values_list('id', flat=True))
+    s = [Station(id=station_id, name=name, lat=lat, lng=lng)
+         for station_id, (name, lat, lng) in stations.items()
+         if station_id not in existing]
+    print("Writing " + str(len(s)) + " stations to database...")
+    with transaction.atomic():
+        bulk_insert(Station, s)
+    return OrderedDict([('inserted', len(s)),
+                        ('unchanged', len(stations) - len(s))])
+
+
+def save_trains(trips, base, generation, rebuild=False):
+    """Créer les objets Train et Halt lus par parse_gtfs_trains(), parcourus
+    une seule fois dans l'itérable trips, dans la génération des horaires
+    generation, en ne conservant que les voyages dont l'empreinte ne
+    correspond à aucun train de la génération base. Les trains de la
+    génération base dont le voyage a disparu, ou a changé, sont
+    retirés : leur dernière génération devient base, ce qui les conserve
+    pour un retour en arrière. Si rebuild vaut True, tous les trains de la
+    génération base sont retirés et tous les voyages sont insérés.
+    Les trains des générations abandonnées depuis base sont écartés par
+    discard_trains(). Aucun train de la génération base n'est modifié de
+    façon visible dans cette génération : les recherches peuvent continuer
+    pendant l'importation.
+    Les identifiants des trains sont attribués à l'avance, pour insérer
+    trains et arrêts par lots sans relire la base de données. Chaque lot de
+    TRIP_BATCH_SIZE trains est écrit dans sa propre transaction, ce qui
+    borne la durée des verrous ; seul le lot en cours est conservé en
+    mémoire.
+    Les voyages dont le type de train ou l'une des gares est inconnu sont
+    ignorés, avec un avertissement.
+    Renvoie le nombre de trains insérés, inchangés, retirés et ignorés."""
+    backfill_fingerprints()
+    discard_trains(base, generation)
+    # Un seul train par empreinte est conservé, les doublons éventuels des
+    # importations précédentes sont retirés
+    existing = {}
+    stale = []
+    closed = []
+    for train_id, fingerprint, last_generation in Train.objects.filter(
+            Train.in_generation(base)).order_by('id').values_list(
+            'id', 'fingerprint', 'last_generation'):
+        if fingerprint in existing or rebuild:
+            stale.append(train_id)
+        else:
+            existing[fingerprint] = train_id
+            if last_generation is not None:
+                closed.append(fingerprint)
+    period_ids = set(Period.objects.values_list("id", flat=True))
+    traintype_ids = {name: traintype_id for traintype_id, name
+                     in TrainType.objects.values_list('id', 'name')}
+    coords = {station_id: (lat, lng) for station_id, lat, lng
+              in Station.objects.values_list('id', 'lat', 'lng')}
+    next_id = (Train.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+    # Les voyages sont lus au fil de l'écriture : seules leurs empreintes
+    # sont conservées en mémoire
+    wanted = set()
+    inserted = 0
+    skipped = []
+    new_trips = _new_trips(_known_trips(trips, traintype_ids, coords, skipped),
+                           existing, wanted)
+    for batch in iter(lambda: list(islice(new_trips, TRIP_BATCH_SIZE)), []):
+        inserted += len(batch)
+        trains = []
+        halts = []
+        for fingerprint, number, period_id, traintype, stops in batch:
+            t = Train(id=next_id, number=number, capacity=3,
+                      traintype_id=traintype_ids[traintype],
+                      period_id=period_id if period_id in period_ids
+                      else None, fingerprint=fingerprint,
+                      first_generation=generation)
+            next_id += 1
+            trains.append(t)
+            # bulk_create() n'appelant pas Halt.save(), les heures affichées
+            # sont calculées ici
+            halts.extend([Halt(arrival_s=arrival, departure_s=departure,
+                               arrival=seconds_to_time(arrival),
+                               departure=seconds_to_time(departure),
+                               sequence=sequence, station_id=station_id,
+                               train_id=t.id)
+                          for station_id, arrival, departure, sequence
+                          in stops])
+        write_trains(trains, halts, coords)
+    stale += [train_id for fingerprint, train_id in existing.items()
+              if fingerprint not in wanted]
+    # Trains retirés par une génération abandonnée, mais toujours présents
+    reopened = [existing[fingerprint] for fingerprint in closed
+                if fingerprint in wanted]
+    if skipped:
+        print("Warning: skipped " + str(len(skipped)) + " trips with an "
+              "unknown station or train type (trains " +
+              ", ".join([str(number) for number in skipped[:10]]) +
+              (", ..." if len(skipped) > 10 else "") + ")")
+    print("Retiring " + str(len(stale)) + " trains...")
+    for ids, last_generation in ((reopened, None), (stale, base)):
+        for i in range(0, len(ids), INSERT_BATCH_SIZE):
+            Train.objects.filter(id__in=ids[i:i + INSERT_BATCH_SIZE]) \
+                .update(last_generation=last_generation)
+    return OrderedDict([
+        ('inserted', inserted),
+        ('unchanged', len(wanted) - inserted),
+        ('retired', len(stale)),
+        ('skipped', len(skipped))])
+
+
+def _known_trips(trips, traintype_ids, coords, skipped):
+    """Parcourir les voyages dont le type de train fait partie du
+    dictionnaire traintype_ids et dont toutes les gares font partie du
+    dictionnaire coords. Le numéro de train des autres voyages est ajouté à
+    la liste skipped."""
     for trip in trips:
-        stop_times_file.seek(1)
-        trip_stop_times = [s for s in stop_times if s[0] == trip[2]]
-        if int(trip[1]) in period_ids:
-            p = int(trip[1])
+        if trip[3] in traintype_ids and all(
+                [stop[0] in coords for stop in trip[4]]):
+            yield trip
         else:
-            p = None
-        t = Train(
-            number=int(trip[3]), capacity=3, traintype=TrainType.objects.get(
-                name=tt_regex.sub('\\1', trip_stop_times[0][3])))
-        t.period_id = p
-        t.save()
-        for stop_time in trip_stop_times:
-            ar_time = stop_time[1].split(':', 2)
-            ar_sec = time(hour=int(ar_time[0]) % 24, minute=int(ar_time[1]))
-            dep_time = stop_time[2].split(':', 2)
-            dep_sec = time(hour=int(dep_time[0]) % 24, minute=int(dep_time[1]))
-            h = Halt(arrival=ar_sec, departure=dep_sec, sequence=stop_time[4])
-            h.station_id = int(station_id_regex.sub('\\1', stop_time[3]))
-            h.train_id = t.id
-            halts.append(h)
-    print("Writing halts to database...")
-    [h.save() for h in halts]
+            skipped.append(trip[1])
+
+
+def _new_trips(trips, existing, wanted):
+    """Parcourir les voyages à insérer : ceux dont l'empreinte ne fait pas
+    partie du dictionnaire existing. Seule la première occurrence de chaque
+    empreinte est retenue ; les empreintes rencontrées sont ajoutées à
+    l'ensemble wanted."""
+    for trip in trips:
+        if trip[0] in wanted:
+            continue
+        wanted.add(trip[0])
+        if trip[0] not in existing:
+            yield trip
+
+
+def discard_trains(base, generation):
+    """Écarter les trains introduits par les générations comprises entre la
+    génération base et la génération generation, c'est-à-dire par des
+    importations ayant échoué ou abandonnées par un retour en arrière.
+    Ces trains ne font partie d'aucune génération utilisable."""
+    train_ids = list(Train.objects.filter(
+        first_generation__gt=base, first_generation__lt=generation)
+        .exclude(last_generation__lt=F('first_generation'))
+        .values_list('id', flat=True))
+    if train_ids:
+        print("Discarding " + str(len(train_ids)) + " trains...")
+        # Une dernière génération antérieure à la première rend les trains
+        # ayant des billets invisibles dans toutes les générations
+        booked = delete_trains(train_ids)
+        Train.objects.filter(id__in=booked).update(last_generation=base)
+
+
+def delete_trains(train_ids):
+    """Supprimer des trains avec leurs arrêts, par lots. Les trains ayant des
+    billets sont conservés.
+    Renvoie la liste des trains conservés."""
+    kept = []
+    for i in range(0, len(train_ids), INSERT_BATCH_SIZE):
+        batch = train_ids[i:i + INSERT_BATCH_SIZE]
+        with transaction.atomic():
+            booked = set(Ticket.objects.filter(
+                start_halt__train_id__in=batch).values_list(
+                'start_halt__train_id', flat=True))
+            Train.objects.filter(id__in=batch).exclude(id__in=booked).delete()
+        kept.extend(booked)
+    return kept
+
+
+def validate_generation(generation, base):
+    """Vérifier une génération des horaires avant son activation : elle doit
+    contenir des trains et des jours de service, et au moins
+    MIN_TRAIN_RATIO fois le nombre de trains de la génération base.
+    Lève ValueError si la vérification échoue, renvoie sinon le nombre de
+    trains de la génération."""
+    trains = Train.objects.filter(Train.in_generation(generation)).count()
+    previous = Train.objects.filter(Train.in_generation(base)).count() \
+        if base else 0
+    if not trains or not ServiceDay.objects.filter(
+            generation_id=generation).exists():
+        raise ValueError("Génération " + str(generation) + " vide")
+    if trains < MIN_TRAIN_RATIO * previous:
+        raise ValueError(
+            "Génération " + str(generation) + " : " + str(trains) +
+            " trains contre " + str(previous) + " dans la génération active")
+    return trains
+
+
+def purge_generations():
+    """Supprimer les données des générations qui ne sont ni active ni en
+    réserve : leurs jours de service et les trains qui n'appartiennent
+    qu'à elles. Les trains ayant des billets sont conservés.
+    Renvoie le nombre de trains supprimés."""
+    keep = TimetableGeneration.standby() or TimetableGeneration.current()
+    ServiceDay.objects.exclude(generation__status__in=[
+        TimetableGeneration.ACTIVE, TimetableGeneration.STANDBY]).delete()
+    train_ids = list(Train.objects.filter(last_generation__lt=keep).exclude(
+        id__in=Ticket.objects.values('start_halt__train_id'))
+        .values_list('id', flat=True))
+    print("Purging " + str(len(train_ids)) + " trains...")
+    delete_trains(train_ids)
+    return len(train_ids)
+
+
+def backfill_fingerprints():
+    """Calculer l'empreinte des trains importés avant l'introduction des
+    empreintes, à partir de leurs arrêts. Sans effet lorsque tous les trains
+    ont une empreinte."""
+    trains = {train_id: (number, period_id, traintype, [])
+              for train_id, number, period_id, traintype
+              in Train.objects.filter(fingerprint__isnull=True).values_list(
+                  'id', 'number', 'period_id', 'traintype__name')}
+    if not trains:
+        return
+    print("Computing fingerprints of " + str(len(trains)) + " trains...")
+    for train_id, station_id, arrival, departure, sequence in \
+            Halt.objects.filter(train__fingerprint__isnull=True).order_by(
+                'train_id', 'sequence').values_list(
+                'train_id', 'station_id', 'arrival_s', 'departure_s',
+                'sequence'):
+        trains[train_id][3].append((station_id, arrival, departure, sequence))
+    with transaction.atomic():
+        for train_id, train in trains.items():
+            Train.objects.filter(id=train_id).update(
+                fingerprint=trip_fingerprint(*train))
+
+
+def write_trains(trains, halts, coords):
+    """Calculer les distances cumulées d'un lot d'arrêts, puis écrire les
+    trains et leurs arrêts dans la base de données, dans une seule
+    transaction."""
+    print("Writing " + str(len(trains)) + " trains and " + str(len(halts)) +
+          " halts to database...")
+    compute_halt_distances(halts, coords)
+    with transaction.atomic():
+        bulk_insert(Train, trains)
+        bulk_insert(Halt, halts)
+
+
+def compute_halt_distances(halts, coords):
+    """Calculer la distance cumulée de chaque arrêt depuis le premier arrêt
+    de son train. Les arrêts sont triés par train puis par numéro de
+    séquence, et les distances entre arrêts successifs sont calculées en un
+    seul appel vectorisé. coords associe à chaque identifiant de gare un
+    tuple (latitude, longitude)."""
+    halts = sorted(halts, key=lambda h: (h.train_id, int(h.sequence)))
+    if not halts:
+        return
+    points = np.array([coords[h.station_id] for h in halts], dtype=float)
+    trains = np.array([h.train_id for h in halts])
+    steps = np.zeros(len(halts))
+    steps[1:] = haversine_array(points[:-1, 1], points[:-1, 0],
+                                points[1:, 1], points[1:, 0])
+    # Le premier arrêt de chaque train repart de zéro
+    first = np.ones(len(halts), dtype=bool)
+    first[1:] = trains[1:] != trains[:-1]
+    steps[first] = 0.0
+    totals = np.cumsum(steps)
+    starts = np.maximum.accumulate(
+        np.where(first, np.arange(len(halts)), 0))
+    for h, distance in zip(halts, (totals - totals[starts]).tolist()):
+        h.distance = distance
+
+
+def build_service_days(generation):
+    """Calculer la table des jours de service (ServiceDay) d'une génération
+    des horaires à partir des périodes de service et de leurs exceptions.
+    Renvoie le nombre de jours de service écrits."""
+    days = [ServiceDay(generation_id=generation, period_id=p.id, date=d)
+            for p in Period.objects.prefetch_related('periodexception_set')
+            for d in p.service_dates()]
+    with transaction.atomic():
+        ServiceDay.objects.filter(generation_id=generation).delete()
+        ServiceDay.objects.bulk_create(
+            days, batch_size=bulk_batch_size(ServiceDay, days, 1000))
+    return len(days)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Importations GTFS en tâche de fond.
+Les archives envoyées depuis l'interface d'administration sont enregistrées
+dans le dossier GTFS_IMPORT_UPLOAD_DIR, puis l'importation est mise en file
+d'attente sous la forme d'un objet ImportRun. La commande runimports exécute
+les importations en attente une par une ; leur avancement est enregistré au
+fil des étapes mesurées par le module telemetry, et une importation peut être
+annulée tant que sa nouvelle génération des horaires n'est pas activée.
+Une seule importation s'exécute à la fois, quelle que soit la commande qui
+la lance (runimports ou autoimport) : chacune doit détenir le verrou des
+importations, obtenu avec import_lock().
+"""
+
+import fcntl
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from . import telemetry
+from .gtfs_parser import parse_gtfs_sncf, ARCHIVE_STAGES, IMPORT_STAGES
+from .models import ImportRun
+
+## Intervalle minimal entre deux enregistrements de l'avancement d'une
+#  importation, en secondes.
+PROGRESS_INTERVAL = 1.0
+## Étapes pendant lesquelles une importation ne peut plus être annulée, la
+#  nouvelle génération des horaires étant activée.
+_COMMITTED_STAGES = IMPORT_STAGES[IMPORT_STAGES.index('activate'):]
+
+
+class ImportBusy(Exception):
+    """
+    Exception levée lorsque le verrou des importations est détenu par un
+    autre processus.
+    """
+
+
+def upload_dir():
+    """Obtenir le dossier des archives en attente d'importation."""
+    return getattr(settings, 'GTFS_IMPORT_UPLOAD_DIR', tempfile.gettempdir())
+
+
+@contextmanager
+def import_lock():
+    """Détenir le verrou des importations pendant un bloc with.
+    Le verrou est posé avec flock sur le fichier import.lock du dossier
+    GTFS_IMPORT_UPLOAD_DIR, partagé par tous les processus ; le système le
+    libère si le processus qui le détient s'arrête brutalement.
+    Lève ImportBusy si une autre importation détient le verrou."""
+    os.makedirs(upload_dir(), exist_ok=True)
+    with open(os.path.join(upload_dir(), 'import.lock'), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ImportBusy("Une autre importation GTFS est en cours.")
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def owner():
+    """Obtenir l'identifiant du processus courant (machine et numéro de
+    processus), enregistré dans les importations qu'il exécute."""
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+def archive_paths(names):
+    """Créer le dossier propre à une nouvelle importation, puis obtenir les
+    chemins d'accès où enregistrer ses archives. Chaque archive a son propre
+    sous-dossier : deux archives de même nom ne peuvent pas s'écraser."""
+    os.makedirs(upload_dir(), exist_ok=True)
+    directory = tempfile.mkdtemp(prefix='gtfs-', dir=upload_dir())
+    paths = []
+    for i, name in enumerate(names):
+        os.mkdir(os.path.join(directory, str(i)))
+        paths.append(os.path.join(directory, str(i), os.path.basename(name)))
+    return paths
+
+
+def enqueue_paths(paths, rebuild=False):
+    """Mettre en file d'attente l'importation d'archives GTFS enregistrées aux
+    chemins obtenus avec archive_paths(). Renvoie l'objet ImportRun créé."""
+    return ImportRun.objects.create(
+        paths="\n".join(paths), rebuild=rebuild,
+        sources="\n".join([os.path.basename(path) for path in paths]))
+
+
+def enqueue(files, rebuild=False):
+    """Enregistrer des archives GTFS envoyées par formulaire dans un dossier
+    propre à l'importation, puis mettre celle-ci en file d'attente.
+    Renvoie l'objet ImportRun créé."""
+    paths = archive_paths([f.name for f in files])
+    for f, path in zip(files, paths):
+        with open(path, 'wb') as destination:
+            for chunk in f.chunks():
+                destination.write(chunk)
+    return enqueue_paths(paths, rebuild)
+
+
+def remove_archives(paths):
+    """Supprimer le dossier d'une importation et ses archives, enregistrées
+    aux chemins obtenus avec archive_paths()."""
+    if paths:
+        shutil.rmtree(os.path.dirname(os.path.dirname(paths[0])),
+                      ignore_errors=True)
+
+
+def cancel(run_id):
+    """Demander l'annulation d'une importation. Une importation en attente
+    est annulée immédiatement ; une importation en cours l'est à sa
+    prochaine étape, si sa nouvelle génération n'est pas encore activée.
+    Renvoie False si l'importation est déjà terminée."""
+    if ImportRun.objects.filter(id=run_id, status=ImportRun.QUEUED).update(
+            status=ImportRun.CANCELLED, cancel_requested=True,
+            finished=timezone.now()):
+        remove_archives(ImportRun.objects.get(id=run_id).paths.splitlines())
+        return True
+    return bool(ImportRun.objects.filter(
+        id=run_id, status=ImportRun.RUNNING).update(cancel_requested=True))
+
+
+def claim(run_id):
+    """Réserver une importation en attente pour le processus courant.
+    Renvoie l'objet ImportRun réservé, ou None si l'importation n'est plus
+    en attente."""
+    # La mise à jour conditionnelle empêche deux exécuteurs de réserver la
+    # même importation
+    if ImportRun.objects.filter(id=run_id, status=ImportRun.QUEUED).update(
+            status=ImportRun.RUNNING, worker=owner(),
+            heartbeat=timezone.now()):
+        return ImportRun.objects.get(id=run_id)
+    return None
+
+
+def claim_next():
+    """Réserver la plus ancienne importation en attente.
+    Renvoie l'objet ImportRun réservé, ou None s'il n'y en a pas."""
+    for run_id in ImportRun.objects.filter(status=ImportRun.QUEUED) \
+            .order_by('id').values_list('id', flat=True):
+        run = claim(run_id)
+        if run is not None:
+            return run
+    return None
+
+
+def _process_exists(pid):
+    """Déterminer si un processus de la machine courante existe encore."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def recover_interrupted():
+    """Marquer comme échouées les importations restées en cours alors que
+    le processus qui les exécutait n'existe plus, après son arrêt brutal.
+    Pour une importation exécutée sur une autre machine, seul l'avancement
+    est connu : elle est considérée comme interrompue s'il n'a pas été
+    enregistré depuis GTFS_IMPORT_STALE_AFTER secondes.
+    À appeler en détenant le verrou des importations. Renvoie leur nombre."""
+    host = socket.gethostname()
+    stale = timezone.now() - timedelta(
+        seconds=getattr(settings, 'GTFS_IMPORT_STALE_AFTER', 3600))
+    interrupted = []
+    for run_id, worker, heartbeat in ImportRun.objects.filter(
+            status=ImportRun.RUNNING).values_list('id', 'worker', 'heartbeat'):
+        worker_host, _, pid = worker.rpartition(':')
+        if worker_host == host and pid.isdigit():
+            if not _process_exists(int(pid)):
+                interrupted.append(run_id)
+        elif heartbeat is None or heartbeat < stale:
+            interrupted.append(run_id)
+    return ImportRun.objects.filter(
+        id__in=interrupted, status=ImportRun.RUNNING).update(
+            status=ImportRun.FAILED, finished=timezone.now(),
+            error="Importation interrompue")
+
+
+class JobProgress(object):
+    """
+    Fonction de suivi d'une importation, appelée par le module telemetry à
+    chaque avancement d'une étape. L'avancement est enregistré au plus une
+    fois par PROGRESS_INTERVAL secondes, et à la fin de chaque étape, avec la
+    date de dernière activité (voir recover_interrupted()) ; une demande
+    d'annulation est alors prise en compte en levant telemetry.Cancelled.
+    """
+
+    def __init__(self, run):
+        """Préparer le suivi d'une importation."""
+        ## Importation suivie.
+        self.run = run
+        ## Nombre d'étapes de l'importation.
+        self.total = len(IMPORT_STAGES) + \
+            len(ARCHIVE_STAGES) * len(run.paths.splitlines())
+        ## Nombre d'étapes terminées.
+        self.done = 0
+        ## Date du dernier enregistrement de l'avancement.
+        self.saved = 0.0
+
+    def __call__(self, stage, rows, finished):
+        """Enregistrer l'avancement d'une étape et vérifier si l'annulation
+        de l'importation a été demandée."""
+        if finished:
+            self.done += 1
+        elif time.monotonic() - self.saved < PROGRESS_INTERVAL:
+            return
+        self.saved = time.monotonic()
+        runs = ImportRun.objects.filter(id=self.run.id)
+        runs.update(stage=stage, rows=rows, heartbeat=timezone.now(),
+                    percent=min(100.0, 100.0 * self.done / self.total))
+        if stage not in _COMMITTED_STAGES and \
+                runs.filter(cancel_requested=True).exists():
+            raise telemetry.Cancelled("Importation annulée")
+
+
+def run_job(run):
+    """Exécuter une importation réservée par claim() ou claim_next(), puis
+    supprimer ses archives. Le verrou des importations doit être détenu.
+    Renvoie l'objet ImportRun à jour."""
+    paths = run.paths.splitlines()
+    telemetry.listen(JobProgress(run))
+    try:
+        parse_gtfs_sncf(*paths, rebuild=run.rebuild, run=run)
+    except telemetry.Cancelled:
+        pass
+    except Exception:
+        # L'erreur est enregistrée par parse_gtfs_sncf()
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        telemetry.listen(None)
+        remove_archives(paths)
+    if run.status == ImportRun.SUCCEEDED:
+        ImportRun.objects.filter(id=run.id).update(percent=100.0, stage='')
+    run.refresh_from_db()
+    return run
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Base commune des commandes de nettoyage.
+Les objets à supprimer sont sélectionnés par une seule requête ensembliste
+(en général une anti-jointure NOT EXISTS), puis supprimés par lots, chaque
+lot dans sa propre transaction, ce qui borne la durée des verrous et permet
+de lancer un nettoyage pendant la journée.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+
+class CleanCommand(BaseCommand):
+    """
+    Commande de nettoyage. Les sous-classes définissent queryset(), ainsi
+    que les noms affichés dans le compte rendu.
+    """
+    ## Nombre d'objets supprimés par défaut dans chaque transaction.
+    BATCH_SIZE = 1000
+    ## Nom du nettoyage, pour le compte rendu (par exemple « des gares »).
+    label = ""
+    ## Nom des objets supprimés au pluriel, pour le compte rendu.
+    plural = ""
+    ## Participe passé accordé avec plural (« supprimés » ou « supprimées »).
+    deleted = "supprimés"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Compter les objets à supprimer sans rien supprimer")
+        parser.add_argument(
+            '--batch-size', type=int, default=self.BATCH_SIZE,
+            help="Nombre d'objets supprimés dans chaque transaction")
+
+    def queryset(self):
+        """Obtenir le QuerySet des objets à supprimer."""
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        queryset = self.queryset()
+        if options['dry_run']:
+            self.stdout.write(
+                'Nettoyage ' + self.label + ' : ' + str(queryset.count()) +
+                ' ' + self.plural + ' seraient ' + self.deleted + '.')
+            return
+        deleted = self.delete(queryset, max(1, options['batch_size']))
+        self.stdout.write(self.style.SUCCESS(
+            'Nettoyage ' + self.label + ' effectué. ' + str(deleted) + ' ' +
+            self.plural + ' ' + self.deleted + '.'))
+
+    def delete(self, queryset, batch_size):
+        """Supprimer les objets d'un QuerySet par lots de batch_size objets.
+        Les lots sont parcourus par identifiant croissant : chaque lot ne
+        relit que la suite de la sélection, et un objet qui ne peut pas être
+        supprimé n'est pas relu indéfiniment.
+        Renvoie le nombre d'objets supprimés, sans compter les suppressions
+        en cascade."""
+        deleted = 0
+        last = None
+        while True:
+            batch = queryset.order_by('pk')
+            if last is not None:
+                batch = batch.filter(pk__gt=last)
+            ids = list(batch.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            with transaction.atomic():
+                # Les objets sont sélectionnés à nouveau dans la transaction,
+                # au cas où ils auraient été utilisés entre-temps
+                deleted += queryset.filter(pk__in=ids).delete()[1].get(
+                    queryset.model._meta.label, 0)
+            last = ids[-1]
@@ -4,9 +4,17 @@ Commande d'importation automatique GTFS.
 Les dernières données Open Data SNCF pour les horaires TER et Intercités sont
 téléchargées automatiquement et l'importation GTFS s'enclenche immédiatement.
 Destiné à un usage en CRON, une fois par mois.
+L'importation passe par la file d'attente des importations (voir le module
+jobs) et s'exécute en détenant leur verrou : la commande échoue si une autre
+importation est en cours.
+Avec l'option --json, le compte rendu de l'importation (différences écrites
+et mesures de chaque étape) est écrit au format JSON sur la sortie standard,
+même si l'importation échoue.
 """
-from django.core.management.base import BaseCommand
-from main.gtfs_parser import parse_gtfs_sncf
+from django.core.management.base import BaseCommand, CommandError
+from main import jobs
+import contextlib
+import sys
 import urllib.request
 import json
 
@@ -25,11 +33,41 @@ def get_file_url(dataset):
 class Command(BaseCommand):
     help = 'Importation automatique GTFS depuis les données ouvertes SNCF'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--json', action='store_true',
+            help="Écrire le compte rendu de l'importation au format JSON")
+
     def handle(self, *args, **options):
         DATASETS = ['sncf-ter-gtfs', 'sncf-intercites-gtfs']
-        [urllib.request.urlretrieve(
-            get_file_url(dataset), '/tmp/' + dataset + '.zip')
-            for dataset in DATASETS]
-        parse_gtfs_sncf(*['/tmp/' + dataset + '.zip' for dataset in DATASETS])
-        self.stdout.write(self.style.SUCCESS(
-            'Importation automatique GTFS effectuée.'))
+        try:
+            with jobs.import_lock():
+                jobs.recover_interrupted()
+                paths = jobs.archive_paths(
+                    [dataset + '.zip' for dataset in DATASETS])
+                try:
+                    for dataset, path in zip(DATASETS, paths):
+                        urllib.request.urlretrieve(get_file_url(dataset),
+                                                   path)
+                except BaseException:
+                    # Archives déjà téléchargées, en totalité ou en partie
+                    jobs.remove_archives(paths)
+                    raise
+                run = jobs.claim(jobs.enqueue_paths(paths).id)
+                if not options['json']:
+                    run = jobs.run_job(run)
+                else:
+                    # Les messages de progression ne doivent pas se mêler
+                    # au JSON
+                    with contextlib.redirect_stdout(sys.stderr):
+                        run = jobs.run_job(run)
+                    self.stdout.write(json.dumps(run.report(), indent=2))
+        except jobs.ImportBusy as e:
+            raise CommandError(str(e))
+        if run.status != run.SUCCEEDED:
+            raise CommandError(
+                'Importation automatique GTFS ' + str(run.id) + ' : ' +
+                run.get_status_display() + '. ' + run.error)
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS(
+                'Importation automatique GTFS effectuée.'))
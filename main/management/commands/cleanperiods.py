@@ -4,17 +4,18 @@ Commande de nettoyage des périodes de service.
 Les périodes de service et exceptions de période de service sont supprimées
 si aucun train n'utilise cette période de service.
 """
-from django.core.management.base import BaseCommand
-from main.models import Period
+from django.db.models import Exists, OuterRef
+from main.management.cleaning import CleanCommand
+from main.models import Period, Train
 
 
-class Command(BaseCommand):
+class Command(CleanCommand):
     help = 'Nettoyage automatique des périodes de service inutilisées'
+    label = 'des périodes de service'
+    plural = 'périodes'
+    deleted = 'supprimées'
 
-    def handle(self, *args, **options):
-        oldcount = Period.objects.count()
-        [p.delete() for p in Period.objects.all() if p.train_set.count() == 0]
-        newcount = Period.objects.count()
-        self.stdout.write(self.style.SUCCESS(
-            'Nettoyage des périodes de service effectué. ' +
-            str(oldcount - newcount) + ' périodes supprimées.'))
+    def queryset(self):
+        return Period.objects.annotate(used=Exists(
+            Train.objects.filter(period_id=OuterRef('pk')))).filter(
+            used=False)
@@ -2,26 +2,41 @@
 """
 Commande de nettoyage des résultats de recherche.
 Les résultats de recherche sont traduits sous la forme de voyages non réservés.
-Les voyages non réservés sont supprimés.
+Les voyages non réservés sont supprimés ; avec l'option --expired, seuls ceux
+créés il y a plus de SEARCH_RESULT_TTL secondes le sont, ce qui épargne les
+paniers en cours.
 """
-from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from main.management.cleaning import CleanCommand
 from main.models import Travel
 
 
-class Command(BaseCommand):
-    help = 'Nettoyage automatique des périodes de service inutilisées'
+class Command(CleanCommand):
+    help = 'Nettoyage automatique des voyages non réservés'
+    label = 'des voyages non réservés'
+    plural = 'voyages'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--expired', action='store_true',
+            help="Ne supprimer que les voyages non réservés expirés")
+
+    def queryset(self):
+        if self.expired_only:
+            return Travel.objects.expired()
+        return Travel.objects.filter(booked=False)
 
     def handle(self, *args, **options):
-        oldcount = Travel.objects.count()
-        for t in Travel.objects.all():
-            if not t.booked:
-                t.delete()
-            elif t.passengers_aboard.count() < 1:
-                self.stderr.write(self.style.WARNING(
-                    "Le voyage ayant l'ID " + t.id +
-                    " est marqué comme réservé, "
-                    "mais n'a pas de passager associé."))
-        newcount = Travel.objects.count()
-        self.stdout.write(self.style.SUCCESS(
-            'Nettoyage des voyages non réservés effectués. ' +
-            str(oldcount - newcount) + ' voyages supprimés.'))
+        ## Suppression limitée aux voyages non réservés expirés.
+        self.expired_only = options['expired']
+        # Les voyages réservés sans passager sont signalés, en une requête
+        for travel_id in Travel.objects.filter(booked=True).annotate(
+                aboard=Exists(Travel.passengers_aboard.through.objects.filter(
+                    travel_id=OuterRef('pk')))).filter(
+                aboard=False).values_list('id', flat=True):
+            self.stderr.write(self.style.WARNING(
+                "Le voyage ayant l'ID " + str(travel_id) +
+                " est marqué comme réservé, "
+                "mais n'a pas de passager associé."))
+        super().handle(*args, **options)
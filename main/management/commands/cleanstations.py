@@ -3,17 +3,18 @@
 Commande de nettoyage des stations.
 Les stations sont supprimées si elles n'ont aucun train s'y arrêtant.
 """
-from django.core.management.base import BaseCommand
-from main.models import Station
+from django.db.models import Exists, OuterRef
+from main.management.cleaning import CleanCommand
+from main.models import Station, Halt
 
 
-class Command(BaseCommand):
+class Command(CleanCommand):
     help = 'Nettoyage automatique des stations inutilisées'
+    label = 'des stations'
+    plural = 'stations'
+    deleted = 'supprimées'
 
-    def handle(self, *args, **options):
-        oldcount = Station.objects.count()
-        [s.delete() for s in Station.objects.all() if s.halt_set.count() == 0]
-        newcount = Station.objects.count()
-        self.stdout.write(self.style.SUCCESS(
-            'Nettoyage des stations effectué. ' +
-            str(oldcount - newcount) + ' stations supprimées.'))
+    def queryset(self):
+        return Station.objects.annotate(used=Exists(
+            Halt.objects.filter(station_id=OuterRef('pk')))).filter(
+            used=False)
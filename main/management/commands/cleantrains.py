@@ -4,22 +4,22 @@ Commande de nettoyage des trains.
 Les trains sont supprimés s'ils ne sont plus en circulation et qu'ils n'ont
 pas eu de réservations.
 """
-from django.core.management.base import BaseCommand
-from main.models import Train
+from django.db.models import Exists, OuterRef
+from main.management.cleaning import CleanCommand
+from main.models import Train, Ticket
 from datetime import datetime
 
 
-class Command(BaseCommand):
+class Command(CleanCommand):
     help = 'Nettoyage automatique des trains sans réservations'
+    label = 'des trains'
+    plural = 'trains'
 
-    def handle(self, *args, **options):
-        oldcount = Train.objects.count()
-        [t.delete() for t in Train.objects.all()
-         if t.period and datetime.now().date() > t.period.end_date and
-         True not in [h.ticket_start_set.count() > 0
-                      or h.ticket_end_set.count() > 0
-                      for h in t.halt_set.all()]]
-        newcount = Train.objects.count()
-        self.stdout.write(self.style.SUCCESS(
-            'Nettoyage des trains effectué. ' +
-            str(oldcount - newcount) + ' trains supprimés.'))
+    def queryset(self):
+        return Train.objects.filter(
+            period__end_date__lt=datetime.now().date()).annotate(
+            booked_start=Exists(Ticket.objects.filter(
+                start_halt__train_id=OuterRef('pk'))),
+            booked_end=Exists(Ticket.objects.filter(
+                end_halt__train_id=OuterRef('pk')))).filter(
+            booked_start=False, booked_end=False)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Commande de retour à la génération précédente des horaires.
+La génération active est abandonnée et la génération conservée en réserve par
+la dernière importation GTFS redevient immédiatement celle des recherches.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from main.models import TimetableGeneration
+from main.timetable import invalidate as invalidate_timetable
+from main.spatial import invalidate as invalidate_station_index
+from main.autocomplete import invalidate as invalidate_station_names
+from main.artifacts import build_artifacts
+
+
+class Command(BaseCommand):
+    help = 'Retour à la génération précédente des horaires'
+
+    def handle(self, *args, **options):
+        generation = TimetableGeneration.rollback()
+        if generation is None:
+            raise CommandError("Aucune génération des horaires en réserve.")
+        invalidate_timetable()
+        invalidate_station_index()
+        invalidate_station_names()
+        build_artifacts()
+        self.stdout.write(self.style.SUCCESS(
+            'Génération ' + str(generation) + ' des horaires réactivée.'))
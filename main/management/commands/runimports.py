@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Commande d'exécution des importations GTFS en tâche de fond.
+Les importations mises en file d'attente depuis l'interface d'administration
+sont exécutées une par une. Destiné à tourner en permanence, par exemple
+sous systemd ; avec l'option --once, la commande s'arrête lorsque la file
+d'attente est vide, ce qui permet aussi un usage en CRON.
+Plusieurs exécuteurs peuvent être lancés : chaque importation est exécutée
+en détenant le verrou des importations, et un exécuteur qui ne peut pas
+l'obtenir attend que l'importation en cours se termine (ou s'arrête, avec
+l'option --once).
+"""
+from django.core.management.base import BaseCommand
+from main import jobs
+import time
+
+
+class Command(BaseCommand):
+    help = 'Exécution des importations GTFS en attente'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help="S'arrêter lorsqu'il n'y a plus d'importation en attente")
+        parser.add_argument(
+            '--interval', type=float, default=5.0,
+            help="Intervalle entre deux consultations de la file d'attente, "
+                 "en secondes")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                with jobs.import_lock():
+                    run = self.run_next()
+            except jobs.ImportBusy as e:
+                if options['once']:
+                    self.stderr.write(self.style.WARNING(str(e)))
+                    break
+                run = None
+            if run is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+
+    def run_next(self):
+        """Exécuter la plus ancienne importation en attente, en détenant le
+        verrou des importations. Renvoie l'importation exécutée, ou None
+        s'il n'y en a pas."""
+        interrupted = jobs.recover_interrupted()
+        if interrupted:
+            self.stderr.write(self.style.WARNING(
+                str(interrupted) + ' importations interrompues.'))
+        run = jobs.claim_next()
+        if run is None:
+            return None
+        run = jobs.run_job(run)
+        message = 'Importation ' + str(run.id) + ' : ' + \
+            run.get_status_display() + '.'
+        if run.status == run.SUCCEEDED:
+            self.stdout.write(self.style.SUCCESS(message))
+        else:
+            self.stderr.write(self.style.ERROR(message))
+        return run
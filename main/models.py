@@ -4,11 +4,17 @@ Modèles de l'application.
 """
 
 from __future__ import unicode_literals
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.auth.models import User
-from .utility import haversine
-from datetime import date
+from django.utils import timezone
+from .utility import haversine, seconds_to_time, fares
+from datetime import date, timedelta
+from time import monotonic
+import json
 
 
 class Passenger(models.Model):
@@ -81,10 +87,31 @@ class Halt(models.Model):
     et le numéro de séquence de l'arrêt (ordre dans lequel le train passe),
     ainsi que le train et la gare concernés.
     """
-    ## Heure d'arrivée du train en gare.
-    arrival = models.TimeField(verbose_name="Heure d'arrivée en gare")
-    ## Heure de départ du train depuis la gare.
-    departure = models.TimeField(verbose_name="Heure de départ")
+    ## Heure d'arrivée du train en gare, pour l'affichage.
+    #  Calculée à partir de arrival_s lors de l'enregistrement.
+    arrival = models.TimeField(
+        editable=False, verbose_name="Heure d'arrivée en gare")
+    ## Heure de départ du train depuis la gare, pour l'affichage.
+    #  Calculée à partir de departure_s lors de l'enregistrement.
+    departure = models.TimeField(
+        editable=False, verbose_name="Heure de départ")
+    ## Heure d'arrivée du train en gare, en secondes depuis le début du jour
+    #  de service. Comme dans GTFS, elle peut dépasser 24 heures pour les
+    #  trains de nuit. Les arrêts enregistrés avant l'ajout de ce champ sont
+    #  complétés après la migration (voir main.upgrade).
+    arrival_s = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Arrivée (secondes depuis le début du service)")
+    ## Heure de départ du train depuis la gare, en secondes depuis le début
+    #  du jour de service.
+    departure_s = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Départ (secondes depuis le début du service)")
+    ## Distance parcourue par le train depuis son premier arrêt, en
+    #  kilomètres, en passant par tous les arrêts précédents.
+    #  Calculée lors de l'importation GTFS ; vaut None si elle est inconnue.
+    distance = models.FloatField(
+        null=True, blank=True, verbose_name="Distance depuis le départ (km)")
     ## Numéro de séquence de l'arrêt. Base 0.
     #  Permet d'ordonner les arrêts pour un train.
     sequence = models.PositiveSmallIntegerField(verbose_name="Numéro d'ordre")
@@ -109,6 +136,19 @@ class Halt(models.Model):
         verbose_name = "arrêt d'un train en gare"
         ## Nom affiché au pluriel dans l'administration de Django.
         verbose_name_plural = "arrêts des trains en gares"
+        ## Index composites permettant de rechercher les départs et les
+        #  arrivées d'une gare dans un intervalle de temps.
+        indexes = [
+            models.Index(fields=["station", "departure_s"]),
+            models.Index(fields=["station", "arrival_s"]),
+        ]
+
+    def save(self, *args, **kwargs):
+        """Enregistrer l'arrêt, en calculant les heures d'arrivée et de
+        départ affichées à partir des heures en secondes."""
+        self.arrival = seconds_to_time(self.arrival_s)
+        self.departure = seconds_to_time(self.departure_s)
+        super(Halt, self).save(*args, **kwargs)
 
     def __str__(self):
         """Représentation textuelle de l'arrêt"""
@@ -138,12 +178,46 @@ class Train(models.Model):
     #  tous les passagers.
     capacity = models.PositiveIntegerField(
         verbose_name="Capacité de passagers")
+    ## Empreinte du voyage GTFS (numéro, période, type de train et arrêts).
+    #  Permet à l'importation de ne réécrire que les trains modifiés.
+    fingerprint = models.CharField(
+        max_length=40, null=True, editable=False, db_index=True,
+        verbose_name="Empreinte")
+    ## Première génération des horaires contenant le train.
+    first_generation = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name="Première génération")
+    ## Dernière génération des horaires contenant le train, ou None si le
+    #  train fait toujours partie des horaires.
+    #  Un train retiré n'est plus proposé dans les recherches, mais il est
+    #  conservé tant que des billets l'utilisent.
+    last_generation = models.PositiveIntegerField(
+        null=True, editable=False, verbose_name="Dernière génération")
 
     class Meta:
         """Métadonnées du modèle de train."""
         ## Nom affiché dans l'interface d'administration de Django.
         verbose_name = "train"
 
+    @staticmethod
+    def in_generation(generation, prefix=''):
+        """Obtenir la condition (objet Q) sélectionnant les trains d'une
+        génération des horaires. prefix permet d'appliquer la condition depuis
+        un autre modèle, par exemple 'train__' pour les arrêts."""
+        return models.Q(**{prefix + 'first_generation__lte': generation}) & (
+            models.Q(**{prefix + 'last_generation__isnull': True}) |
+            models.Q(**{prefix + 'last_generation__gte': generation}))
+
+    @staticmethod
+    def runs_on(date, generation, prefix=''):
+        """Obtenir la condition (objet Q) sélectionnant les trains d'une
+        génération des horaires qui circulent à une date donnée, d'après les
+        jours de service de cette génération. prefix a le même rôle que pour
+        in_generation()."""
+        return Train.in_generation(generation, prefix) & (
+            models.Q(**{prefix + 'period__isnull': True}) |
+            models.Q(**{prefix + 'period__serviceday__generation': generation,
+                        prefix + 'period__serviceday__date': date}))
+
     def runs(self, date):
         """Déterminer si un train roule à une certaine date.
         Si les données de la SNCF sont mauvaises (et c'est le cas), et qu'il
@@ -153,16 +227,11 @@ class Train(models.Model):
             return True
         return self.period.includes_date(date)
 
-    def can_hold(self, start_halt, end_halt, passengers):
+    def can_hold(self, start_halt, end_halt, passengers, date):
         """Détermine si un train peut accepter d'embarquer un nombre donné de
-        passagers entre deux arrêts."""
-        return True not in [
-            sum([t.travel.passengers
-                 for t in h.ticket_start_set.all() if t.travel.booked]) +
-            passengers > self.capacity
-            for h in self.halt_set.filter(
-                sequence__gte=start_halt.sequence,
-                sequence__lte=end_halt.sequence)]
+        passagers entre deux arrêts, à une date donnée."""
+        return SeatOccupancy.can_hold(
+            [(start_halt, end_halt)], date, passengers)[0]
 
     def __str__(self):
         """Représentation textuelle du train pour l'affichage."""
@@ -239,13 +308,24 @@ class Period(models.Model):
     def includes_date(self, date):
         """Teste si une date fait partie de la période concernée.
         Quand une date fait partie d'une période, un train ayant cette période
-        roulera à cette date."""
-        if not self.start_date < date < self.end_date:
-            return False
-        ex = self.periodexception_set.filter(date=date)
-        if ex.exists():
-            return ex.add_day()
-        return self.week_tuple()[date.weekday()]
+        roulera à cette date. La réponse est lue dans les jours de service
+        (voir ServiceDay) de la génération active des horaires."""
+        return self.serviceday_set.filter(
+            date=date,
+            generation_id=TimetableGeneration.current_cached()).exists()
+
+    def service_dates(self):
+        """Calculer toutes les dates durant lesquelles les trains de cette
+        période circulent, en tenant compte des exceptions.
+        Les dates de début et de fin sont exclues."""
+        exceptions = {e.date: e.add_day
+                      for e in self.periodexception_set.all()}
+        week = self.week_tuple()
+        day = self.start_date + timedelta(days=1)
+        while day < self.end_date:
+            if exceptions.get(day, week[day.weekday()]):
+                yield day
+            day += timedelta(days=1)
 
     def __str__(self):
         """Représentation textuelle de la période pour l'affichage."""
@@ -297,6 +377,348 @@ class PeriodException(models.Model):
             ", le " + str(self.date)
 
 
+class ServiceDay(models.Model):
+    """
+    Décrit un jour de circulation d'une période de service.
+    Cette table est entièrement calculée à partir des périodes de service et
+    de leurs exceptions lors de chaque importation GTFS, pour la nouvelle
+    génération des horaires. Elle permet de filtrer les trains circulant à une
+    date donnée directement dans les requêtes SQL.
+    """
+    ## Génération des horaires à laquelle appartient le jour de service.
+    generation = models.ForeignKey(
+        'TimetableGeneration', on_delete=models.CASCADE,
+        verbose_name="Génération des horaires")
+    ## Date de circulation.
+    date = models.DateField()
+    ## Association avec une période de service.
+    #  Les jours de service sont supprimés avec leur période de service.
+    period = models.ForeignKey(
+        'Period', on_delete=models.CASCADE, verbose_name="Période associée")
+
+    class Meta:
+        """Métadonnées du modèle de jour de service."""
+        ## Index de type unique, utilisé pour retrouver les périodes
+        #  circulant à une date donnée dans une génération des horaires.
+        unique_together = ("generation", "date", "period")
+        ## Nom affiché dans l'interface d'administration de Django.
+        verbose_name = "jour de service"
+        ## Nom au pluriel affiché dans l'administration de Django.
+        verbose_name_plural = "jours de service"
+
+    def __str__(self):
+        """Représentation textuelle du jour de service pour affichage."""
+        return str(self.period) + ", le " + str(self.date)
+
+
+class SeatOccupancy(models.Model):
+    """
+    Décrit le nombre de places réservées dans un train, à une date donnée,
+    sur le tronçon commençant à un arrêt et finissant à l'arrêt suivant.
+    Ce registre est tenu à jour lors de la réservation d'un voyage et de sa
+    suppression, ce qui permet de vérifier la capacité d'un train avec une
+    seule lecture indexée.
+    """
+    ## Association avec un train.
+    train = models.ForeignKey(
+        'Train', on_delete=models.CASCADE, verbose_name="Train")
+    ## Date de circulation du train.
+    date = models.DateField()
+    ## Numéro de séquence de l'arrêt de début du tronçon.
+    sequence = models.PositiveSmallIntegerField(verbose_name="Numéro d'ordre")
+    ## Nombre de passagers ayant réservé ce tronçon.
+    passengers = models.PositiveIntegerField(
+        default=0, verbose_name="Passagers")
+
+    class Meta:
+        """Métadonnées du modèle d'occupation des places."""
+        ## Index de type unique, utilisé pour lire l'occupation d'un train
+        #  sur un intervalle de tronçons.
+        unique_together = ("train", "date", "sequence")
+        ## Nom affiché dans l'interface d'administration de Django.
+        verbose_name = "occupation des places"
+        ## Nom au pluriel affiché dans l'administration de Django.
+        verbose_name_plural = "occupations des places"
+
+    @classmethod
+    def can_hold(cls, legs, date, passengers):
+        """Déterminer, pour chaque couple (arrêt de départ, arrêt d'arrivée)
+        d'une liste, si le train concerné peut accepter un nombre donné de
+        passagers à une date donnée.
+        L'occupation de tous les trains est lue en une seule requête.
+        Renvoie une liste de booléens dans l'ordre des couples."""
+        taken = {}
+        for train_id, sequence, count in cls.objects.filter(
+                date=date, train_id__in={s.train_id for s, e in legs},
+                passengers__gt=0).values_list(
+                    'train_id', 'sequence', 'passengers'):
+            taken.setdefault(train_id, []).append((sequence, count))
+        return [max([count for sequence, count in taken.get(s.train_id, [])
+                     if s.sequence <= sequence < e.sequence] or [0]) +
+                passengers <= s.train.capacity
+                for s, e in legs]
+
+    @classmethod
+    def reserve(cls, ticket, date, passengers):
+        """Retenir des places pour un billet dans le registre.
+        Les lignes concernées sont verrouillées jusqu'à la fin de la
+        transaction. Renvoie False, sans rien modifier, si le train ne peut
+        pas accepter tous les passagers."""
+        train = ticket.start_halt.train
+        sequences = list(train.halt_set.filter(
+            sequence__gte=ticket.start_halt.sequence,
+            sequence__lt=ticket.end_halt.sequence)
+            .values_list('sequence', flat=True))
+        for sequence in sequences:
+            cls.objects.get_or_create(
+                train=train, date=date, sequence=sequence)
+        segments = cls.objects.select_for_update().filter(
+            train=train, date=date, sequence__in=sequences)
+        if any(s.passengers + passengers > train.capacity for s in segments):
+            return False
+        segments.update(passengers=F('passengers') + passengers)
+        return True
+
+    @classmethod
+    def release(cls, ticket, date, passengers):
+        """Libérer les places retenues pour un billet dans le registre."""
+        cls.objects.filter(
+            train_id=ticket.start_halt.train_id, date=date,
+            sequence__gte=ticket.start_halt.sequence,
+            sequence__lt=ticket.end_halt.sequence,
+            passengers__gte=passengers).update(
+                passengers=F('passengers') - passengers)
+
+    def __str__(self):
+        """Représentation textuelle de l'occupation pour affichage."""
+        return str(self.passengers) + " passagers dans le " + \
+            str(self.train) + " le " + str(self.date)
+
+
+class TimetableGeneration(models.Model):
+    """
+    Décrit une génération des horaires. Chaque importation GTFS écrit les
+    horaires dans une nouvelle génération, sans modifier ceux de la
+    génération active : les recherches continuent d'utiliser cette dernière
+    jusqu'à ce que la nouvelle génération, une fois vérifiée, soit activée.
+    La génération précédente est conservée en réserve pour pouvoir y revenir
+    immédiatement.
+    Le numéro de la génération active permet aussi d'invalider tout ce qui
+    est calculé à partir des horaires (moteur d'horaires en mémoire, cache des
+    résultats de recherche).
+    """
+    ## Génération en cours d'importation.
+    BUILDING = 'building'
+    ## Génération utilisée par les recherches.
+    ACTIVE = 'active'
+    ## Génération précédente, conservée pour revenir en arrière.
+    STANDBY = 'standby'
+    ## Génération dont l'importation a échoué ou dont la vérification n'a pas
+    #  réussi.
+    FAILED = 'failed'
+    ## Génération abandonnée, dont les données ont été ou seront supprimées.
+    DISCARDED = 'discarded'
+    ## États possibles d'une génération.
+    STATUSES = ((BUILDING, "En cours d'importation"), (ACTIVE, "Active"),
+                (STANDBY, "En réserve"), (FAILED, "Échouée"),
+                (DISCARDED, "Abandonnée"))
+
+    ## Date et heure de création de la génération.
+    created = models.DateTimeField(
+        auto_now_add=True, verbose_name="Date de création")
+    ## État de la génération. Une seule génération est active à la fois.
+    status = models.CharField(
+        max_length=10, choices=STATUSES, default=BUILDING, db_index=True,
+        verbose_name="État")
+
+    class Meta:
+        """Métadonnées du modèle de génération des horaires."""
+        ## Nom affiché dans l'interface d'administration de Django.
+        verbose_name = "génération des horaires"
+        ## Nom au pluriel affiché dans l'administration de Django.
+        verbose_name_plural = "générations des horaires"
+
+    @classmethod
+    def current(cls):
+        """Obtenir le numéro de la génération active des horaires, ou 0 si
+        aucune importation n'a été effectuée."""
+        return cls.objects.filter(status=cls.ACTIVE).aggregate(
+            models.Max('id'))['id__max'] or 0
+
+    @classmethod
+    def current_cached(cls):
+        """Obtenir le numéro de la génération active des horaires sans
+        interroger la base de données à chaque appel : le numéro est relu au
+        plus une fois toutes les TIMETABLE_GENERATION_TTL secondes dans chaque
+        processus, et immédiatement après une activation ou un retour en
+        arrière effectué par le processus."""
+        global _current_generation
+        number, read = _current_generation
+        if number is None or monotonic() - read >= getattr(
+                settings, 'TIMETABLE_GENERATION_TTL', 5):
+            _current_generation = (cls.current(), monotonic())
+        return _current_generation[0]
+
+    @classmethod
+    def standby(cls):
+        """Obtenir le numéro de la génération en réserve, ou None s'il n'y en
+        a pas."""
+        return cls.objects.filter(status=cls.STANDBY).aggregate(
+            models.Max('id'))['id__max']
+
+    def activate(self):
+        """Activer la génération, dans une seule transaction : la génération
+        active passe en réserve et l'ancienne génération en réserve est
+        abandonnée."""
+        with transaction.atomic():
+            TimetableGeneration.objects.filter(status=self.STANDBY).update(
+                status=self.DISCARDED)
+            TimetableGeneration.objects.filter(status=self.ACTIVE).update(
+                status=self.STANDBY)
+            self.status = self.ACTIVE
+            self.save(update_fields=['status'])
+        _forget_current_generation()
+
+    @classmethod
+    def rollback(cls):
+        """Revenir à la génération en réserve, dans une seule transaction. La
+        génération active est abandonnée.
+        Renvoie le numéro de la génération réactivée, ou None s'il n'y a pas
+        de génération en réserve."""
+        with transaction.atomic():
+            standby = cls.standby()
+            if standby is None:
+                return None
+            cls.objects.filter(status=cls.ACTIVE).update(
+                status=cls.DISCARDED)
+            cls.objects.filter(id=standby).update(status=cls.ACTIVE)
+        _forget_current_generation()
+        return standby
+
+    def __str__(self):
+        """Représentation textuelle de la génération pour affichage."""
+        return "Génération " + str(self.id) + " du " + str(self.created) + \
+            " (" + self.get_status_display() + ")"
+
+
+## Numéro de la génération active lu par TimetableGeneration.current_cached()
+#  et date de cette lecture, ou None si le numéro n'a pas encore été lu.
+_current_generation = (None, 0.0)
+
+
+def _forget_current_generation():
+    """Oublier le numéro de la génération active lu par le processus, pour
+    qu'il soit relu lors du prochain appel de
+    TimetableGeneration.current_cached()."""
+    global _current_generation
+    _current_generation = (None, 0.0)
+
+
+class ImportRun(models.Model):
+    """
+    Décrit une importation GTFS et ses mesures : durée totale, différences
+    écrites et mesures de chaque étape (voir le module telemetry).
+    Une importation peut aussi être une tâche mise en file d'attente depuis
+    l'interface d'administration et exécutée en tâche de fond (voir le
+    module jobs) ; son avancement est alors enregistré au fil des étapes.
+    """
+    ## Importation en attente d'exécution.
+    QUEUED = 'queued'
+    ## Importation en cours.
+    RUNNING = 'running'
+    ## Importation terminée avec succès.
+    SUCCEEDED = 'succeeded'
+    ## Importation ayant échoué.
+    FAILED = 'failed'
+    ## Importation annulée.
+    CANCELLED = 'cancelled'
+    ## États possibles d'une importation.
+    STATUSES = ((QUEUED, "En attente"), (RUNNING, "En cours"),
+                (SUCCEEDED, "Réussie"), (FAILED, "Échouée"),
+                (CANCELLED, "Annulée"))
+
+    ## Date et heure de création de l'importation.
+    started = models.DateTimeField(
+        auto_now_add=True, verbose_name="Date de début")
+    ## Date et heure de fin de l'importation.
+    finished = models.DateTimeField(null=True, verbose_name="Date de fin")
+    ## État de l'importation.
+    status = models.CharField(
+        max_length=10, choices=STATUSES, default=QUEUED, db_index=True,
+        verbose_name="État")
+    ## Archives GTFS importées, une par ligne.
+    sources = models.TextField(blank=True, verbose_name="Archives")
+    ## Chemins d'accès des archives d'une tâche, un par ligne.
+    paths = models.TextField(blank=True, editable=False)
+    ## Réécriture de tous les trains (voir gtfs_parser.parse_gtfs_sncf()).
+    rebuild = models.BooleanField(
+        default=False, verbose_name="Réimportation complète")
+    ## Processus exécutant l'importation (machine et numéro de processus).
+    worker = models.CharField(
+        max_length=100, blank=True, editable=False,
+        verbose_name="Processus d'exécution")
+    ## Date du dernier enregistrement de l'avancement de l'importation.
+    heartbeat = models.DateTimeField(
+        null=True, editable=False, verbose_name="Dernière activité")
+    ## Annulation demandée par un administrateur.
+    cancel_requested = models.BooleanField(
+        default=False, verbose_name="Annulation demandée")
+    ## Étape en cours.
+    stage = models.CharField(
+        max_length=40, blank=True, verbose_name="Étape en cours")
+    ## Nombre de lignes traitées par l'étape en cours.
+    rows = models.PositiveIntegerField(
+        default=0, verbose_name="Lignes traitées")
+    ## Avancement de l'importation, en pourcentage des étapes terminées.
+    percent = models.FloatField(default=0, verbose_name="Avancement (%)")
+    ## Durée totale de l'importation, en secondes.
+    seconds = models.FloatField(null=True, verbose_name="Durée (s)")
+    ## Message d'erreur si l'importation a échoué.
+    error = models.TextField(blank=True, verbose_name="Erreur")
+    ## Génération des horaires écrite par l'importation.
+    generation = models.ForeignKey(
+        'TimetableGeneration', null=True, on_delete=models.SET_NULL,
+        verbose_name="Génération des horaires")
+    ## Nombre d'objets insérés, modifiés, inchangés, retirés ou ignorés, en
+    #  JSON.
+    delta = models.TextField(default='{}', verbose_name="Différences")
+    ## Mesures de chaque étape, en JSON.
+    stages = models.TextField(default='[]', verbose_name="Étapes")
+
+    class Meta:
+        """Métadonnées du modèle d'importation GTFS."""
+        ## Nom affiché dans l'interface d'administration de Django.
+        verbose_name = "importation GTFS"
+        ## Nom au pluriel affiché dans l'administration de Django.
+        verbose_name_plural = "importations GTFS"
+
+    def progress(self):
+        """Obtenir l'avancement de l'importation sous forme de dictionnaire
+        sérialisable en JSON."""
+        return {
+            'id': self.id, 'status': self.status,
+            'status_display': self.get_status_display(),
+            'stage': self.stage, 'rows': self.rows,
+            'percent': round(self.percent, 1),
+            'cancel_requested': self.cancel_requested,
+            'error': self.error or None}
+
+    def report(self):
+        """Obtenir le compte rendu de l'importation sous forme de
+        dictionnaire sérialisable en JSON."""
+        return {
+            'id': self.id, 'started': self.started.isoformat(),
+            'sources': self.sources.splitlines(), 'seconds': self.seconds,
+            'status': self.status, 'success': self.status == self.SUCCEEDED,
+            'error': self.error or None, 'generation': self.generation_id,
+            'delta': json.loads(self.delta),
+            'stages': json.loads(self.stages)}
+
+    def __str__(self):
+        """Représentation textuelle de l'importation pour affichage."""
+        return "Importation " + str(self.id) + " du " + str(self.started)
+
+
 class Ticket(models.Model):
     """
     Décrit un billet de train. Un billet représente un voyage dans un seul
@@ -342,7 +764,12 @@ class Ticket(models.Model):
 
     @property
     def distance(self):
-        """Distance parcourue en kilomètres."""
+        """Distance parcourue en kilomètres, le long de l'itinéraire du
+        train. Si la distance cumulée des arrêts est inconnue, la distance à
+        vol d'oiseau entre les deux gares est utilisée."""
+        if self.start_halt.distance is not None and \
+                self.end_halt.distance is not None:
+            return self.end_halt.distance - self.start_halt.distance
         return self.start_halt.station.distance_to(self.end_halt.station)
 
     @property
@@ -350,16 +777,66 @@ class Ticket(models.Model):
         """Prix du billet."""
         return self.distance * self.start_halt.train.traintype.km_price
 
+    @staticmethod
+    def fares(tickets):
+        """Calculer les distances et les prix d'une liste de billets en un
+        seul appel vectorisé, avec les mêmes règles que distance et price.
+        Renvoie un couple de tableaux NumPy (distances, prix) dans l'ordre
+        des billets."""
+        return fares(
+            [t.start_halt.station.coords for t in tickets],
+            [t.end_halt.station.coords for t in tickets],
+            [t.start_halt.train.traintype.km_price for t in tickets],
+            [t.end_halt.distance - t.start_halt.distance
+             if t.start_halt.distance is not None and
+             t.end_halt.distance is not None else None for t in tickets])
+
     def __str__(self):
         """Représentation textuelle du billet pour affichage."""
         return "Billet de " + str(self.start_halt) + " à " + \
             str(self.end_halt) + " le " + str(self.travel.date)
 
 
+class TravelQuerySet(models.QuerySet):
+    """Requêtes sur les voyages."""
+
+    def with_tickets(self):
+        """Précharger les billets des voyages, avec leurs arrêts, gares,
+        trains et types de train, ainsi que les passagers, pour afficher une
+        liste de voyages sans requête supplémentaire."""
+        return self.prefetch_related(
+            models.Prefetch('ticket_set', queryset=Ticket.objects
+                            .select_related('start_halt__station',
+                                            'start_halt__train__traintype',
+                                            'end_halt__station')),
+            'passengers_aboard')
+
+    def search_results(self):
+        """Sélectionner les voyages non réservés (résultats de recherche
+        ajoutés à un panier) qui n'ont pas encore expiré."""
+        return self.filter(booked=False, created_at__gte=_expiry_cutoff())
+
+    def expired(self):
+        """Sélectionner les voyages non réservés créés il y a plus de
+        SEARCH_RESULT_TTL secondes, à l'aide de l'index
+        (booked, created_at)."""
+        return self.filter(booked=False, created_at__lt=_expiry_cutoff())
+
+
+def _expiry_cutoff():
+    """Obtenir la date de création avant laquelle un voyage non réservé a
+    expiré."""
+    return timezone.now() - timedelta(
+        seconds=getattr(settings, 'SEARCH_RESULT_TTL', 24 * 3600))
+
+
 class Travel(models.Model):
     """
     Décrit un voyage. Un voyage peut contenir plusieurs billets, qui feront
     une correspondance.
+    Un résumé du voyage (gares et heures de départ et d'arrivée, prix,
+    distance et nombre de passagers) est enregistré lors de sa création et de
+    sa réservation, pour éviter de le recalculer à chaque affichage.
     """
     ## Date du voyage.
     date = models.DateField()
@@ -368,55 +845,163 @@ class Travel(models.Model):
         Passenger, verbose_name="Passager")
     ## Voyage réservé ou état de résultat de recherche
     booked = models.BooleanField(verbose_name="Trajet réservé")
+    ## Date et heure de création du voyage.
+    #  Un voyage non réservé expire SEARCH_RESULT_TTL secondes après sa
+    #  création (voir TravelQuerySet.expired()). La valeur par défaut
+    #  s'applique aussi aux voyages existants lors de l'ajout du champ.
+    created_at = models.DateTimeField(
+        default=timezone.now, editable=False,
+        verbose_name="Date de création")
+    ## Gare de départ du voyage (résumé).
+    departure_station = models.ForeignKey(
+        'Station', null=True, editable=False, on_delete=models.SET_NULL,
+        related_name='+', verbose_name="Gare de départ")
+    ## Gare d'arrivée du voyage (résumé).
+    arrival_station = models.ForeignKey(
+        'Station', null=True, editable=False, on_delete=models.SET_NULL,
+        related_name='+', verbose_name="Gare d'arrivée")
+    ## Heure de départ du voyage (résumé).
+    departure_time = models.TimeField(
+        null=True, editable=False, verbose_name="Heure de départ")
+    ## Heure d'arrivée du voyage (résumé).
+    arrival_time = models.TimeField(
+        null=True, editable=False, verbose_name="Heure d'arrivée")
+    ## Prix du voyage pour un passager (résumé).
+    unit_price = models.FloatField(
+        null=True, editable=False, verbose_name="Prix par passager")
+    ## Distance totale du voyage, en kilomètres (résumé).
+    #  Vaut None tant que le résumé n'a pas été calculé.
+    distance = models.FloatField(
+        null=True, editable=False, verbose_name="Distance")
+    ## Nombre de passagers effectuant le voyage (résumé).
+    passenger_count = models.PositiveSmallIntegerField(
+        default=0, editable=False, verbose_name="Nombre de passagers")
+
+    objects = TravelQuerySet.as_manager()
 
     class Meta:
         """Métadonnées du modèle de voyage."""
         ## Tri par défaut si aucune clause order_by() n'est spécifiée dans un
         #  QuerySet.
         ordering = ["date"]
+        ## Index utilisé pour retrouver les voyages non réservés expirés.
+        indexes = [
+            models.Index(fields=["booked", "created_at"]),
+        ]
         ## Nom affiché dans l'interface d'administration de Django.
         verbose_name = "voyage"
 
+    @property
+    def summarized(self):
+        """Indique si le résumé du voyage a été calculé."""
+        return self.distance is not None
+
     @property
     def start_station(self):
         """Station de départ du voyage."""
+        if self.summarized:
+            return self.departure_station
         return self.ticket_set.order_by('sequence')[0].start_halt.station
 
     @property
     def end_station(self):
         """Station d'arrivée du voyage."""
+        if self.summarized:
+            return self.arrival_station
         return self.ticket_set.order_by('-sequence')[0].end_halt.station
 
     @property
     def start_time(self):
         """Heure de départ du voyage."""
+        if self.summarized:
+            return self.departure_time
         return self.ticket_set.order_by('sequence')[0].start_halt.departure
 
     @property
     def end_time(self):
         """Heure d'arrivée du voyage."""
-        return self.ticket_set.order_by('-sequence')[0].arrival
+        if self.summarized:
+            return self.arrival_time
+        return self.ticket_set.order_by('-sequence')[0].end_halt.arrival
 
     @property
     def price(self):
         """Prix total du voyage."""
-        return sum([t.price for t in self.ticket_set.all()]) * self.passengers
+        return self.price_passenger * self.passengers
 
     @property
     def price_passenger(self):
         """Prix par passager du voyage."""
-        return self.price / self.passengers
+        if self.summarized:
+            return self.unit_price
+        return float(Ticket.fares(self.ticket_set.all())[1].sum())
 
     @property
     def total_distance(self):
         """Distance totale du voyage."""
-        return sum([t.distance for t in self.ticket_set.all()])
+        if self.summarized:
+            return self.distance
+        return float(Ticket.fares(self.ticket_set.all())[0].sum())
 
     @property
     def passengers(self):
         """Nombre de passagers effectuant le voyage."""
+        if self.summarized:
+            return self.passenger_count
         return self.passengers_aboard.count()
 
+    def summarize(self, tickets=None, passengers=None):
+        """Calculer et enregistrer le résumé du voyage.
+        Les billets et le nombre de passagers peuvent être fournis s'ils sont
+        déjà connus ; sinon, ils sont lus depuis la base de données.
+        Un voyage sans billets n'a pas de résumé."""
+        if tickets is None:
+            tickets = list(self.ticket_set.select_related(
+                'start_halt__station', 'start_halt__train__traintype',
+                'end_halt__station'))
+        if passengers is None:
+            passengers = self.passengers_aboard.count()
+        if not tickets:
+            return
+        self.departure_station = tickets[0].start_halt.station
+        self.arrival_station = tickets[-1].end_halt.station
+        self.departure_time = tickets[0].start_halt.departure
+        self.arrival_time = tickets[-1].end_halt.arrival
+        distances, prices = Ticket.fares(tickets)
+        self.unit_price = float(prices.sum())
+        self.distance = float(distances.sum())
+        self.passenger_count = passengers
+        self.save(update_fields=[
+            'departure_station', 'arrival_station', 'departure_time',
+            'arrival_time', 'unit_price', 'distance', 'passenger_count'])
+
+    def book(self):
+        """Réserver le voyage. Les places sont retenues de façon atomique dans
+        le registre d'occupation de chaque train emprunté, puis le résumé du
+        voyage est recalculé.
+        Renvoie False si un des trains ne peut plus accueillir tous les
+        passagers, ou si le voyage a expiré entre-temps ; le voyage n'est
+        alors pas réservé."""
+        with transaction.atomic():
+            travel = Travel.objects.select_for_update().filter(
+                pk=self.pk).first()
+            if travel is None:
+                return False
+            if travel.booked:
+                return True
+            passengers = self.passengers_aboard.count()
+            tickets = list(self.ticket_set.select_related(
+                'start_halt__station', 'start_halt__train__traintype',
+                'end_halt__station'))
+            for ticket in tickets:
+                if not SeatOccupancy.reserve(ticket, self.date, passengers):
+                    transaction.set_rollback(True)
+                    return False
+            self.booked = True
+            self.save()
+            self.summarize(tickets, passengers)
+        return True
+
     def __str__(self):
         """Représentation textuelle du voyage pour affichage."""
         # S'il n'y a pas encore de billets dans le voyage (cas de la création
@@ -427,3 +1012,14 @@ class Travel(models.Model):
                  " de " + str(self.start_station) + " à " +
                  str(self.end_station))) + \
             " le " + str(self.date)
+
+
+@receiver(pre_delete, sender=Travel)
+def release_seats(sender, instance, **kwargs):
+    """Libérer les places retenues par un voyage réservé lors de sa
+    suppression."""
+    if not instance.booked:
+        return
+    passengers = instance.passengers
+    for ticket in instance.ticket_set.select_related('start_halt'):
+        SeatOccupancy.release(ticket, instance.date, passengers)
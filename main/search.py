@@ -2,127 +2,360 @@
 """Fonctions de recherche d'itinéraire de trains"""
 
 from enum import Enum
-from datetime import datetime, date
-from time import strftime
-from .utility import sql_query
-from .models import Train, Halt, Travel, Ticket
+import numpy as np
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils.dateparse import parse_date
+from django.utils.functional import cached_property
+from .utility import sql_query, LRUCache
+from .models import Halt, Train, Travel, Ticket, SeatOccupancy, \
+    TimetableGeneration
+from .timetable import get_timetable, MAX_TRANSFER_TIME
 
 
 class TimeOptions(Enum):
     """Définit les options de temps. Permet d'effectuer un départ après l'heure
     fournie ou une arrivée avant l'heure fournie."""
     ## Partir après une heure donnée.
-    DEPART_AFTER = 'D.departure'
+    DEPART_AFTER = 'departure'
     ## Arriver avant une heure donnée.
-    ARRIVE_BEFORE = 'A.arrival'
+    ARRIVE_BEFORE = 'arrival'
+
+
+class Itinerary(object):
+    """
+    Décrit un résultat de recherche, sans l'enregistrer en base de données.
+    Un itinéraire offre les mêmes propriétés qu'un voyage (Travel) pour
+    l'affichage, et ses billets sont des objets Ticket non enregistrés.
+    Il peut être transmis entre deux requêtes sous la forme d'un jeton signé,
+    et n'est enregistré comme voyage que lors de son ajout au panier.
+    """
+
+    ## Sel utilisé pour la signature des jetons d'itinéraires.
+    TOKEN_SALT = 'main.search.Itinerary'
+
+    def __init__(self, date, passengers, legs):
+        """Créer un itinéraire à partir d'une date, d'une liste de passagers
+        et d'une liste de couples (arrêt de départ, arrêt d'arrivée)."""
+        ## Date du voyage.
+        self.date = date
+        ## Passagers effectuant le voyage.
+        self.passengers_aboard = list(passengers)
+        ## Billets non enregistrés, dans l'ordre des étapes.
+        self.tickets = [Ticket(start_halt=start_halt, end_halt=end_halt,
+                               sequence=sequence)
+                        for sequence, (start_halt, end_halt)
+                        in enumerate(legs)]
+        ## Prix par passager et distance totale, calculés à la demande ou
+        #  pour plusieurs itinéraires à la fois par price_all().
+        self.fare = None
+
+    @property
+    def start_station(self):
+        """Station de départ du voyage."""
+        return self.tickets[0].start_halt.station
+
+    @property
+    def end_station(self):
+        """Station d'arrivée du voyage."""
+        return self.tickets[-1].end_halt.station
+
+    @property
+    def start_time(self):
+        """Heure de départ du voyage."""
+        return self.tickets[0].start_halt.departure
+
+    @property
+    def end_time(self):
+        """Heure d'arrivée du voyage."""
+        return self.tickets[-1].end_halt.arrival
+
+    @property
+    def price(self):
+        """Prix total du voyage."""
+        return self.price_passenger * self.passengers
+
+    @property
+    def price_passenger(self):
+        """Prix par passager du voyage."""
+        if self.fare is None:
+            Itinerary.price_all([self])
+        return self.fare[0]
+
+    @property
+    def total_distance(self):
+        """Distance totale du voyage."""
+        if self.fare is None:
+            Itinerary.price_all([self])
+        return self.fare[1]
+
+    @property
+    def passengers(self):
+        """Nombre de passagers effectuant le voyage."""
+        return len(self.passengers_aboard)
+
+    @staticmethod
+    def price_all(itineraries):
+        """Calculer les prix et distances de plusieurs itinéraires en un seul
+        appel vectorisé sur l'ensemble de leurs billets."""
+        distances, prices = Ticket.fares(
+            [t for i in itineraries for t in i.tickets])
+        # Sommes par itinéraire, à partir des sommes cumulées des billets
+        ends = np.cumsum([len(i.tickets) for i in itineraries])
+        starts = ends - [len(i.tickets) for i in itineraries]
+        for i, start, end in zip(itineraries, starts, ends):
+            i.fare = (float(prices[start:end].sum()),
+                      float(distances[start:end].sum()))
+
+    @cached_property
+    def token(self):
+        """Jeton signé permettant de retrouver l'itinéraire."""
+        return signing.dumps(
+            [self.date.isoformat(), [p.id for p in self.passengers_aboard],
+             [[t.start_halt.id, t.end_halt.id] for t in self.tickets]],
+            salt=self.TOKEN_SALT, compress=True)
+
+    @classmethod
+    def from_token(cls, token, passengers):
+        """Retrouver un itinéraire à partir de son jeton signé.
+        Les passagers sont recherchés dans le QuerySet passengers.
+        Lève BadSignature si le jeton est invalide ou a été émis il y a plus
+        de SEARCH_RESULT_TTL secondes, ou ObjectDoesNotExist si un passager
+        ou un arrêt n'existe plus, ou si un train ne fait plus partie de la
+        génération active des horaires ou ne circule pas à la date du
+        voyage."""
+        day, passenger_ids, legs = signing.loads(
+            token, salt=cls.TOKEN_SALT,
+            max_age=getattr(settings, 'SEARCH_RESULT_TTL', 24 * 3600))
+        day = parse_date(day)
+        halts = Halt.objects.select_related(
+            'station', 'train__traintype').filter(Train.runs_on(
+                day, TimetableGeneration.current(), 'train__')).in_bulk(
+                [halt_id for leg in legs for halt_id in leg])
+        passengers = list(passengers.filter(id__in=passenger_ids))
+        if len(passengers) != len(set(passenger_ids)) or \
+                not all([s in halts and e in halts for s, e in legs]):
+            raise ObjectDoesNotExist("Itinéraire introuvable.")
+        return cls(day, passengers, [(halts[s], halts[e]) for s, e in legs])
+
+    def matches(self, travel):
+        """Déterminer si un voyage correspond à l'itinéraire : même date,
+        mêmes étapes et mêmes passagers. Le voyage doit être chargé avec
+        TravelQuerySet.with_tickets()."""
+        return travel.date == self.date and \
+            [(t.start_halt_id, t.end_halt_id)
+             for t in travel.ticket_set.all()] == \
+            [(t.start_halt.id, t.end_halt.id) for t in self.tickets] and \
+            {p.id for p in travel.passengers_aboard.all()} == \
+            {p.id for p in self.passengers_aboard}
+
+    def save(self):
+        """Enregistrer l'itinéraire comme voyage non réservé, avec son
+        résumé. Renvoie le voyage créé."""
+        tv = Travel.objects.create(date=self.date, booked=False)
+        tv.passengers_aboard.add(*self.passengers_aboard)
+        for t in self.tickets:
+            t.travel = tv
+        Ticket.objects.bulk_create(self.tickets)
+        tv.summarize(self.tickets, self.passengers)
+        return tv
+
+
+## Nombre maximal de correspondances d'un voyage, utilisé si le paramètre
+#  SEARCH_MAX_TRANSFERS n'est pas défini.
+MAX_TRANSFERS = 3
+
+## Borne supérieure des heures en secondes, utilisée quand les départs ou les
+#  arrivées ne sont pas filtrés.
+_END_OF_SERVICE = 2147483647
+
+## Condition SQL vérifiant qu'un train (dont l'alias est à insérer avec
+#  format()) fait partie de la génération des horaires passée trois fois en
+#  paramètre et circule à la date passée ensuite, à l'aide de la table des
+#  jours de service de cette génération. Un train sans période de service
+#  circule tous les jours.
+_RUNS_ON_DATE = """({0}.first_generation <= %s AND
+    ({0}.last_generation IS NULL OR {0}.last_generation >= %s) AND
+    ({0}.period_id IS NULL OR EXISTS (
+        SELECT 1 FROM main_serviceday S
+        WHERE S.generation_id = %s AND S.period_id = {0}.period_id
+        AND S.date = %s)))"""
+
+
+## Cache des résultats de recherche du processus, partagé par ses fils
+#  d'exécution. Les clés contiennent les paramètres de la recherche et la
+#  génération des horaires ; les valeurs sont les voyages candidats, avant
+#  vérification de la capacité des trains, sous forme de couples
+#  d'identifiants d'arrêts.
+_cache = LRUCache(getattr(settings, 'SEARCH_CACHE_SIZE', 256))
+## Génération des horaires des entrées du cache.
+_cache_generation = None
 
 
 def search(start_station, end_station, date, time, passengers,
            time_setting=TimeOptions.DEPART_AFTER):
     """Effectuer une recherche d'itinéraire d'une gare à une autre, à une date
     donnée et une heure donnée et selon les paramètres de temps.
-    Renvoie des objets Travel."""
-    zero = _search_zero(
-        start_station, end_station, date, time, passengers, time_setting)
-    if len(zero):
-        return zero
-    one = _search_one(
-        start_station, end_station, date, time, passengers, time_setting)
-    zero.extend(one)
-    return zero
-
-
-def _search_zero(start_station, end_station, date, time, passengers,
-                 time_setting=TimeOptions.DEPART_AFTER):
-    """Effectuer une recherche d'itinéraire sans correspondances.
-    Renvoie des Travel correspondant aux résultats."""
+    Renvoie des objets Itinerary, qui ne sont pas enregistrés.
+    Le paramètre SEARCH_ENGINE permet de choisir entre le moteur d'horaires
+    en mémoire ('timetable') et les requêtes SQL ('sql'). Les deux moteurs
+    respectent le paramètre SEARCH_MAX_TRANSFERS, mais les requêtes SQL ne
+    trouvent jamais plus d'une correspondance.
+    Les voyages candidats sont conservés en cache jusqu'à la prochaine
+    importation GTFS. La capacité des trains est vérifiée à chaque recherche,
+    en une seule lecture ; seuls les voyages ayant le moins de
+    correspondances sont renvoyés."""
+    global _cache_generation
+    engine = getattr(settings, 'SEARCH_ENGINE', 'sql')
+    generation = TimetableGeneration.current()
+    if generation != _cache_generation:
+        # Les entrées des générations précédentes ne serviront plus
+        _cache.clear()
+        _cache_generation = generation
+    if engine == 'timetable':
+        finders = [_search_timetable]
+    else:
+        finders = [_search_zero, _search_one][:min(max_transfers(), 1) + 1]
+
+    results = []
+    for finder in finders:
+        key = (finder.__name__, start_station.id, end_station.id, date,
+               time.hour, time_setting.name,
+               max_transfers(), generation)
+        journeys = _cache.get(key)
+        if journeys is None:
+            journeys = finder(start_station, end_station, date, time,
+                              time_setting, generation)
+            _cache.set(key, journeys)
+        results = _itineraries(journeys, date, passengers)
+        if results:
+            break
+    fewest = min([len(i.tickets) for i in results] or [0])
+    return [i for i in results if len(i.tickets) == fewest]
+
+
+def max_transfers():
+    """Obtenir le nombre maximal de correspondances d'un voyage, défini par
+    le paramètre SEARCH_MAX_TRANSFERS."""
+    return getattr(settings, 'SEARCH_MAX_TRANSFERS', MAX_TRANSFERS)
+
+
+def cache_info():
+    """Obtenir les statistiques du cache des résultats de recherche :
+    succès, échecs, nombre d'entrées et taille maximale."""
+    return _cache.info()
+
 
+def _itineraries(journeys, date, passengers):
+    """Construire les itinéraires correspondant à une liste de voyages
+    candidats, donnés sous forme de listes de couples d'identifiants d'arrêts.
+    Les arrêts, avec leurs gares, trains et types de train, sont chargés en
+    une seule requête, et la capacité de toutes les étapes est vérifiée en une
+    seule lecture ; les voyages dont un train est complet sont écartés, ainsi
+    que ceux dont un arrêt a été supprimé depuis leur mise en cache."""
+    halts = Halt.objects.select_related(
+        'station', 'train__traintype').in_bulk(
+        [halt_id for legs in journeys for leg in legs for halt_id in leg])
+    journeys = [[(halts[s], halts[e]) for s, e in legs] for legs in journeys
+                if all([s in halts and e in halts for s, e in legs])]
+    fits = iter(SeatOccupancy.can_hold(
+        [leg for legs in journeys for leg in legs], date, len(passengers)))
+    itineraries = [Itinerary(date, passengers, legs) for legs in journeys
+                   if all([next(fits) for leg in legs])]
+    Itinerary.price_all(itineraries)
+    return itineraries
+
+
+def _search_timetable(start_station, end_station, date, time,
+                      time_setting=TimeOptions.DEPART_AFTER, generation=None):
+    """Rechercher les voyages candidats avec le moteur d'horaires en
+    mémoire, avec au plus SEARCH_MAX_TRANSFERS correspondances."""
+    departures, arrivals = _windows(time, time_setting)
+    return get_timetable(generation).journeys(
+        start_station.id, end_station.id, date,
+        departures if time_setting == TimeOptions.DEPART_AFTER else arrivals,
+        time_setting == TimeOptions.DEPART_AFTER,
+        max_transfers())
+
+
+def _search_zero(start_station, end_station, date, time,
+                 time_setting=TimeOptions.DEPART_AFTER, generation=None):
+    """Rechercher les voyages candidats sans correspondances.
+    Les trains qui ne circulent pas à la date souhaitée sont écartés par la
+    requête, et les heures sont filtrées par des parcours d'intervalles sur
+    les index (station_id, departure_s) et (station_id, arrival_s)."""
+    departures, arrivals = _windows(time, time_setting)
+    if generation is None:
+        generation = TimetableGeneration.current()
     halt_ids = sql_query(
         """SELECT start_halt_id, end_halt_id, D.train_id FROM (
-    SELECT id AS start_halt_id, departure, sequence, train_id FROM main_halt
-    WHERE station_id = %s) AS D INNER JOIN (
-        SELECT id AS end_halt_id, arrival, sequence, train_id FROM main_halt
-        WHERE station_id = %s) AS A
+    SELECT id AS start_halt_id, departure_s, sequence, train_id FROM main_halt
+    WHERE station_id = %s AND departure_s BETWEEN %s AND %s) AS D
+    INNER JOIN (
+        SELECT id AS end_halt_id, arrival_s, sequence, train_id FROM main_halt
+        WHERE station_id = %s AND arrival_s BETWEEN %s AND %s) AS A
     ON D.train_id = A.train_id AND D.sequence < A.sequence
-    WHERE """ + time_setting.value + """ BETWEEN %s AND %s
-    ORDER BY departure ASC, arrival ASC""",
-        [start_station.id, end_station.id,
-         str(time.hour - 1).zfill(2) + ":00:00",
-         str(time.hour + 1).zfill(2) + ":00:00"])
-
-    # Filtrer pour ne garder que les trains qui circulent à la date souhaitée,
-    # et créer les résultats de recherche correspondants
-    travels = []
-    for trip in halt_ids:
-        tr = Train.objects.get(id=trip[2])
-        start_halt = Halt.objects.get(id=trip[0])
-        end_halt = Halt.objects.get(id=trip[1])
-        if tr.runs(date) and \
-                tr.can_hold(start_halt, end_halt, len(passengers)):
-            tv = Travel.objects.create(date=date, booked=False)
-            tv.passengers_aboard.add(*passengers)
-            Ticket.objects.create(start_halt=start_halt, end_halt=end_halt,
-                                  sequence=0, travel=tv)
-            travels.append(tv)
-    return travels
-
-
-def _search_one(start_station, end_station, date, time, passengers,
-                time_setting=TimeOptions.DEPART_AFTER):
-    """Effectuer une recherche d'itinéraire avec une correspondance.
-    Renvoie des Travel correspondant aux résultats."""
+    INNER JOIN main_train T ON T.id = D.train_id
+    WHERE """ + _RUNS_ON_DATE.format('T') + """
+    ORDER BY departure_s ASC, arrival_s ASC""",
+        [start_station.id] + departures + [end_station.id] + arrivals +
+        [generation] * 3 + [date])
+
+    return [[(trip[0], trip[1])] for trip in halt_ids]
 
+
+def _search_one(start_station, end_station, date, time,
+                time_setting=TimeOptions.DEPART_AFTER, generation=None):
+    """Rechercher les voyages candidats avec une correspondance.
+    Les trains qui ne circulent pas à la date souhaitée sont écartés par la
+    requête, ainsi que les correspondances trop longues."""
+    departures, arrivals = _windows(time, time_setting)
+    if generation is None:
+        generation = TimetableGeneration.current()
     halt_ids = sql_query(
-        """SELECT start_halt_id, mid1_halt_id, mid2_halt_id, end_halt_id,
-        D.departure, D.first_arrival, A.second_departure, A.arrival FROM (
+        """SELECT start_halt_id, mid1_halt_id, mid2_halt_id, end_halt_id FROM (
             SELECT start_halt_id, mid1_halt_id, I1.station_id as mid_station,
-            D.departure, I1.arrival as first_arrival, first_train_id FROM (
-                SELECT id AS start_halt_id, departure, sequence, train_id
+            D.departure_s, I1.arrival_s as first_arrival, first_train_id
+            FROM (
+                SELECT id AS start_halt_id, departure_s, sequence, train_id
                 AS first_train_id FROM main_halt
-                WHERE station_id = %s ) AS D INNER JOIN (
-                SELECT id AS mid1_halt_id, station_id, arrival, sequence,
+                WHERE station_id = %s AND departure_s BETWEEN %s AND %s
+                ) AS D INNER JOIN (
+                SELECT id AS mid1_halt_id, station_id, arrival_s, sequence,
                 train_id FROM main_halt ) AS I1
                 ON first_train_id = I1.train_id AND D.sequence < I1.sequence
         ) AS D INNER JOIN (
             SELECT mid2_halt_id, end_halt_id, I2.station_id as mid_station,
-            I2.departure as second_departure, A.arrival, second_train_id FROM (
-                SELECT id AS mid2_halt_id, station_id, departure, sequence,
+            I2.departure_s as second_departure, A.arrival_s, second_train_id
+            FROM (
+                SELECT id AS mid2_halt_id, station_id, departure_s, sequence,
                 train_id FROM main_halt ) AS I2 INNER JOIN (
-                SELECT id AS end_halt_id, arrival, sequence,
+                SELECT id AS end_halt_id, arrival_s, sequence,
                 train_id AS second_train_id FROM main_halt
-                WHERE station_id = %s ) AS A
+                WHERE station_id = %s AND arrival_s BETWEEN %s AND %s
+                ) AS A
                 ON second_train_id = I2.train_id AND I2.sequence < A.sequence
         ) AS A ON D.mid_station = A.mid_station
         AND D.first_arrival < A.second_departure
-        WHERE first_train_id <> second_train_id AND """ + time_setting.value +
-        """ BETWEEN %s AND %s ORDER BY D.departure ASC, A.arrival ASC;""",
-        [start_station.id, end_station.id,
-         str(time.hour - 1).zfill(2) + ":00:00",
-         str(time.hour + 1).zfill(2) + ":00:00"])
-
-    # Filtrer pour ne garder que les trains qui circulent à la date souhaitée,
-    # et ont assez de place, et créer les résultats de recherche correspondants
-    travels = []
-    for trip in halt_ids:
-        mid_halt_1 = Halt.objects.get(id=trip[1])
-        mid_halt_2 = Halt.objects.get(id=trip[2])
-        if (datetime.combine(date.today(), mid_halt_2.departure) -
-            datetime.combine(date.today(), mid_halt_1.arrival)) \
-                .seconds / 3600 > 3:
-            # Ignorer un temps de correspondance supérieur à 3 heures
-            continue
-        start_halt = Halt.objects.get(id=trip[0])
-        end_halt = Halt.objects.get(id=trip[3])
-        tr_1 = start_halt.train
-        tr_2 = end_halt.train
-        if tr_1.runs(date) and tr_2.runs(date) and \
-                tr_1.can_hold(start_halt, mid_halt_1, len(passengers)) and \
-                tr_2.can_hold(mid_halt_2, end_halt, len(passengers)):
-            tv = Travel.objects.create(date=date, booked=False)
-            tv.passengers_aboard.add(*passengers)
-            Ticket.objects.create(start_halt=start_halt, end_halt=mid_halt_1,
-                                  sequence=0, travel=tv)
-            Ticket.objects.create(start_halt=mid_halt_2, end_halt=end_halt,
-                                  sequence=1, travel=tv)
-            travels.append(tv)
-    return travels
+        AND A.second_departure - D.first_arrival <= %s
+        INNER JOIN main_train T1 ON T1.id = first_train_id
+        INNER JOIN main_train T2 ON T2.id = second_train_id
+        WHERE first_train_id <> second_train_id
+        AND """ + _RUNS_ON_DATE.format('T1') + """
+        AND """ + _RUNS_ON_DATE.format('T2') + """
+        ORDER BY D.departure_s ASC, A.arrival_s ASC;""",
+        [start_station.id] + departures + [end_station.id] + arrivals +
+        [MAX_TRANSFER_TIME] + ([generation] * 3 + [date]) * 2)
+
+    return [[(trip[0], trip[1]), (trip[2], trip[3])] for trip in halt_ids]
+
+
+def _windows(time, time_setting):
+    """Obtenir les intervalles, en secondes depuis le début du jour de
+    service, imposés aux départs de la gare de départ et aux arrivées en gare
+    d'arrivée, sous forme de listes [début, fin]."""
+    window = [(time.hour - 1) * 3600, (time.hour + 1) * 3600]
+    if time_setting == TimeOptions.DEPART_AFTER:
+        return window, [0, _END_OF_SERVICE]
+    return [0, _END_OF_SERVICE], window
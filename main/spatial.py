@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Index spatial des gares pour les recherches de proximité.
+Les gares sont rangées dans un arbre k-d construit sur leurs coordonnées
+converties en vecteurs unitaires en trois dimensions : la distance en ligne
+droite entre deux vecteurs croît avec la distance sur la surface de la Terre,
+ce qui permet d'élaguer l'arbre sans se soucier des pôles ni du méridien 180.
+Pour l'affichage de la carte, les gares sont également regroupées sur une
+grille en projection de Mercator, précalculée pour chaque niveau de zoom.
+Les positions des gares ne changent qu'à l'importation GTFS : l'arbre et
+les grilles de regroupement sont donc calculés une fois par processus, et
+les requêtes de proximité ou de carte ne lisent la base de données que pour
+vérifier la génération active, au plus toutes les TIMETABLE_GENERATION_TTL
+secondes.
+"""
+
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappushpop
+from math import radians, cos, sin, asin, tan, log, pi
+from .models import Station, TimetableGeneration
+
+## Rayon de la Terre en kilomètres, identique à celui de utility.haversine.
+EARTH_RADIUS = 6367
+
+## Niveau de zoom à partir duquel les gares ne sont plus regroupées.
+CLUSTER_MAX_ZOOM = 12
+## Nombre de cellules de la grille de regroupement par tuile de carte (256
+#  pixels), sur chaque axe.
+CELLS_PER_TILE = 4
+## Latitude maximale de la projection de Mercator.
+_MAX_LATITUDE = 85.05112878
+
+## Arbre et grilles de regroupement des gares, calculés par le processus
+#  pour la génération des horaires indiquée par leur attribut generation.
+_index = None
+
+
+def get_index():
+    """Obtenir l'index spatial du processus. Il est calculé lors du premier
+    appel, puis à nouveau lorsque TimetableGeneration.current_cached()
+    indique qu'une autre génération des horaires est active."""
+    global _index
+    generation = TimetableGeneration.current_cached()
+    if _index is None or _index.generation != generation:
+        _index = StationIndex.load()
+        _index.generation = generation
+    return _index
+
+
+def invalidate():
+    """Oublier l'index spatial chargé, pour qu'il soit reconstruit lors de la
+    prochaine recherche. À appeler après une importation GTFS."""
+    global _index
+    _index = None
+
+
+def _unit_vector(lat, lng):
+    """Convertir une latitude et une longitude en degrés en vecteur unitaire
+    (x, y, z)."""
+    lat, lng = radians(lat), radians(lng)
+    return (cos(lat) * cos(lng), cos(lat) * sin(lng), sin(lat))
+
+
+def _mercator(lat, lng):
+    """Projeter une latitude et une longitude en degrés sur le carré unité
+    de la projection de Mercator, l'axe des ordonnées étant dirigé vers le
+    sud comme pour les tuiles de carte."""
+    lat = radians(max(min(lat, _MAX_LATITUDE), -_MAX_LATITUDE))
+    return ((lng + 180) / 360,
+            (1 - log(tan(lat) + 1 / cos(lat)) / pi) / 2)
+
+
+def _cell(value, size):
+    """Obtenir l'indice de la cellule contenant une coordonnée projetée,
+    sur une grille de size cellules."""
+    return max(0, min(int(value * size), size - 1))
+
+
+def _chord_to_km(chord):
+    """Convertir une distance en ligne droite entre vecteurs unitaires en
+    distance sur la surface de la Terre, en kilomètres."""
+    return 2 * EARTH_RADIUS * asin(min(chord / 2, 1.0))
+
+
+def _km_to_chord(km):
+    """Convertir une distance sur la surface de la Terre, en kilomètres, en
+    distance en ligne droite entre vecteurs unitaires."""
+    return 2 * sin(min(km / EARTH_RADIUS, pi) / 2)
+
+
+class StationIndex(object):
+    """
+    Arbre k-d des gares. Chaque nœud est un tuple
+    (indice de gare, axe de découpe, sous-arbre gauche, sous-arbre droit),
+    les sous-arbres vides valant None.
+    Les grilles de regroupement associent à chaque cellule non vide la liste
+    de ses gares et leur position moyenne ; leurs clés (colonne, ligne) sont
+    triées pour parcourir par dichotomie les seules cellules visibles.
+    """
+
+    def __init__(self, stations):
+        """Construire l'index à partir de tuples bruts
+        (id, nom, latitude, longitude)."""
+        ## Gares indexées : (id, nom, latitude, longitude).
+        self.stations = list(stations)
+        ## Vecteurs unitaires des gares, dans le même ordre.
+        self.points = [_unit_vector(s[2], s[3]) for s in self.stations]
+        ## Racine de l'arbre k-d.
+        self.root = self._build(list(range(len(self.points))), 0)
+        ## Coordonnées projetées des gares, dans le même ordre.
+        self.projected = [_mercator(s[2], s[3]) for s in self.stations]
+        ## Grilles de regroupement pour chaque niveau de zoom jusqu'à
+        #  CLUSTER_MAX_ZOOM : (clés triées, cellules).
+        self.grids = [self._grid(zoom)
+                      for zoom in range(CLUSTER_MAX_ZOOM + 1)]
+        ## Génération des horaires chargée.
+        self.generation = None
+
+    @classmethod
+    def load(cls):
+        """Charger l'index spatial depuis la base de données."""
+        return cls(Station.objects.values_list('id', 'name', 'lat', 'lng'))
+
+    def _build(self, indices, depth):
+        """Construire récursivement un sous-arbre, en découpant sur la
+        médiane de chaque axe à tour de rôle."""
+        if not indices:
+            return None
+        axis = depth % 3
+        indices.sort(key=lambda i: self.points[i][axis])
+        middle = len(indices) // 2
+        return (indices[middle], axis,
+                self._build(indices[:middle], depth + 1),
+                self._build(indices[middle + 1:], depth + 1))
+
+    def _grid(self, zoom):
+        """Regrouper les gares sur la grille d'un niveau de zoom.
+        Chaque cellule est un tuple (indices des gares, latitude moyenne,
+        longitude moyenne)."""
+        size = 2**zoom * CELLS_PER_TILE
+        members = {}
+        for i, (x, y) in enumerate(self.projected):
+            members.setdefault((_cell(x, size), _cell(y, size)), []).append(i)
+        cells = {key: (indices,
+                       sum([self.stations[i][2] for i in indices]) /
+                       len(indices),
+                       sum([self.stations[i][3] for i in indices]) /
+                       len(indices))
+                 for key, indices in members.items()}
+        return sorted(cells), cells
+
+    def clusters(self, south, west, north, east, zoom):
+        """Obtenir les gares visibles dans un rectangle de la carte à un
+        niveau de zoom donné. En dessous de CLUSTER_MAX_ZOOM, les gares
+        proches sont regroupées sur la grille de ce niveau.
+        Si west est supérieur à east, le rectangle traverse le méridien 180.
+        Renvoie une liste de tuples (latitude, longitude, nombre de gares,
+        gare), où gare vaut None pour un groupe de plusieurs gares, et
+        (id, nom, latitude, longitude) sinon."""
+        zoom = max(0, min(int(zoom), CLUSTER_MAX_ZOOM))
+        keys, cells = self.grids[zoom]
+        size = 2**zoom * CELLS_PER_TILE
+        x0, y1 = (_cell(v, size) for v in _mercator(south, west))
+        x1, y0 = (_cell(v, size) for v in _mercator(north, east))
+        if west <= east:
+            columns = list(range(x0, x1 + 1))
+        else:
+            columns = list(range(x0, size)) + list(range(0, x1 + 1))
+        results = []
+        for column in columns:
+            for key in keys[bisect_left(keys, (column, y0)):
+                            bisect_right(keys, (column, y1))]:
+                indices, lat, lng = cells[key]
+                if len(indices) > 1 and zoom < CLUSTER_MAX_ZOOM:
+                    results.append((lat, lng, len(indices), None))
+                    continue
+                # Gares isolées : seules celles réellement visibles
+                for i in indices:
+                    station = self.stations[i]
+                    if south <= station[2] <= north and (
+                            west <= station[3] <= east if west <= east
+                            else station[3] >= west or station[3] <= east):
+                        results.append((station[2], station[3], 1, station))
+        return results
+
+    def nearest(self, lat, lng, k=10):
+        """Rechercher les k gares les plus proches d'une position.
+        Renvoie une liste de tuples (id, nom, latitude, longitude, distance
+        en kilomètres), de la plus proche à la plus éloignée."""
+        if k <= 0:
+            return []
+        # Tas des meilleurs candidats, par distance au carré opposée
+        best = []
+        self._nearest(self.root, _unit_vector(lat, lng), k, best)
+        return self._results(sorted([(-d, i) for d, i in best]))
+
+    def _nearest(self, node, query, k, best):
+        """Parcourir un sous-arbre à la recherche des plus proches voisins,
+        en visitant d'abord le côté contenant la position recherchée."""
+        if node is None:
+            return
+        index, axis, left, right = node
+        point = self.points[index]
+        dist = sum([(a - b)**2 for a, b in zip(point, query)])
+        if len(best) < k:
+            heappush(best, (-dist, index))
+        elif dist < -best[0][0]:
+            heappushpop(best, (-dist, index))
+        diff = query[axis] - point[axis]
+        near, far = (left, right) if diff < 0 else (right, left)
+        self._nearest(near, query, k, best)
+        if len(best) < k or diff**2 < -best[0][0]:
+            self._nearest(far, query, k, best)
+
+    def within(self, lat, lng, radius):
+        """Rechercher les gares situées à moins de radius kilomètres d'une
+        position. Renvoie une liste de tuples (id, nom, latitude, longitude,
+        distance en kilomètres), de la plus proche à la plus éloignée."""
+        found = []
+        limit = _km_to_chord(radius)**2
+        self._within(self.root, _unit_vector(lat, lng), limit, found)
+        return self._results(sorted(found))
+
+    def _within(self, node, query, limit, found):
+        """Parcourir un sous-arbre à la recherche des gares dont la distance
+        au carré est inférieure à limit."""
+        if node is None:
+            return
+        index, axis, left, right = node
+        point = self.points[index]
+        dist = sum([(a - b)**2 for a, b in zip(point, query)])
+        if dist <= limit:
+            found.append((dist, index))
+        diff = query[axis] - point[axis]
+        if diff < 0 or diff**2 <= limit:
+            self._within(left, query, limit, found)
+        if diff >= 0 or diff**2 <= limit:
+            self._within(right, query, limit, found)
+
+    def _results(self, candidates):
+        """Mettre en forme des couples (distance au carré, indice)."""
+        return [self.stations[i] + (_chord_to_km(dist**0.5),)
+                for dist, i in candidates]
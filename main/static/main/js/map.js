@@ -1,19 +1,57 @@
 var map;
+var request;
+
+function clusterIcon(count) {
+    // Mêmes images que MarkerClusterer, selon le nombre de gares
+    var index = Math.min(String(count).length, 5);
+    return {
+        url: '/static/main/img/m' + index + '.png',
+        anchor: new google.maps.Point(26, 26)
+    };
+}
+
+function loadStations() {
+    var bounds = map.getBounds();
+    if(!bounds) {
+        return;
+    }
+    var sw = bounds.getSouthWest(), ne = bounds.getNorthEast();
+    if(request) {
+        request.abort();
+    }
+    request = $.getJSON($("#map").data('geojson'), {
+        bbox: [sw.lng(), sw.lat(), ne.lng(), ne.lat()].join(','),
+        zoom: map.getZoom()
+    }, function(data) {
+        map.data.forEach(function(feature) {
+            map.data.remove(feature);
+        });
+        map.data.addGeoJson(data);
+    });
+}
+
 function initMap() {
     map = new google.maps.Map(document.getElementById('map'), {
         zoom: 5,
         center: new google.maps.LatLng(48.85,2.34),
         mapTypeId: 'terrain'
     });
-    map.data.loadGeoJson('/train/stations.geojson', null, function(features) {
-        var markers = features.map(function (feature) {
-            var g = feature.getGeometry();
-            var marker = new google.maps.Marker({ 'position': g.get(0) });
-            return marker;
-        });
-        var clusterer = new MarkerClusterer(map, markers, {imagePath: '/static/main/img/m'});
-    });
     map.data.setStyle(function (feature) {
-        return { icon: feature.getProperty('icon'), visible: false };
+        var count = feature.getProperty('count');
+        if(count > 1) {
+            return {
+                icon: clusterIcon(count),
+                label: { text: String(count), color: 'white' }
+            };
+        }
+        return { title: feature.getProperty('title') };
+    });
+    map.data.addListener('click', function(event) {
+        // Un clic sur un groupe de gares zoome sur celui-ci
+        if(event.feature.getProperty('count') > 1) {
+            map.setCenter(event.feature.getGeometry().get());
+            map.setZoom(map.getZoom() + 2);
+        }
     });
+    map.addListener('idle', loadStations);
 }
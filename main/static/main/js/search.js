@@ -7,31 +7,44 @@ function hideLoader() {
     $(".loader").remove();
 }
 
-function createAutoComp(data) {
+function createAutoComp() {
     $('#startStation, #endStation').autocomplete({
         source: function(request, response) {
-            var results = $.ui.autocomplete.filter(data, request.term);
-            response(results.slice(0, 10));
+            $.getJSON("/train/stations/complete.json", {q: request.term}, response);
         },
-        minLength: 3,
+        minLength: 2,
     });
     $('form').submit(function(event) {
-	$(".alert").remove();
-        labels = data.map(s => s.label.toLowerCase());
-        if(!labels.includes($("#startStation").val().trim().toLowerCase())) {
-            $('.input-stack').before('<div class="alert alert-danger alert-dismissible fade show" role="alert">Cette station de départ n\'existe pas.<button type="button" class="close" data-dismiss="alert" aria-label="Fermer"><span aria-hidden="true">&times;</span></button></div>');
-            event.preventDefault();
-        } else if(!labels.includes($("#endStation").val().trim().toLowerCase())) {
-            $('.input-stack').before('<div class="alert alert-danger alert-dismissible fade show" role="alert">Cette station d\'arrivée n\'existe pas.<button type="button" class="close" data-dismiss="alert" aria-label="Fermer"><span aria-hidden="true">&times;</span></button></div>');
-            event.preventDefault();
-        } else {
-        	showLoader("Calcul des trajets...");
-	}
+        $(".alert").remove();
+        showLoader("Calcul des trajets...");
     });
 }
 
+function fillNearestStation() {
+    navigator.geolocation.getCurrentPosition(function(position) {
+        $.getJSON("/train/stations/near.json", {
+            lat: position.coords.latitude,
+            lng: position.coords.longitude,
+            k: 1
+        }, function(data) {
+            if(data.length) {
+                $("#startStation").val(data[0].label);
+            }
+        });
+    });
+}
+
+function createNearestStationButton() {
+    // La position n'est demandée qu'à la demande de l'utilisateur
+    if(!navigator.geolocation) {
+        return;
+    }
+    $("#nearestStation").removeClass("d-none").click(fillNearestStation);
+}
+
 $(function() {
-    $.getJSON("/train/stations.json", createAutoComp);
+    createAutoComp();
+    createNearestStationButton();
     $("#date").datepicker({
         altField: "#date",
         closeText: 'Fermer',
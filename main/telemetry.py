@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Mesures des étapes de l'importation GTFS.
+Chaque étape, délimitée par le gestionnaire de contexte stage(), est mesurée :
+durée, nombre de lignes traitées, débit et pic de mémoire allouée pendant
+l'étape, relevé avec tracemalloc si le paramètre GTFS_IMPORT_TRACE_MEMORY
+est activé, ce qui ralentit l'importation et ne sert qu'à son profilage.
+Les étapes ne doivent pas être imbriquées.
+Les mesures sont accumulées dans le processus courant jusqu'à leur lecture
+par collect() ; celles des étapes exécutées dans un autre processus sont
+renvoyées avec leurs résultats, puis ajoutées par record().
+Une fonction définie par listen() est informée de l'avancement des étapes,
+par exemple pour suivre une importation en tâche de fond ; elle peut
+l'interrompre en levant Cancelled.
+"""
+
+import time
+import tracemalloc
+from contextlib import contextmanager
+from django.conf import settings
+
+## Nombre de lignes traitées entre deux avis d'avancement d'une étape.
+PROGRESS_ROWS = 10000
+
+## Mesures des étapes terminées dans le processus, non encore lues.
+_stages = []
+## Fonction informée de l'avancement des étapes, ou None.
+_listener = None
+
+
+class Cancelled(Exception):
+    """
+    Exception levée pour interrompre une importation, par exemple à la
+    demande d'un administrateur.
+    """
+
+
+class Stage(object):
+    """
+    Mesures d'une étape de l'importation, en cours ou terminée.
+    """
+
+    def __init__(self, name, source=None):
+        """Créer les mesures d'une étape, éventuellement limitée à une
+        archive GTFS source."""
+        ## Nom de l'étape.
+        self.name = name
+        ## Nom de l'archive traitée, ou None pour une étape globale.
+        self.source = source
+        ## Nombre de lignes traitées.
+        self.rows = 0
+        ## Durée de l'étape, en secondes.
+        self.seconds = 0.0
+        ## Pic de mémoire allouée pendant l'étape, en octets, ou None si la
+        #  mémoire n'est pas mesurée.
+        self.peak_memory = None
+
+    def count(self, iterable):
+        """Parcourir un itérable en comptant ses éléments comme lignes
+        traitées."""
+        for item in iterable:
+            self.rows += 1
+            if not self.rows % PROGRESS_ROWS:
+                _notify(self.name, self.rows, False)
+            yield item
+
+    def as_dict(self):
+        """Obtenir les mesures sous forme de dictionnaire sérialisable en
+        JSON."""
+        return {
+            'name': self.name, 'source': self.source,
+            'seconds': round(self.seconds, 6), 'rows': self.rows,
+            'rows_per_second': round(self.rows / self.seconds, 1)
+            if self.seconds else None,
+            'peak_memory': self.peak_memory}
+
+
+@contextmanager
+def stage(name, source=None):
+    """Mesurer une étape de l'importation. L'objet Stage renvoyé permet
+    d'indiquer le nombre de lignes traitées, avec Stage.count() ou en
+    modifiant Stage.rows."""
+    _notify(name, 0, False)
+    current = Stage(name, source)
+    trace = getattr(settings, 'GTFS_IMPORT_TRACE_MEMORY', False)
+    started = trace and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    elif trace and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    elif trace:
+        # tracemalloc.reset_peak() n'existe qu'à partir de Python 3.9 : le
+        # suivi déjà en cours est redémarré pour remettre le pic à zéro
+        tracemalloc.stop()
+        tracemalloc.start()
+    allocated = tracemalloc.get_traced_memory()[0] if trace else 0
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - start
+        if trace:
+            current.peak_memory = tracemalloc.get_traced_memory()[1] - \
+                allocated
+            if started:
+                tracemalloc.stop()
+        _stages.append(current.as_dict())
+    # Seules les étapes terminées sans erreur sont annoncées comme telles
+    _notify(name, current.rows, True)
+
+
+def collect():
+    """Obtenir, sous forme de dictionnaires, les mesures des étapes terminées
+    dans le processus depuis le dernier appel."""
+    global _stages
+    stages, _stages = _stages, []
+    return stages
+
+
+def record(stages):
+    """Ajouter les mesures d'étapes exécutées dans un autre processus."""
+    _stages.extend(stages)
+    for s in stages:
+        _notify(s['name'], s['rows'], True)
+
+
+def listen(listener):
+    """Définir la fonction informée de l'avancement des étapes du processus,
+    appelée avec le nom de l'étape, le nombre de lignes traitées et un
+    booléen indiquant si l'étape est terminée. None supprime la fonction."""
+    global _listener
+    _listener = listener
+
+
+def _notify(name, rows, finished):
+    """Informer la fonction définie par listen() de l'avancement d'une
+    étape."""
+    if _listener is not None:
+        _listener(name, rows, finished)
+
+
+def format_stage(stage):
+    """Mettre en forme les mesures d'une étape pour affichage."""
+    text = stage['name']
+    if stage['source']:
+        text += " (" + stage['source'] + ")"
+    text += ": %.3f s, %d rows" % (stage['seconds'], stage['rows'])
+    if stage['rows_per_second']:
+        text += ", %d rows/s" % stage['rows_per_second']
+    if stage['peak_memory'] is not None:
+        text += ", %.1f MiB peak" % (stage['peak_memory'] / 1048576)
+    return text
@@ -1,6 +1,1659 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import pickle
+import socket
+import tempfile
+import tracemalloc
+import zipfile
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import date, time, timedelta
+from unittest import mock
+from urllib.error import URLError
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from django.core.signing import BadSignature
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from . import artifacts, autocomplete, gtfs_parser, jobs, models, \
+    search as search_module, spatial, telemetry, timetable
+from .autocomplete import StationNames
+from .gtfs_parser import build_service_days, compute_halt_distances, \
+    parse_gtfs_trains, read_gtfs_csv, read_gtfs_part, trip_fingerprint
+from .management.commands import autoimport
+from .models import Halt, ImportRun, Passenger, Period, PeriodException, \
+    SeatOccupancy, ServiceDay, Station, Ticket, TimetableGeneration, Train, \
+    TrainType, Travel
+from .search import Itinerary, TimeOptions, search
+from .spatial import StationIndex
+from .upgrade import backfill_halt_seconds, backfill_service_days
+from .utility import fares, haversine, haversine_array
 
-# Create your tests here.
+## Lundi durant lequel circulent les trains de test.
+MONDAY = date(2018, 3, 5)
+## Samedi durant lequel les trains de test ne circulent pas.
+SATURDAY = date(2018, 3, 10)
+
+
+def seconds(value):
+    """Convertir une heure HH:MM en secondes depuis le début du jour de
+    service."""
+    hours, minutes = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+def write_csv(archive, name, header, rows):
+    """Écrire un fichier CSV dans une archive ZIP."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    writer.writerows(rows)
+    archive.writestr(name, buf.getvalue().encode('utf-8-sig'))
+
+
+def write_gtfs(path, stations, trips, service=1):
+    """Écrire une archive GTFS au format de la SNCF, dont les colonnes ne
+    sont pas dans l'ordre habituel. Tous les trains circulent en semaine en
+    2018, sauf le mardi 6 mars, avec la période d'identifiant service.
+    stations associe à chaque identifiant de gare un tuple (nom, latitude,
+    longitude) ; trips est une liste de tuples (numéro de train, type de
+    train, arrêts), chaque arrêt étant un tuple (gare, heure HH:MM:SS)."""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        write_csv(archive, 'calendar.txt', [
+            'end_date', 'service_id', 'monday', 'tuesday', 'wednesday',
+            'thursday', 'friday', 'saturday', 'sunday', 'start_date'],
+            [['20181231', service, 1, 1, 1, 1, 1, 0, 0, '20180101']])
+        write_csv(archive, 'calendar_dates.txt',
+                  ['exception_type', 'date', 'service_id'],
+                  [[2, '20180306', service]])
+        write_csv(archive, 'routes.txt', ['route_id', 'route_type'],
+                  [['R', 2]])
+        write_csv(archive, 'stops.txt',
+                  ['stop_lon', 'stop_lat', 'stop_name', 'stop_id'],
+                  [[lng, lat, 'Gare de ' + name,
+                    'StopPoint:OCE' + traintype + '-' + str(station)]
+                   for station, (name, lat, lng) in sorted(stations.items())
+                   for traintype in sorted({t[1] for t in trips})] +
+                  [[lng, lat, name, 'StopArea:OCE' + str(station)]
+                   for station, (name, lat, lng) in stations.items()])
+        write_csv(archive, 'trips.txt',
+                  ['service_id', 'trip_headsign', 'route_id', 'trip_id'],
+                  [[service, number, 'R', 'trip' + str(number)]
+                   for number, _, _ in trips])
+        write_csv(archive, 'stop_times.txt', [
+            'stop_sequence', 'departure_time', 'stop_id', 'arrival_time',
+            'trip_id'],
+            [[sequence, when, 'StopPoint:OCE' + traintype + '-' +
+              str(station), when, 'trip' + str(number)]
+             for number, traintype, stops in trips
+             for sequence, (station, when) in enumerate(stops)])
+
+
+class NetworkTestCase(TestCase):
+    """
+    Réseau de test : le train 1 relie A à C en passant par B, le train 2
+    relie C à D après l'arrivée du train 1, en semaine uniquement. Chaque
+    train accepte trois passagers.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='voyageur')
+        cls.passengers = [
+            Passenger.objects.create(first_name=name, last_name='Test',
+                                     user=cls.user)
+            for name in ('Alice', 'Bob')]
+        cls.traintype = TrainType.objects.create(name='Train TER',
+                                                 km_price=0.1)
+        cls.period = Period.objects.create(
+            monday=True, tuesday=True, wednesday=True, thursday=True,
+            friday=True, saturday=False, sunday=False,
+            start_date=date(2018, 1, 1), end_date=date(2018, 12, 31))
+        cls.stations = {
+            name: Station.objects.create(name=name, lat=45 + i * 0.1,
+                                         lng=5 + i * 0.1)
+            for i, name in enumerate('ABCD')}
+        cls.train1 = cls.train(1, [('A', '08:00', '08:00'),
+                                   ('B', '08:30', '08:32'),
+                                   ('C', '09:00', '09:00')])
+        cls.train2 = cls.train(2, [('C', '09:20', '09:20'),
+                                   ('D', '10:00', '10:00')])
+        generation = TimetableGeneration.objects.create()
+        build_service_days(generation.id)
+        generation.activate()
+
+    @classmethod
+    def train(cls, number, stops):
+        """Créer un train et ses arrêts, donnés sous forme de triplets (gare,
+        heure d'arrivée, heure de départ)."""
+        t = Train.objects.create(number=number, period=cls.period,
+                                 traintype=cls.traintype, capacity=3)
+        for sequence, (station, arrival, departure) in enumerate(stops):
+            Halt.objects.create(
+                train=t, station=cls.stations[station], sequence=sequence,
+                arrival_s=seconds(arrival), departure_s=seconds(departure))
+        return t
+
+    def setUp(self):
+        # Les identifiants sont réutilisés d'un test à l'autre : rien ne doit
+        # être repris des recherches précédentes
+        timetable.invalidate()
+        search_module._cache.clear()
+        models._forget_current_generation()
+
+    def search(self, start, end, day, hour, passengers=1,
+               time_setting=TimeOptions.DEPART_AFTER):
+        """Rechercher un voyage entre deux gares du réseau de test."""
+        return search(self.stations[start], self.stations[end], day,
+                      time(hour=hour), self.passengers[:passengers],
+                      time_setting)
+
+    def legs(self, itinerary):
+        """Obtenir les étapes d'un itinéraire sous forme de triplets
+        (numéro du train, gare de départ, gare d'arrivée)."""
+        return [(t.start_halt.train.number, t.start_halt.station.name,
+                 t.end_halt.station.name) for t in itinerary.tickets]
+
+
+@override_settings(SEARCH_ENGINE='timetable')
+class SearchTest(NetworkTestCase):
+    """Recherche d'itinéraires avec le moteur d'horaires en mémoire."""
+
+    def test_direct(self):
+        results = self.search('A', 'C', MONDAY, 8)
+        self.assertEqual([self.legs(i) for i in results], [[(1, 'A', 'C')]])
+        self.assertEqual(results[0].start_time, time(8, 0))
+        self.assertEqual(results[0].end_time, time(9, 0))
+
+    def test_intermediate_stop(self):
+        results = self.search('B', 'C', MONDAY, 8)
+        self.assertEqual([self.legs(i) for i in results], [[(1, 'B', 'C')]])
+        self.assertEqual(results[0].start_time, time(8, 32))
+
+    def test_departure_window(self):
+        self.assertEqual(self.search('A', 'C', MONDAY, 11), [])
+        self.assertEqual(self.search('C', 'A', MONDAY, 8), [])
+
+    def test_service_day(self):
+        self.assertEqual(self.search('A', 'C', SATURDAY, 8), [])
+
+    def test_arrive_before(self):
+        results = self.search('A', 'C', MONDAY, 9,
+                              time_setting=TimeOptions.ARRIVE_BEFORE)
+        self.assertEqual([self.legs(i) for i in results], [[(1, 'A', 'C')]])
+        self.assertEqual(self.search('A', 'C', MONDAY, 13,
+                                     time_setting=TimeOptions.ARRIVE_BEFORE),
+                         [])
+
+    def test_transfer(self):
+        results = self.search('A', 'D', MONDAY, 8)
+        self.assertEqual([self.legs(i) for i in results],
+                         [[(1, 'A', 'C'), (2, 'C', 'D')]])
+
+    @override_settings(SEARCH_MAX_TRANSFERS=0)
+    def test_transfer_limit(self):
+        self.assertEqual(self.search('A', 'D', MONDAY, 8), [])
+
+    def test_arrive_before_transfer(self):
+        results = self.search('A', 'D', MONDAY, 10,
+                              time_setting=TimeOptions.ARRIVE_BEFORE)
+        self.assertEqual([self.legs(i) for i in results],
+                         [[(1, 'A', 'C'), (2, 'C', 'D')]])
+
+    def test_late_direct_train(self):
+        # Le train 3 arrive directement en D, trop tard : la correspondance
+        # avec le train 4, prise depuis le même départ, arrive à temps
+        self.train(3, [('A', '06:00', '06:00'), ('C', '07:00', '07:00'),
+                       ('D', '13:00', '13:00')])
+        self.train(4, [('C', '07:30', '07:30'), ('D', '08:30', '08:30')])
+        results = self.search('A', 'D', MONDAY, 8,
+                              time_setting=TimeOptions.ARRIVE_BEFORE)
+        self.assertIn([(3, 'A', 'C'), (4, 'C', 'D')],
+                      [self.legs(i) for i in results])
+
+    def test_long_ride(self):
+        # Départ bien avant la fenêtre d'arrivée
+        self.train(5, [('A', '00:30', '00:30'), ('D', '09:30', '09:30')])
+        results = self.search('A', 'D', MONDAY, 9,
+                              time_setting=TimeOptions.ARRIVE_BEFORE)
+        self.assertEqual([self.legs(i) for i in results], [[(5, 'A', 'D')]])
+
+
+@override_settings(SEARCH_ENGINE='sql')
+class SQLSearchTest(SearchTest):
+    """Recherche d'itinéraires avec les requêtes SQL, qui ne trouvent pas
+    plus d'une correspondance."""
+
+    @override_settings(SEARCH_MAX_TRANSFERS=2)
+    def test_two_transfers(self):
+        self.train(3, [('D', '10:20', '10:20'), ('A', '11:00', '11:00')])
+        self.assertEqual(self.search('B', 'A', MONDAY, 8), [])
+
+
+@override_settings(SEARCH_ENGINE='timetable', SEARCH_MAX_TRANSFERS=2)
+class TimetableTest(NetworkTestCase):
+    """Fonctionnement propre au moteur d'horaires en mémoire."""
+
+    def test_timetable_loaded_once(self):
+        self.search('A', 'C', MONDAY, 8)
+        generation = TimetableGeneration.current()
+        with self.assertNumQueries(0):
+            engine = timetable.get_timetable(generation)
+            engine.journeys(self.stations['A'].id, self.stations['C'].id,
+                            MONDAY, (seconds('07:00'), seconds('09:00')))
+
+    def test_two_transfers(self):
+        self.train(3, [('D', '10:20', '10:20'), ('A', '11:00', '11:00')])
+        results = self.search('B', 'A', MONDAY, 8)
+        self.assertEqual([self.legs(i) for i in results],
+                         [[(1, 'B', 'C'), (2, 'C', 'D'), (3, 'D', 'A')]])
+
+
+class ServiceDayTest(NetworkTestCase):
+    """Table des jours de service calculée à partir des périodes."""
+
+    def test_week(self):
+        self.assertTrue(self.period.includes_date(MONDAY))
+        self.assertFalse(self.period.includes_date(SATURDAY))
+        self.assertTrue(self.train1.runs(MONDAY))
+        self.assertFalse(self.train1.runs(SATURDAY))
+
+    def test_exceptions(self):
+        PeriodException.objects.create(period=self.period, date=MONDAY,
+                                       add_day=False)
+        PeriodException.objects.create(period=self.period, date=SATURDAY,
+                                       add_day=True)
+        generation = TimetableGeneration.objects.create()
+        build_service_days(generation.id)
+        generation.activate()
+        self.assertFalse(self.period.includes_date(MONDAY))
+        self.assertTrue(self.period.includes_date(SATURDAY))
+
+    def test_bounds(self):
+        # Les dates de début et de fin de la période sont exclues
+        dates = set(ServiceDay.objects.filter(
+            period=self.period).values_list('date', flat=True))
+        self.assertNotIn(date(2018, 1, 1), dates)
+        self.assertIn(date(2018, 1, 2), dates)
+        # 261 jours de semaine en 2018, dont les lundis 1er janvier et 31
+        # décembre
+        self.assertEqual(len(dates), 261 - 2)
+
+
+class SeatOccupancyTest(NetworkTestCase):
+    """Réservation des places dans le registre d'occupation."""
+
+    def book(self, start, end, passengers):
+        """Réserver un voyage direct dans le train 1. Renvoie le voyage et
+        le résultat de la réservation."""
+        halts = {h.station.name: h for h in self.train1.halt_set.all()}
+        travel = Itinerary(MONDAY, self.passengers[:passengers],
+                           [(halts[start], halts[end])]).save()
+        return travel, travel.book()
+
+    def occupancy(self):
+        """Obtenir le nombre de passagers du train 1 sur chaque tronçon."""
+        return dict(SeatOccupancy.objects.filter(
+            train=self.train1, date=MONDAY).values_list(
+            'sequence', 'passengers'))
+
+    def test_reserve(self):
+        travel, booked = self.book('A', 'C', 2)
+        self.assertTrue(booked)
+        self.assertTrue(Travel.objects.get(pk=travel.pk).booked)
+        self.assertEqual(self.occupancy(), {0: 2, 1: 2})
+
+    def test_overbooking(self):
+        self.book('A', 'C', 2)
+        travel, booked = self.book('A', 'B', 2)
+        self.assertFalse(booked)
+        self.assertFalse(Travel.objects.get(pk=travel.pk).booked)
+        self.assertEqual(self.occupancy(), {0: 2, 1: 2})
+        # Il reste une place sur chaque tronçon
+        self.assertTrue(self.book('B', 'C', 1)[1])
+        self.assertEqual(self.occupancy(), {0: 2, 1: 3})
+
+    def test_can_hold(self):
+        self.book('A', 'B', 2)
+        self.assertTrue(self.train1.can_hold(
+            self.train1.halt_set.get(sequence=1),
+            self.train1.halt_set.get(sequence=2), 3, MONDAY))
+        self.assertFalse(self.train1.can_hold(
+            self.train1.halt_set.get(sequence=0),
+            self.train1.halt_set.get(sequence=2), 2, MONDAY))
+        self.assertTrue(self.train1.can_hold(
+            self.train1.halt_set.get(sequence=0),
+            self.train1.halt_set.get(sequence=2), 3, SATURDAY))
+
+    def test_full_train_hidden_from_search(self):
+        self.book('A', 'C', 2)
+        self.book('B', 'C', 1)
+        self.assertEqual(self.search('A', 'C', MONDAY, 8), [])
+        self.assertEqual(len(self.search('A', 'B', MONDAY, 8)), 1)
+
+    def test_release(self):
+        travel, booked = self.book('A', 'C', 2)
+        travel.delete()
+        self.assertEqual(self.occupancy(), {0: 0, 1: 0})
+        self.assertTrue(self.book('A', 'C', 2)[1])
+
+
+class ItineraryTest(NetworkTestCase):
+    """Résultats de recherche transmis sous forme de jetons signés, et
+    enregistrés seulement lors de l'ajout au panier."""
+
+    def setUp(self):
+        super(ItineraryTest, self).setUp()
+        self.client.force_login(self.user)
+
+    def itinerary(self, day=MONDAY):
+        """Construire l'itinéraire direct de A à C dans le train 1."""
+        halts = list(self.train1.halt_set.all())
+        return Itinerary(day, self.passengers, [(halts[0], halts[2])])
+
+    def test_search_saves_nothing(self):
+        results = self.search('A', 'D', MONDAY, 8)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(Travel.objects.count(), 0)
+
+    def test_token(self):
+        itinerary = Itinerary.from_token(
+            self.itinerary().token, self.user.passenger_set.all())
+        self.assertEqual(self.legs(itinerary), [(1, 'A', 'C')])
+        self.assertEqual(itinerary.date, MONDAY)
+        self.assertEqual(itinerary.passengers, 2)
+
+    def test_invalid_token(self):
+        with self.assertRaises(BadSignature):
+            Itinerary.from_token(self.itinerary().token[:-2] + 'xx',
+                                 self.user.passenger_set.all())
+        with override_settings(SEARCH_RESULT_TTL=-1):
+            with self.assertRaises(BadSignature):
+                Itinerary.from_token(self.itinerary().token,
+                                     self.user.passenger_set.all())
+
+    def test_cart_add(self):
+        token = self.itinerary().token
+        response = self.client.get('/train/cart/add/' + token)
+        self.assertRedirects(response, '/train/cart',
+                             fetch_redirect_response=False)
+        self.client.get('/train/cart/add/' + token)
+        travel = Travel.objects.get()
+        self.assertFalse(travel.booked)
+        self.assertEqual(travel.passengers, 2)
+
+    def test_cart_add_refused(self):
+        response = self.client.get('/train/cart/add/invalide')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(
+            '/train/cart/add/' + self.itinerary(SATURDAY).token)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Travel.objects.count(), 0)
+
+    def test_order(self):
+        self.client.get('/train/cart/add/' + self.itinerary().token)
+        response = self.client.get('/train/order')
+        self.assertRedirects(response, '/train/tickets',
+                             fetch_redirect_response=False)
+        self.assertTrue(Travel.objects.get().booked)
+
+    def test_order_full_train(self):
+        self.client.get('/train/cart/add/' + self.itinerary().token)
+        other = User.objects.create(username='autre')
+        others = [Passenger.objects.create(first_name=name,
+                                           last_name='Test', user=other)
+                  for name in ('Chloé', 'David')]
+        halts = list(self.train1.halt_set.all())
+        Itinerary(MONDAY, others, [(halts[1], halts[2])]).save().book()
+        response = self.client.get('/train/order', follow=True)
+        self.assertRedirects(response, '/train/cart')
+        self.assertContains(response, "plus assez de places dans le " +
+                            str(self.train1))
+        self.assertFalse(Travel.objects.get(
+            passengers_aboard=self.passengers[0]).booked)
+
+
+@override_settings(SEARCH_ENGINE='timetable')
+class SearchCacheTest(NetworkTestCase):
+    """Cache des résultats de recherche par génération des horaires."""
+
+    def test_hit(self):
+        hits = search_module.cache_info()['hits']
+        self.search('A', 'C', MONDAY, 8)
+        self.search('A', 'C', MONDAY, 8, passengers=2)
+        info = search_module.cache_info()
+        self.assertEqual((info['hits'] - hits, info['size']), (1, 1))
+
+    def test_capacity_checked_on_hit(self):
+        self.search('A', 'C', MONDAY, 8)
+        halts = list(self.train1.halt_set.all())
+        Itinerary(MONDAY, self.passengers, [(halts[0], halts[2])]) \
+            .save().book()
+        self.assertEqual(self.search('A', 'C', MONDAY, 8, passengers=2), [])
+
+    def test_new_generation(self):
+        self.search('A', 'C', MONDAY, 8)
+        self.train(3, [('A', '08:10', '08:10'), ('C', '08:40', '08:40')])
+        generation = TimetableGeneration.objects.create()
+        build_service_days(generation.id)
+        generation.activate()
+        results = self.search('A', 'C', MONDAY, 8)
+        self.assertEqual([self.legs(i)[0][0] for i in results], [1, 3])
+        self.assertEqual(search_module.cache_info()['size'], 1)
+
+    def test_deleted_halt(self):
+        self.search('A', 'D', MONDAY, 8)
+        self.train2.delete()
+        self.assertEqual(self.search('A', 'D', MONDAY, 8), [])
+
+
+@override_settings(SEARCH_ENGINE='timetable')
+class SearchQueriesTest(NetworkTestCase):
+    """Chargement des voyages candidats en un nombre fixe de requêtes."""
+
+    def test_queries_independent_of_results(self):
+        def queries():
+            self.search('A', 'C', MONDAY, 8)
+            with CaptureQueriesContext(connection) as context:
+                results = self.search('A', 'C', MONDAY, 8)
+            return len(results), len(context)
+
+        count, few = queries()
+        for number in range(3, 8):
+            self.train(number, [('A', '08:10', '08:10'),
+                                ('B', '08:40', '08:40'),
+                                ('C', '09:10', '09:10')])
+        timetable.invalidate()
+        search_module._cache.clear()
+        self.assertEqual(queries(), (count + 5, few))
+
+
+class HaltSecondsTest(NetworkTestCase):
+    """Heures des arrêts en secondes depuis le début du jour de service,
+    complétées après la migration pour les arrêts existants."""
+
+    def test_displayed_times(self):
+        t = self.train(3, [('A', '23:50', '23:55'), ('B', '24:20', '24:25')])
+        halt = t.halt_set.get(sequence=1)
+        self.assertEqual((halt.arrival, halt.departure),
+                         (time(0, 20), time(0, 25)))
+
+    def test_backfill(self):
+        t = self.train(3, [('A', '22:00', '22:00'), ('B', '23:50', '23:55'),
+                           ('C', '24:20', '24:25'), ('D', '25:00', '25:00')])
+        expected = list(t.halt_set.values_list('arrival_s', 'departure_s'))
+        # Arrêts enregistrés avant l'ajout des colonnes
+        Halt.objects.update(arrival_s=0, departure_s=0)
+        self.assertEqual(backfill_halt_seconds(Halt), 9)
+        self.assertEqual(
+            list(t.halt_set.values_list('arrival_s', 'departure_s')),
+            expected)
+        self.assertEqual(list(self.train1.halt_set.values_list(
+            'departure_s', flat=True)),
+            [seconds('08:00'), seconds('08:32'), seconds('09:00')])
+        self.assertEqual(backfill_halt_seconds(Halt), 0)
+
+    def test_migrate(self):
+        Halt.objects.update(arrival_s=0, departure_s=0)
+        call_command('migrate', verbosity=0)
+        self.assertEqual(self.train2.halt_set.get(sequence=1).arrival_s,
+                         seconds('10:00'))
+
+
+class TravelSummaryTest(NetworkTestCase):
+    """Résumé des voyages enregistré lors de leur création."""
+
+    def travel(self):
+        """Enregistrer le voyage de A à D avec une correspondance en C."""
+        a, b, c = self.train1.halt_set.all()
+        d, e = self.train2.halt_set.all()
+        return Itinerary(MONDAY, self.passengers, [(a, c), (d, e)]).save()
+
+    def test_summary(self):
+        travel = Travel.objects.get(pk=self.travel().pk)
+        self.assertTrue(travel.summarized)
+        self.assertEqual(
+            (travel.departure_station, travel.arrival_station),
+            (self.stations['A'], self.stations['D']))
+        self.assertEqual((travel.departure_time, travel.arrival_time),
+                         (time(8, 0), time(10, 0)))
+        distance = self.stations['A'].distance_to(self.stations['C']) + \
+            self.stations['C'].distance_to(self.stations['D'])
+        self.assertAlmostEqual(travel.distance, distance)
+        self.assertAlmostEqual(travel.unit_price, distance * 0.1)
+        self.assertEqual(travel.passenger_count, 2)
+
+    def test_no_queries(self):
+        travel = Travel.objects.select_related(
+            'departure_station', 'arrival_station').get(pk=self.travel().pk)
+        with self.assertNumQueries(0):
+            travel.start_station, travel.end_station
+            travel.start_time, travel.end_time
+            travel.price, travel.total_distance, travel.passengers
+
+    def test_same_as_computed(self):
+        summarized = Travel.objects.get(pk=self.travel().pk)
+        Travel.objects.update(distance=None)
+        computed = Travel.objects.get(pk=summarized.pk)
+        self.assertFalse(computed.summarized)
+        for name in ('start_station', 'end_station', 'start_time',
+                     'end_time', 'passengers'):
+            self.assertEqual(getattr(computed, name),
+                             getattr(summarized, name))
+        self.assertAlmostEqual(computed.price, summarized.price)
+        self.assertAlmostEqual(computed.total_distance,
+                               summarized.total_distance)
+
+    def test_empty_travel(self):
+        travel = Travel.objects.create(date=MONDAY, booked=False)
+        travel.summarize()
+        self.assertFalse(travel.summarized)
+
+
+class RouteDistanceTest(NetworkTestCase):
+    """Prix des billets calculés sur la distance cumulée le long de
+    l'itinéraire des trains."""
+
+    def test_compute_halt_distances(self):
+        halts = list(self.train1.halt_set.all()) + \
+            list(self.train2.halt_set.all())
+        coords = {s.id: s.coords for s in self.stations.values()}
+        compute_halt_distances(reversed(halts), coords)
+        a, b, c, d, e = [h.distance for h in halts]
+        ab = self.stations['A'].distance_to(self.stations['B'])
+        bc = self.stations['B'].distance_to(self.stations['C'])
+        self.assertEqual(a, 0)
+        self.assertAlmostEqual(b, ab)
+        self.assertAlmostEqual(c, ab + bc)
+        # Le second train repart de zéro
+        self.assertEqual(d, 0)
+        self.assertAlmostEqual(
+            e, self.stations['C'].distance_to(self.stations['D']))
+
+    def test_ticket_uses_route(self):
+        start, middle, end = self.train1.halt_set.all()
+        Halt.objects.filter(pk=start.pk).update(distance=0)
+        Halt.objects.filter(pk=end.pk).update(distance=42)
+        start.refresh_from_db()
+        end.refresh_from_db()
+        ticket = Ticket(start_halt=start, end_halt=end)
+        self.assertEqual(ticket.distance, 42)
+        self.assertAlmostEqual(ticket.price, 4.2)
+        # Distance inconnue : à vol d'oiseau
+        ticket = Ticket(start_halt=start, end_halt=middle)
+        self.assertAlmostEqual(
+            ticket.distance,
+            self.stations['A'].distance_to(self.stations['B']))
+
+
+class FaresTest(TestCase):
+    """Calcul vectorisé des distances et des prix."""
+
+    def test_haversine_array(self):
+        points = [(5.0, 45.0, 2.35, 48.85), (-1.5, 43.5, 7.25, 43.7),
+                  (3.0, 50.0, 3.0, 50.0)]
+        distances = haversine_array(*zip(*points))
+        for point, distance in zip(points, distances):
+            self.assertAlmostEqual(distance, haversine(*point))
+
+    def test_fares(self):
+        start = [(45.0, 5.0), (48.85, 2.35)]
+        end = [(45.5, 5.5), (43.7, 7.25)]
+        distances, prices = fares(start, end, [0.1, 0.2],
+                                  [None, float('nan')])
+        self.assertAlmostEqual(distances[0], haversine(5.0, 45.0, 5.5, 45.5))
+        self.assertAlmostEqual(prices[1], distances[1] * 0.2)
+        distances, prices = fares(start, end, [0.1, 0.2], [10.0, None])
+        self.assertEqual(distances[0], 10.0)
+        self.assertAlmostEqual(prices[0], 1.0)
+
+    def test_ticket_fares(self):
+        station = Station(lat=45.0, lng=5.0)
+        other = Station(lat=45.1, lng=5.1)
+        traintype = TrainType(km_price=0.5)
+        train = Train(traintype=traintype)
+        tickets = [
+            Ticket(start_halt=Halt(station=station, train=train, distance=3),
+                   end_halt=Halt(station=other, train=train, distance=8)),
+            Ticket(start_halt=Halt(station=other, train=train),
+                   end_halt=Halt(station=station, train=train))]
+        distances, prices = Ticket.fares(tickets)
+        for ticket, distance, price in zip(tickets, distances, prices):
+            self.assertAlmostEqual(distance, ticket.distance)
+            self.assertAlmostEqual(price, ticket.price)
+
+
+class StationIndexTest(TestCase):
+    """Arbre k-d des gares, comparé à un parcours de toutes les gares."""
+
+    def setUp(self):
+        points = [(i, 'Gare ' + str(i), 42 + (i * 7 % 90) / 10,
+                   -4 + (i * 13 % 120) / 10) for i in range(300)]
+        # Gares de part et d'autre du méridien 180
+        points += [(300, 'Est', 0, 179.9), (301, 'Ouest', 0, -179.9)]
+        self.index = StationIndex(points)
+        self.points = points
+
+    def brute_force(self, lat, lng):
+        """Trier toutes les gares par distance à une position."""
+        return sorted([p + (haversine(lng, lat, p[3], p[2]),)
+                       for p in self.points], key=lambda p: p[4])
+
+    def test_nearest(self):
+        for lat, lng in ((45.0, 5.0), (48.85, 2.35), (60.0, -10.0)):
+            expected = self.brute_force(lat, lng)[:10]
+            found = self.index.nearest(lat, lng, 10)
+            self.assertEqual([s[0] for s in found],
+                             [s[0] for s in expected])
+            for s, e in zip(found, expected):
+                self.assertAlmostEqual(s[4], e[4], places=6)
+
+    def test_within(self):
+        expected = [s[0] for s in self.brute_force(45.0, 5.0)
+                    if s[4] <= 50]
+        self.assertEqual([s[0] for s in self.index.within(45.0, 5.0, 50)],
+                         expected)
+        self.assertEqual(self.index.within(45.05, 5.05, 0.001), [])
+
+    def test_antimeridian(self):
+        found = self.index.nearest(0, 180, 2)
+        self.assertEqual({s[0] for s in found}, {300, 301})
+        self.assertLess(found[1][4], 25)
+
+    def test_empty(self):
+        self.assertEqual(StationIndex([]).nearest(45.0, 5.0), [])
+        self.assertEqual(self.index.nearest(45.0, 5.0, 0), [])
+
+    def test_clusters(self):
+        # Sur toute la carte, chaque gare est comptée une fois par niveau
+        for zoom in range(spatial.CLUSTER_MAX_ZOOM + 1):
+            found = self.index.clusters(-85, -180, 85, 180, zoom)
+            self.assertEqual(sum([c[2] for c in found]), len(self.points))
+        self.assertLess(len(self.index.clusters(-85, -180, 85, 180, 3)),
+                        len(self.index.clusters(-85, -180, 85, 180, 8)))
+        found = self.index.clusters(-85, -180, 85, 180,
+                                    spatial.CLUSTER_MAX_ZOOM + 5)
+        self.assertEqual(sorted([c[3] for c in found]), self.points)
+
+    def test_clusters_bbox(self):
+        found = self.index.clusters(44, 0, 46, 3, spatial.CLUSTER_MAX_ZOOM)
+        self.assertEqual(sorted([c[3][0] for c in found]),
+                         [p[0] for p in self.points
+                          if 44 <= p[2] <= 46 and 0 <= p[3] <= 3])
+        self.assertEqual(self.index.clusters(10, 20, 20, 30, 5), [])
+
+    def test_clusters_antimeridian(self):
+        found = self.index.clusters(-1, 179, 1, -179,
+                                    spatial.CLUSTER_MAX_ZOOM)
+        self.assertEqual({c[3][0] for c in found}, {300, 301})
+
+
+class StationsNearTest(NetworkTestCase):
+    """Point d'accès des gares les plus proches d'une position."""
+
+    def setUp(self):
+        super(StationsNearTest, self).setUp()
+        spatial.invalidate()
+
+    def get(self, **params):
+        """Appeler le point d'accès avec des paramètres donnés."""
+        return self.client.get('/train/stations/near.json', params)
+
+    def test_nearest(self):
+        response = self.get(lat=45.08, lng=5.08, k=2)
+        self.assertEqual([s['label'] for s in response.json()], ['B', 'A'])
+
+    def test_radius(self):
+        response = self.get(lat=45.0, lng=5.0, radius=20)
+        self.assertEqual([s['label'] for s in response.json()], ['A', 'B'])
+        self.assertEqual(response.json()[0]['distance'], 0)
+
+    def test_invalid(self):
+        for params in ({'lat': 45}, {'lat': 'x', 'lng': 5},
+                       {'lat': 'nan', 'lng': 5}, {'lat': 45, 'lng': 'inf'},
+                       {'lat': 45, 'lng': 5, 'radius': -30},
+                       {'lat': 45, 'lng': 5, 'radius': 0},
+                       {'lat': 45, 'lng': 5, 'radius': 'nan'},
+                       {'lat': 45, 'lng': 5, 'k': 0},
+                       {'lat': 45, 'lng': 5, 'k': -3}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+
+    def test_new_station(self):
+        self.get(lat=45.0, lng=5.0, k=1)
+        Station.objects.create(name='E', lat=44.0, lng=4.0)
+        generation = TimetableGeneration.objects.create()
+        generation.activate()
+        response = self.get(lat=44.0, lng=4.0, k=1)
+        self.assertEqual(response.json()[0]['label'], 'E')
+
+
+class StationNamesTest(TestCase):
+    """Index des noms de gares pour l'autocomplétion."""
+
+    def setUp(self):
+        self.names = StationNames([
+            (1, 'Paris Saint-Lazare'), (2, 'Paris Gare de Lyon'),
+            (3, 'Lyon Part-Dieu'), (4, 'Gare de Évian-les-Bains'),
+            (5, 'Saint-Étienne Châteaucreux'), (6, 'Lyon Perrache')])
+
+    def test_lookup(self):
+        self.assertEqual(self.names.lookup('Paris Saint-Lazare'), 1)
+        self.assertEqual(self.names.lookup('paris saint lazare'), 1)
+        self.assertEqual(self.names.lookup('evian les bains'), 4)
+        self.assertEqual(self.names.lookup('Gare de Évian-les-Bains'), 4)
+        self.assertIsNone(self.names.lookup('Marseille'))
+
+    def test_prefix(self):
+        self.assertEqual([n for _, n in self.names.complete('lyon')],
+                         ['Lyon Perrache', 'Lyon Part-Dieu',
+                          'Paris Gare de Lyon'])
+        self.assertEqual(self.names.complete('lyon', k=1),
+                         [(6, 'Lyon Perrache')])
+
+    def test_word(self):
+        self.assertEqual(self.names.complete('lazare'),
+                         [(1, 'Paris Saint-Lazare')])
+        self.assertEqual(self.names.complete('SAINT'),
+                         [(5, 'Saint-Étienne Châteaucreux'),
+                          (1, 'Paris Saint-Lazare')])
+
+    def test_typo(self):
+        self.assertEqual(self.names.complete('perache')[0],
+                         (6, 'Lyon Perrache'))
+
+    def test_nothing(self):
+        self.assertEqual(self.names.complete(''), [])
+        self.assertEqual(self.names.complete('--'), [])
+        self.assertEqual(self.names.complete('xyzxyz'), [])
+
+
+class StationSearchFormTest(NetworkTestCase):
+    """Saisie des gares dans le formulaire de recherche."""
+
+    def setUp(self):
+        super(StationSearchFormTest, self).setUp()
+        autocomplete.invalidate()
+        self.client.force_login(self.user)
+
+    def post(self, start, end):
+        """Envoyer le formulaire de recherche."""
+        return self.client.post('/train/search', {
+            'startStation': start, 'endStation': end,
+            'travelDate': MONDAY.isoformat(), 'timeOptions': 'DEPART_AFTER',
+            'hour': '8', 'passengers': [str(self.passengers[0].id)]})
+
+    def test_complete_json(self):
+        response = self.client.get('/train/stations/complete.json',
+                                   {'q': 'b'})
+        self.assertEqual(response.json(),
+                         [{'id': self.stations['B'].id, 'label': 'B'}])
+        self.assertEqual(self.client.get('/train/stations/complete.json',
+                                         {'q': 'b', 'k': 'x'}).status_code,
+                         400)
+
+    def test_search(self):
+        response = self.post('a', 'C')
+        self.assertTemplateUsed(response, 'main/searchResult.html')
+        self.assertEqual(len(response.context['results']), 1)
+
+    def test_unknown_station(self):
+        response = self.post('A', 'Z')
+        self.assertTemplateUsed(response, 'main/search.html')
+        self.assertContains(response, "La gare de Z n&#39;existe pas.")
+
+    def test_stale_index(self):
+        autocomplete.get_index()
+        # Gare supprimée sans que l'index soit reconstruit
+        Station.objects.create(name='Z', lat=40, lng=2).delete()
+        autocomplete._index.exact['Z'] = 999
+        response = self.post('A', 'Z')
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'main/search.html')
+        self.assertContains(response, "La gare de Z n&#39;existe pas.")
+        self.assertIsNone(autocomplete._index)
+
+
+class ArtifactTest(NetworkTestCase):
+    """Carte des gares précalculée et servie avec son ETag."""
+
+    def setUp(self):
+        super(ArtifactTest, self).setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(STATION_ARTIFACTS_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.directory = directory.name
+        artifacts._manifest = (None, {})
+
+    def read(self, name):
+        """Lire un fichier précalculé."""
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return f.read()
+
+    def get(self, version, **headers):
+        """Télécharger une version de la carte des gares."""
+        return self.client.get('/train/stations.' + version + '.geojson',
+                               **headers)
+
+    def test_build(self):
+        digest = artifacts.build_artifacts()['stations.geojson']
+        data = self.read('stations.geojson')
+        self.assertEqual(len(json.loads(data.decode())['features']), 4)
+        self.assertEqual(gzip.decompress(self.read('stations.geojson.gz')),
+                         data)
+        compressed = self.read('stations.geojson.gz')
+        self.assertEqual(artifacts.build_artifacts()['stations.geojson'],
+                         digest)
+        self.assertEqual(self.read('stations.geojson.gz'), compressed)
+        Station.objects.create(name='E', lat=46, lng=6)
+        self.assertNotEqual(artifacts.build_artifacts()['stations.geojson'],
+                            digest)
+
+    def test_download(self):
+        response = self.client.get('/train/map')
+        digest = artifacts.get_artifact('stations.geojson')[0]
+        self.assertEqual(response.context['download_url'],
+                         '/train/stations.' + digest + '.geojson')
+        response = self.get(digest)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.read('stations.geojson'))
+        self.assertEqual(response['ETag'], '"' + digest + '"')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_not_modified(self):
+        digest = artifacts.get_artifact('stations.geojson')[0]
+        response = self.get(digest, HTTP_IF_NONE_MATCH='"' + digest + '"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"' + digest + '"')
+
+    def test_gzip(self):
+        digest = artifacts.get_artifact('stations.geojson')[0]
+        response = self.get(digest, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['ETag'], '"' + digest + '-gz"')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.read('stations.geojson.gz'))
+        self.assertEqual(self.get(digest, HTTP_ACCEPT_ENCODING='gzip',
+                                  HTTP_IF_NONE_MATCH='"' + digest + '"')
+                         .status_code, 200)
+
+    def test_old_version(self):
+        artifacts.get_artifact('stations.geojson')
+        response = self.get('0123456789abcdef')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+
+    def test_missing_file(self):
+        digest = artifacts.get_artifact('stations.geojson')[0]
+        os.remove(os.path.join(self.directory, 'stations.geojson'))
+        response = self.get(digest)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(len(json.loads(response.content.decode())
+                             ['features']), 4)
+
+    def test_removed_lists(self):
+        self.assertEqual(self.client.get('/train/stations.json')
+                         .status_code, 404)
+        self.assertEqual(self.client.get('/train/stations.geojson')
+                         .status_code, 404)
+
+
+class StationsMapTest(NetworkTestCase):
+    """Point d'accès des gares visibles sur la carte."""
+
+    def setUp(self):
+        super(StationsMapTest, self).setUp()
+        spatial.invalidate()
+
+    def get(self, **params):
+        """Appeler le point d'accès avec des paramètres donnés."""
+        return self.client.get('/train/stations/map.geojson', params)
+
+    def test_stations(self):
+        response = self.get(bbox='4.9,44.9,5.25,45.25', zoom=14)
+        self.assertEqual(
+            sorted([(f['properties']['title'], f['properties']['count'])
+                    for f in response.json()['features']]),
+            [('A', 1), ('B', 1), ('C', 1)])
+
+    def test_cluster(self):
+        features = self.get(bbox='0,40,10,50', zoom=2).json()['features']
+        self.assertEqual([f['properties'] for f in features], [{'count': 4}])
+
+    def test_invalid(self):
+        for params in ({'zoom': 5}, {'bbox': '0,40,10,50'},
+                       {'bbox': '0,40,10', 'zoom': 5},
+                       {'bbox': '0,40,10,50', 'zoom': 'x'}):
+            self.assertEqual(self.get(**params).status_code, 400)
+
+
+class GtfsTripsTest(TestCase):
+    """Lecture des voyages en un seul passage sur stop_times.txt."""
+
+    def setUp(self):
+        self.trips = [
+            {'trip_id': 'T1', 'trip_headsign': '101', 'service_id': '7'},
+            {'trip_id': 'T2', 'trip_headsign': '102', 'service_id': '8'}]
+        self.stop_times = [
+            self.stop_time('T1', 'TER', 1, '08:00:00', 1),
+            self.stop_time('T1', 'TER', 3, '09:00:00', 3),
+            self.stop_time('T1', 'TER', 2, '08:30:00', 2),
+            self.stop_time('T0', 'TER', 1, '07:00:00', 1),
+            self.stop_time('T2', 'Intercités', 3, '23:50:00', 1),
+            self.stop_time('T2', 'Intercités', 4, '24:20:00', 2)]
+
+    def stop_time(self, trip, traintype, station, when, sequence):
+        """Construire une ligne de stop_times.txt."""
+        return {'trip_id': trip, 'arrival_time': when,
+                'departure_time': when, 'stop_sequence': str(sequence),
+                'stop_id': 'StopPoint:OCE' + traintype + '-' + str(station)}
+
+    def test_trips(self):
+        trains = list(parse_gtfs_trains(self.trips, self.stop_times))
+        self.assertEqual([t[1:] for t in trains], [
+            (101, 7, 'TER', [(1, seconds('08:00'), seconds('08:00'), 1),
+                             (2, seconds('08:30'), seconds('08:30'), 2),
+                             (3, seconds('09:00'), seconds('09:00'), 3)]),
+            (102, 8, 'Intercités',
+             [(3, seconds('23:50'), seconds('23:50'), 1),
+              (4, 86400 + seconds('00:20'), 86400 + seconds('00:20'), 2)])])
+        for train in trains:
+            self.assertEqual(train[0], trip_fingerprint(*train[1:]))
+
+    def test_streaming(self):
+        read = []
+
+        def stop_times():
+            for stop_time in self.stop_times:
+                read.append(stop_time)
+                yield stop_time
+
+        trains = parse_gtfs_trains(self.trips, stop_times())
+        self.assertEqual(next(trains)[1], 101)
+        # Seules les lignes du premier voyage et la suivante ont été lues
+        self.assertEqual(len(read), 4)
+        self.assertEqual(next(trains)[1], 102)
+        self.assertEqual(len(read), 6)
+
+    def test_unsorted(self):
+        with self.assertRaises(ValueError):
+            list(parse_gtfs_trains(self.trips, self.stop_times +
+                                   [self.stop_time('T1', 'TER', 4,
+                                                   '09:30:00', 4)]))
+
+
+class GtfsArchiveTest(TestCase):
+    """Lecture des fichiers d'une archive GTFS sans extraction."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, 'ter.zip')
+        write_gtfs(self.path, {1: ('Grenoble', 45.19, 5.71),
+                               2: ('Lyon', 45.76, 4.86)},
+                   [(1, 'TER', [(1, '08:00:00'), (2, '09:30:00')])])
+
+    def read(self, part):
+        """Lire une partie de l'archive."""
+        with redirect_stdout(io.StringIO()):
+            return read_gtfs_part(self.path, part, self.directory)
+
+    def test_columns(self):
+        with zipfile.ZipFile(self.path) as archive:
+            line = next(read_gtfs_csv(archive, 'stops.txt'))
+        self.assertEqual(line, {'stop_id': 'StopPoint:OCETER-1',
+                                'stop_name': 'Gare de Grenoble',
+                                'stop_lat': '45.19', 'stop_lon': '5.71'})
+
+    def test_calendar(self):
+        periods, exceptions = self.read('calendar')
+        self.assertEqual(list(periods), [1])
+        self.assertTrue(periods[1]['friday'])
+        self.assertFalse(periods[1]['saturday'])
+        self.assertEqual(periods[1]['start_date'], date(2018, 1, 1))
+        self.assertEqual(exceptions, [(1, date(2018, 3, 6), False)])
+
+    def test_stops(self):
+        traintypes, stations = self.read('stops')
+        self.assertEqual(traintypes, {'TER'})
+        self.assertEqual(stations, {1: ('Grenoble', 45.19, 5.71),
+                                    2: ('Lyon', 45.76, 4.86)})
+
+    def test_no_extraction(self):
+        self.read('stops')
+        self.assertEqual(os.listdir(self.directory), ['ter.zip'])
+
+
+class GtfsFeedsTest(TestCase):
+    """Lecture de plusieurs archives, en parallèle ou non."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        stations = {i: ('Gare ' + str(i), 45 + i / 10, 5) for i in range(6)}
+        self.paths = []
+        for name, traintype, offset in (('ter', 'TER', 0),
+                                        ('ic', 'Intercités', 100)):
+            self.paths.append(os.path.join(self.directory, name + '.zip'))
+            write_gtfs(self.paths[-1], stations, [
+                (offset + n, traintype,
+                 [(n % 6, '08:%02d:00' % n), ((n + 1) % 6, '09:%02d:00' % n)])
+                for n in range(1, 8)], service=offset + 1)
+
+    def read(self, workers):
+        """Lire les deux archives avec un nombre de processus donné.
+        Renvoie les données de chaque archive, voyages compris."""
+        spool = tempfile.mkdtemp(dir=self.directory)
+        with override_settings(GTFS_IMPORT_WORKERS=workers):
+            with redirect_stdout(io.StringIO()):
+                feeds = gtfs_parser.read_gtfs_feeds(self.paths, spool)
+        for feed in feeds:
+            self.assertTrue(feed['trips'].startswith(spool))
+            feed['trips'] = list(gtfs_parser.read_spooled_trains(
+                feed['trips']))
+        return feeds
+
+    def test_feeds(self):
+        feeds = self.read(1)
+        self.assertEqual([list(f['calendar'][0]) for f in feeds],
+                         [[1], [101]])
+        self.assertEqual([f['stops'][0] for f in feeds],
+                         [{'TER'}, {'Intercités'}])
+        self.assertEqual([[t[1] for t in f['trips']] for f in feeds],
+                         [list(range(1, 8)), list(range(101, 108))])
+
+    def test_workers(self):
+        self.assertEqual(self.read(2), self.read(1))
+
+    def test_spool(self):
+        self.addCleanup(setattr, gtfs_parser, 'TRIP_BATCH_SIZE',
+                        gtfs_parser.TRIP_BATCH_SIZE)
+        gtfs_parser.TRIP_BATCH_SIZE = 3
+        trains = [(str(n), n) for n in range(7)]
+        path = gtfs_parser.spool_trains(iter(trains), self.directory)
+        with open(path, 'rb') as f:
+            self.assertEqual([len(pickle.load(f)) for _ in range(3)],
+                             [3, 3, 1])
+            self.assertEqual(f.read(), b'')
+        self.assertEqual(list(gtfs_parser.read_spooled_trains(path)),
+                         trains)
+
+
+class ReimportTest(NetworkTestCase):
+    """Importation des trains GTFS sous forme de différences avec la
+    génération précédente."""
+
+    def trip(self, number, stops):
+        """Construire un voyage tel que lu par parse_gtfs_trains()."""
+        stops = [(self.stations[station].id, seconds(arrival),
+                  seconds(departure), sequence)
+                 for sequence, (station, arrival, departure)
+                 in enumerate(stops)]
+        trip = (number, self.period.id, self.traintype.name, stops)
+        return (trip_fingerprint(*trip),) + trip
+
+    def save(self, trips, base):
+        """Importer des voyages dans une nouvelle génération des horaires,
+        à partir de la génération base. Renvoie la génération et le compte
+        rendu de save_trains()."""
+        generation = TimetableGeneration.objects.create().id
+        with redirect_stdout(io.StringIO()):
+            result = gtfs_parser.save_trains(iter(trips), base, generation)
+        return generation, result
+
+    def setUp(self):
+        super(ReimportTest, self).setUp()
+        self.trips = [self.trip(10, [('A', '12:00', '12:00'),
+                                     ('D', '13:00', '13:00')]),
+                      self.trip(11, [('D', '14:00', '14:00'),
+                                     ('A', '15:00', '15:00')])]
+        self.base, result = self.save(self.trips, 0)
+        self.assertEqual(result['inserted'], 2)
+
+    def test_unchanged(self):
+        trains = Train.objects.count()
+        generation, result = self.save(self.trips, self.base)
+        self.assertEqual(list(result.items()), [
+            ('inserted', 0), ('unchanged', 2), ('retired', 0),
+            ('skipped', 0)])
+        self.assertEqual(Train.objects.count(), trains)
+        self.assertEqual(Train.objects.filter(
+            Train.in_generation(generation), number__in=[10, 11]).count(), 2)
+
+    def test_changed(self):
+        trips = [self.trips[0], self.trip(11, [('D', '14:05', '14:05'),
+                                               ('A', '15:00', '15:00')])]
+        generation, result = self.save(trips, self.base)
+        self.assertEqual(list(result.items()), [
+            ('inserted', 1), ('unchanged', 1), ('retired', 1),
+            ('skipped', 0)])
+        departures = Halt.objects.filter(
+            Train.in_generation(generation, 'train__'),
+            train__number=11, sequence=0).values_list(
+            'departure_s', flat=True)
+        self.assertEqual(list(departures), [seconds('14:05')])
+        # Le train modifié reste dans la génération précédente
+        self.assertEqual(Train.objects.filter(
+            Train.in_generation(self.base), number=11).count(), 1)
+
+    def test_unknown(self):
+        trips = self.trips + [self.trip(12, [('A', '16:00', '16:00'),
+                                             ('B', '16:30', '16:30')])]
+        trips[2] = trips[2][:3] + ('TGV',) + trips[2][4:]
+        trips.append(self.trip(13, [('A', '17:00', '17:00')]))
+        trips[3][4][0] = (99999,) + trips[3][4][0][1:]
+        out = io.StringIO()
+        generation = TimetableGeneration.objects.create().id
+        with redirect_stdout(out):
+            result = gtfs_parser.save_trains(iter(trips), self.base,
+                                             generation)
+        self.assertEqual(list(result.values()), [0, 2, 0, 2])
+        self.assertIn("skipped 2 trips", out.getvalue())
+        self.assertIn("(trains 12, 13)", out.getvalue())
+        self.assertFalse(Train.objects.filter(number__in=[12, 13]).exists())
+
+
+class ImportTestCase(TestCase):
+    """
+    Importations d'archives GTFS de test : les archives, les fichiers
+    précalculés et les archives envoyées sont écrits dans un dossier
+    temporaire.
+    """
+
+    ## Gares des archives de test.
+    STATIONS = {87001: ('Grenoble', 45.19, 5.71),
+                87002: ('Voiron', 45.36, 5.59),
+                87003: ('Lyon', 45.76, 4.86)}
+    ## Voyages des archives de test.
+    TRIPS = [(1, 'TER', [(87001, '08:00:00'), (87002, '08:20:00'),
+                         (87003, '09:30:00')]),
+             (2, 'TER', [(87003, '18:00:00'), (87001, '19:30:00')])]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings = override_settings(
+            STATION_ARTIFACTS_DIR=os.path.join(self.directory, 'artifacts'),
+            GTFS_IMPORT_UPLOAD_DIR=os.path.join(self.directory, 'uploads'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        artifacts._manifest = (None, {})
+        timetable.invalidate()
+        search_module._cache.clear()
+        models._forget_current_generation()
+        self.passenger = Passenger.objects.create(
+            first_name='Alice', last_name='Test',
+            user=User.objects.create(username='voyageur'))
+
+    def archive(self, trips=None, stations=None, name='ter.zip'):
+        """Écrire une archive GTFS contenant des voyages donnés.
+        Renvoie son chemin d'accès."""
+        path = os.path.join(self.directory, name)
+        write_gtfs(path, stations or self.STATIONS, trips or self.TRIPS)
+        return path
+
+
+class GtfsImportTest(ImportTestCase):
+    """Importation complète d'archives GTFS."""
+
+    def parse(self, trips=None, stations=None, name='ter.zip'):
+        """Importer une archive GTFS contenant des voyages donnés.
+        Renvoie le compte rendu de parse_gtfs_sncf()."""
+        path = self.archive(trips, stations, name)
+        with redirect_stdout(io.StringIO()):
+            return gtfs_parser.parse_gtfs_sncf(path)
+
+    def search(self, day):
+        """Rechercher un voyage de Grenoble à Lyon."""
+        return search(Station.objects.get(id=87001),
+                      Station.objects.get(id=87003), day, time(7),
+                      [self.passenger])
+
+    def test_import(self):
+        delta = self.parse()
+        self.assertEqual(json.loads(json.dumps(delta)), {
+            'periods': {'inserted': 1, 'updated': 0, 'unchanged': 0},
+            'stations': {'inserted': 3, 'unchanged': 0},
+            'trains': {'inserted': 2, 'unchanged': 0, 'retired': 0,
+                       'skipped': 0}})
+        generation = TimetableGeneration.current()
+        self.assertEqual(Train.objects.filter(
+            Train.in_generation(generation)).count(), 2)
+        self.assertEqual(Station.objects.get(id=87002).name, 'Voiron')
+        self.assertEqual([[t.start_halt.train.number for t in i.tickets]
+                          for i in self.search(MONDAY)], [[1]])
+        # Exception du mardi 6 mars
+        self.assertEqual(self.search(date(2018, 3, 6)), [])
+
+    def test_reimport(self):
+        self.parse()
+        delta = self.parse()
+        self.assertEqual(delta['periods']['unchanged'], 1)
+        self.assertEqual(delta['stations']['unchanged'], 3)
+        self.assertEqual(list(delta['trains'].values()), [0, 2, 0, 0])
+        self.assertEqual(Train.objects.count(), 2)
+
+    def test_changed_trip(self):
+        self.parse()
+        trips = [self.TRIPS[0], (2, 'TER', [(87003, '18:05:00'),
+                                            (87001, '19:30:00')])]
+        delta = self.parse(trips)
+        self.assertEqual(list(delta['trains'].values()), [1, 1, 1, 0])
+        self.assertEqual(Halt.objects.filter(
+            Train.in_generation(TimetableGeneration.current(), 'train__'),
+            train__number=2, sequence=0).get().departure_s, seconds('18:05'))
+
+    def test_report(self):
+        self.parse()
+        report = ImportRun.objects.get().report()
+        self.assertTrue(report['success'])
+        self.assertEqual(report['sources'], ['ter.zip'])
+        self.assertEqual(report['generation'], TimetableGeneration.current())
+        self.assertEqual(report['delta']['trains']['inserted'], 2)
+        self.assertEqual(
+            [s['name'] for s in report['stages'] if s['source']],
+            gtfs_parser.ARCHIVE_STAGES)
+        self.assertEqual(
+            [s['name'] for s in report['stages'] if not s['source']],
+            gtfs_parser.IMPORT_STAGES)
+        self.assertEqual([s['rows'] for s in report['stages']
+                          if s['name'] == 'trips'], [5])
+
+    def test_unknown_station(self):
+        delta = self.parse(self.TRIPS + [(3, 'TER', [(87001, '10:00:00'),
+                                                     (87999, '11:00:00')])])
+        self.assertEqual(list(delta['trains'].values()), [2, 0, 0, 1])
+        self.assertEqual(json.loads(ImportRun.objects.get().delta)
+                         ['trains']['skipped'], 1)
+
+    def test_rollback(self):
+        self.parse()
+        first = TimetableGeneration.current()
+        self.parse([self.TRIPS[0], (2, 'TER', [(87003, '18:05:00'),
+                                               (87001, '19:30:00')])])
+        second = TimetableGeneration.current()
+        self.assertEqual(TimetableGeneration.objects.get(id=first).status,
+                         TimetableGeneration.STANDBY)
+        call_command('rollbacktimetable', stdout=io.StringIO())
+        models._forget_current_generation()
+        self.assertEqual(TimetableGeneration.current(), first)
+        self.assertEqual(TimetableGeneration.objects.get(id=second).status,
+                         TimetableGeneration.DISCARDED)
+        self.assertEqual(Halt.objects.filter(
+            Train.in_generation(first, 'train__'),
+            train__number=2, sequence=0).get().departure_s, seconds('18:00'))
+        with self.assertRaises(CommandError):
+            call_command('rollbacktimetable', stdout=io.StringIO())
+
+    def test_invalid_generation(self):
+        self.parse()
+        first = TimetableGeneration.current()
+        with self.assertRaises(ValueError):
+            self.parse([(1, 'TER', [(87001, '08:00:00'),
+                                    (87999, '09:00:00')])])
+        self.assertEqual(TimetableGeneration.current(), first)
+        self.assertEqual(
+            TimetableGeneration.objects.exclude(id=first).get().status,
+            TimetableGeneration.FAILED)
+        self.assertEqual(
+            list(ImportRun.objects.order_by('id').values_list(
+                'status', flat=True)),
+            [ImportRun.SUCCEEDED, ImportRun.FAILED])
+
+
+class TimetableGenerationTest(NetworkTestCase):
+    """Générations des horaires et jours de service."""
+
+    def test_runs_on(self):
+        generation = TimetableGeneration.current()
+        self.assertEqual(Train.objects.filter(
+            Train.runs_on(MONDAY, generation)).count(), 2)
+        self.assertFalse(Train.objects.filter(
+            Train.runs_on(SATURDAY, generation)).exists())
+        # Les jours de service d'une autre génération ne comptent pas
+        self.assertFalse(Train.objects.filter(
+            Train.runs_on(MONDAY, generation + 1)).exists())
+
+    def test_activate(self):
+        first = TimetableGeneration.current()
+        second = TimetableGeneration.objects.create()
+        second.activate()
+        self.assertEqual(TimetableGeneration.current(), second.id)
+        self.assertEqual(TimetableGeneration.standby(), first)
+        self.assertEqual(TimetableGeneration.rollback(), first)
+        self.assertEqual(TimetableGeneration.current(), first)
+        self.assertIsNone(TimetableGeneration.rollback())
+
+    def test_backfill(self):
+        # Horaires importés avant l'ajout des générations
+        TimetableGeneration.objects.all().delete()
+        self.assertFalse(TimetableGeneration.current())
+        self.assertEqual(backfill_service_days(), 259)
+        generation = TimetableGeneration.current()
+        self.assertEqual(Train.objects.filter(
+            Train.runs_on(MONDAY, generation)).count(), 2)
+        self.assertEqual(backfill_service_days(), 0)
+
+    def test_backfill_empty(self):
+        TimetableGeneration.objects.all().delete()
+        Train.objects.all().delete()
+        self.assertEqual(backfill_service_days(), 0)
+        self.assertFalse(TimetableGeneration.current())
+
+
+class TelemetryTest(TestCase):
+    """Mesures des étapes de l'importation."""
+
+    def setUp(self):
+        telemetry.collect()
+        self.events = []
+        telemetry.listen(lambda *event: self.events.append(event))
+        self.addCleanup(telemetry.listen, None)
+
+    def test_stage(self):
+        with telemetry.stage('stops', 'ter.zip') as s:
+            list(s.count(range(telemetry.PROGRESS_ROWS + 5)))
+        with telemetry.stage('write_stations') as s:
+            s.rows = 3
+        stages = telemetry.collect()
+        self.assertEqual([(s['name'], s['source'], s['rows'])
+                          for s in stages],
+                         [('stops', 'ter.zip', telemetry.PROGRESS_ROWS + 5),
+                          ('write_stations', None, 3)])
+        self.assertIsNone(stages[0]['peak_memory'])
+        self.assertEqual(telemetry.collect(), [])
+        self.assertEqual(self.events, [
+            ('stops', 0, False), ('stops', telemetry.PROGRESS_ROWS, False),
+            ('stops', telemetry.PROGRESS_ROWS + 5, True),
+            ('write_stations', 0, False), ('write_stations', 3, True)])
+        self.assertRegex(telemetry.format_stage(stages[0]),
+                         r'^stops \(ter\.zip\): [0-9.]+ s, 10005 rows, '
+                         r'[0-9]+ rows/s$')
+
+    def test_failed_stage(self):
+        with self.assertRaises(ZeroDivisionError):
+            with telemetry.stage('calendar'):
+                1 / 0
+        self.assertEqual(len(telemetry.collect()), 1)
+        self.assertEqual(self.events, [('calendar', 0, False)])
+
+    def test_record(self):
+        telemetry.record([{'name': 'trips', 'rows': 7}])
+        self.assertEqual(telemetry.collect(), [{'name': 'trips', 'rows': 7}])
+        self.assertEqual(self.events, [('trips', 7, True)])
+
+    @override_settings(GTFS_IMPORT_TRACE_MEMORY=True)
+    def test_memory(self):
+        with telemetry.stage('trips'):
+            data = bytearray(1 << 20)
+        del data
+        self.assertGreaterEqual(telemetry.collect()[0]['peak_memory'],
+                                1 << 20)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    @override_settings(GTFS_IMPORT_TRACE_MEMORY=True)
+    def test_memory_tracing(self):
+        # Suivi démarré en dehors des étapes : le pic est remis à zéro
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        data = bytearray(1 << 22)
+        del data
+        with telemetry.stage('calendar'):
+            pass
+        self.assertLess(telemetry.collect()[0]['peak_memory'], 1 << 20)
+        self.assertTrue(tracemalloc.is_tracing())
+
+
+class ImportJobTest(ImportTestCase):
+    """File d'attente, verrou et annulation des importations."""
+
+    def enqueue(self):
+        """Mettre en file d'attente l'importation d'une archive de test,
+        envoyée comme depuis l'interface d'administration."""
+        with open(self.archive(), 'rb') as f:
+            return jobs.enqueue([SimpleUploadedFile('ter.zip', f.read())])
+
+    def run_job(self, run):
+        """Exécuter une importation réservée."""
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            return jobs.run_job(run)
+
+    def uploads(self):
+        """Obtenir les dossiers d'importation non supprimés."""
+        return [name for name in os.listdir(jobs.upload_dir())
+                if name.startswith('gtfs-')]
+
+    def test_enqueue(self):
+        run = self.enqueue()
+        self.assertEqual(run.status, ImportRun.QUEUED)
+        self.assertEqual(run.sources, 'ter.zip')
+        with open(run.paths, 'rb') as f, open(self.archive(), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_claim(self):
+        first, second = self.enqueue(), self.enqueue()
+        run = jobs.claim_next()
+        self.assertEqual(run.id, first.id)
+        self.assertEqual(run.status, ImportRun.RUNNING)
+        self.assertEqual(run.worker, jobs.owner())
+        self.assertIsNone(jobs.claim(first.id))
+        self.assertEqual(jobs.claim_next().id, second.id)
+        self.assertIsNone(jobs.claim_next())
+
+    def test_run(self):
+        run = self.enqueue()
+        with redirect_stdout(io.StringIO()):
+            call_command('runimports', '--once', stdout=io.StringIO())
+        run.refresh_from_db()
+        self.assertEqual(run.status, ImportRun.SUCCEEDED)
+        self.assertEqual(run.percent, 100)
+        self.assertEqual(run.generation_id, TimetableGeneration.current())
+        self.assertEqual(self.uploads(), [])
+
+    def test_cancel_queued(self):
+        run = self.enqueue()
+        self.assertTrue(jobs.cancel(run.id))
+        run.refresh_from_db()
+        self.assertEqual(run.status, ImportRun.CANCELLED)
+        self.assertEqual(self.uploads(), [])
+        self.assertIsNone(jobs.claim_next())
+        self.assertFalse(jobs.cancel(run.id))
+
+    def test_cancel_running(self):
+        run = jobs.claim(self.enqueue().id)
+        self.assertTrue(jobs.cancel(run.id))
+        run = self.run_job(run)
+        self.assertEqual(run.status, ImportRun.CANCELLED)
+        self.assertFalse(TimetableGeneration.current())
+        self.assertFalse(Train.objects.exists())
+        self.assertEqual(self.uploads(), [])
+
+    def test_lock(self):
+        run = self.enqueue()
+        with jobs.import_lock():
+            with self.assertRaises(jobs.ImportBusy):
+                with jobs.import_lock():
+                    pass
+            err = io.StringIO()
+            call_command('runimports', '--once', stderr=err)
+            self.assertIn("Une autre importation", err.getvalue())
+        run.refresh_from_db()
+        self.assertEqual(run.status, ImportRun.QUEUED)
+        with jobs.import_lock():
+            pass
+
+    def test_recover_interrupted(self):
+        now = timezone.now()
+        runs = [ImportRun.objects.create(status=ImportRun.RUNNING,
+                                         worker=worker, heartbeat=heartbeat)
+                for worker, heartbeat in (
+                    (jobs.owner(), now - timedelta(days=1)),
+                    (socket.gethostname() + ':999999999', now),
+                    ('ailleurs:1', now),
+                    ('ailleurs:2', now - timedelta(days=1)))]
+        self.assertEqual(jobs.recover_interrupted(), 2)
+        self.assertEqual([ImportRun.objects.get(id=run.id).status
+                          for run in runs],
+                         [ImportRun.RUNNING, ImportRun.FAILED,
+                          ImportRun.RUNNING, ImportRun.FAILED])
+
+    def test_autoimport(self):
+        urls = {'sncf-ter-gtfs': 'file://' + self.archive(),
+                'sncf-intercites-gtfs': 'file://' + self.archive(
+                    [(3, 'Intercités', [(87003, '12:00:00'),
+                                        (87001, '13:30:00')])],
+                    name='ic.zip')}
+        out = io.StringIO()
+        with mock.patch(autoimport.__name__ + '.get_file_url', urls.get):
+            with redirect_stderr(io.StringIO()):
+                call_command('autoimport', '--json', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertTrue(report['success'])
+        self.assertEqual(report['sources'], ['sncf-ter-gtfs.zip',
+                                             'sncf-intercites-gtfs.zip'])
+        self.assertEqual(report['delta']['trains']['inserted'], 3)
+        self.assertEqual(self.uploads(), [])
+
+    def test_autoimport_download_error(self):
+        urls = {'sncf-ter-gtfs': 'file://' + self.archive(),
+                'sncf-intercites-gtfs': 'file://' + os.path.join(
+                    self.directory, 'absent.zip')}
+        with mock.patch(autoimport.__name__ + '.get_file_url', urls.get):
+            with self.assertRaises(URLError):
+                call_command('autoimport', stdout=io.StringIO())
+        # L'archive déjà téléchargée est supprimée
+        self.assertEqual(self.uploads(), [])
+        self.assertFalse(ImportRun.objects.exists())
+
+
+class CleanCommandTest(NetworkTestCase):
+    """Commandes de nettoyage de la base de données."""
+
+    def clean(self, command, *args):
+        """Exécuter une commande de nettoyage. Renvoie ses sorties standard
+        et d'erreur, et les requêtes de suppression exécutées."""
+        out, err = io.StringIO(), io.StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command(command, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue(), [
+            q['sql'] for q in queries.captured_queries
+            if q['sql'].startswith('DELETE')]
+
+    def test_stations(self):
+        for name in ('E', 'F', 'G'):
+            Station.objects.create(name=name, lat=46, lng=6)
+        out, _, deletes = self.clean('cleanstations', '--dry-run')
+        self.assertIn('3 stations seraient supprimées', out)
+        self.assertEqual(deletes, [])
+        self.assertEqual(Station.objects.count(), 7)
+        out, _, deletes = self.clean('cleanstations', '--batch-size', '2')
+        self.assertIn('3 stations supprimées', out)
+        # Un lot de deux gares, puis un lot d'une gare
+        self.assertEqual(len([sql for sql in deletes
+                              if 'main_station' in sql.split('WHERE')[0]]),
+                         2)
+        self.assertEqual(sorted(Station.objects.values_list('name',
+                                                            flat=True)),
+                         ['A', 'B', 'C', 'D'])
+
+    def test_periods(self):
+        period = Period.objects.create(
+            monday=True, tuesday=False, wednesday=False, thursday=False,
+            friday=False, saturday=False, sunday=False,
+            start_date=date(2018, 1, 1), end_date=date(2018, 12, 31))
+        PeriodException.objects.create(period=period, date=MONDAY,
+                                       add_day=False)
+        out, _, _ = self.clean('cleanperiods', '--dry-run')
+        self.assertIn('1 périodes seraient supprimées', out)
+        self.clean('cleanperiods')
+        self.assertEqual(list(Period.objects.all()), [self.period])
+        self.assertFalse(PeriodException.objects.exists())
+
+    def test_trains(self):
+        halts = self.train1.halt_set.order_by('sequence')
+        Ticket.objects.create(
+            sequence=0, start_halt=halts[0], end_halt=halts[2],
+            travel=Travel.objects.create(date=MONDAY, booked=True))
+        out, _, _ = self.clean('cleantrains', '--dry-run')
+        self.assertIn('1 trains seraient supprimés', out)
+        self.clean('cleantrains', '--batch-size', '1')
+        self.assertEqual(list(Train.objects.all()), [self.train1])
+
+    def test_search(self):
+        Travel.objects.create(date=MONDAY, booked=False)
+        Travel.objects.create(date=MONDAY, booked=False)
+        booked = Travel.objects.create(date=MONDAY, booked=True)
+        out, err, _ = self.clean('cleansearch', '--dry-run')
+        self.assertIn('2 voyages seraient supprimés', out)
+        self.assertIn("Le voyage ayant l'ID " + str(booked.id), err)
+        self.assertEqual(Travel.objects.count(), 3)
+        out, _, _ = self.clean('cleansearch', '--batch-size', '0')
+        self.assertIn('2 voyages supprimés', out)
+        self.assertEqual(list(Travel.objects.all()), [booked])
+
+
+class TravelExpiryTest(NetworkTestCase):
+    """Expiration des voyages non réservés."""
+
+    def travel(self, age, booked=False):
+        """Créer un voyage âgé d'un nombre de secondes donné."""
+        return Travel.objects.create(
+            date=MONDAY, booked=booked,
+            created_at=timezone.now() - timedelta(seconds=age))
+
+    def setUp(self):
+        super(TravelExpiryTest, self).setUp()
+        self.old = self.travel(25 * 3600)
+        self.fresh = self.travel(3600)
+        self.booked = self.travel(25 * 3600, booked=True)
+
+    def test_expired(self):
+        self.assertEqual(list(Travel.objects.expired()), [self.old])
+        self.assertEqual(list(Travel.objects.search_results()), [self.fresh])
+        with override_settings(SEARCH_RESULT_TTL=60):
+            self.assertEqual(list(Travel.objects.expired().order_by('id')),
+                             [self.old, self.fresh])
+
+    def test_cart_add(self):
+        # L'ajout au panier ne supprime aucun voyage
+        halts = list(self.train1.halt_set.all())
+        travel = Itinerary(MONDAY, self.passengers,
+                           [(halts[0], halts[2])]).save()
+        self.assertLess(timezone.now() - travel.created_at,
+                        timedelta(seconds=60))
+        self.assertEqual(Travel.objects.count(), 4)
+
+    def test_cart(self):
+        halts = list(self.train1.halt_set.all())
+        old, fresh = [Itinerary(MONDAY, self.passengers,
+                                [(halts[0], halts[2])]).save()
+                      for _ in range(2)]
+        Travel.objects.filter(id=old.id).update(
+            created_at=timezone.now() - timedelta(days=2))
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['easycart'] = {'items': {
+            str(travel.id): {'quantity': 1} for travel in (old, fresh)}}
+        session.save()
+        response = self.client.get('/train/cart')
+        self.assertEqual(response.context['total_price'], fresh.price)
+        self.assertGreater(fresh.price, 0)
+
+    def test_cleansearch(self):
+        call_command('cleansearch', '--expired', stdout=io.StringIO(),
+                     stderr=io.StringIO())
+        self.assertEqual(list(Travel.objects.order_by('id')),
+                         [self.fresh, self.booked])
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Moteur d'horaires en mémoire pour la recherche d'itinéraires.
+Les arrêts, trains et périodes de service sont chargés une seule fois par
+processus dans des tableaux triés, puis les recherches sont effectuées par
+tours successifs (à la manière de l'algorithme RAPTOR) sans interroger la base
+de données.
+"""
+
+from bisect import bisect_left, bisect_right
+from .models import Halt, Train, ServiceDay, TimetableGeneration
+
+## Temps de correspondance maximal accepté, en secondes.
+MAX_TRANSFER_TIME = 3 * 3600
+
+## Instance partagée par toutes les recherches du processus.
+_timetable = None
+
+
+def get_timetable(generation=None):
+    """Obtenir le moteur d'horaires du processus, en le chargeant depuis la
+    base de données lors du premier appel ou lorsqu'une autre génération des
+    horaires a été activée. Par défaut, la génération active est utilisée."""
+    global _timetable
+    if generation is None:
+        generation = TimetableGeneration.current()
+    if _timetable is None or _timetable.generation != generation:
+        _timetable = Timetable.load(generation)
+    return _timetable
+
+
+def invalidate():
+    """Oublier le moteur d'horaires chargé, pour qu'il soit reconstruit lors
+    de la prochaine recherche. À appeler après une importation GTFS."""
+    global _timetable
+    _timetable = None
+
+
+class Timetable(object):
+    """
+    Horaires de tous les trains, rangés pour la recherche d'itinéraires.
+    Pour chaque train, les arrêts sont stockés par ordre de passage dans des
+    listes parallèles (gares, arrivées, départs, identifiants d'arrêts).
+    Pour chaque gare, les départs sont triés par heure pour permettre une
+    recherche dichotomique.
+    """
+
+    def __init__(self, halts, trains):
+        """Construire le moteur à partir de tuples bruts :
+        halts : (id, train_id, station_id, arrival_s, departure_s) triés par
+        train puis par numéro de séquence ;
+        trains : (id, period_id)."""
+        ## Période de service de chaque train, indexée par identifiant.
+        self.train_period = dict(trains)
+        ## Arrêts de chaque train : (gares, arrivées, départs, arrêts).
+        self.stops = {}
+        ## Départs de chaque gare : (heures triées, (train, indice d'arrêt)).
+        self.departures = {}
+        ## Trains circulant à chaque date déjà consultée.
+        self.running = {}
+        ## Génération des horaires chargée.
+        self.generation = None
+        ## Durée du plus long trajet d'un train, de son premier départ à sa
+        #  dernière arrivée, en secondes.
+        self.longest_ride = 0
+
+        for halt_id, train_id, station_id, arrival, departure in halts:
+            stops = self.stops.setdefault(train_id, ([], [], [], []))
+            stops[0].append(station_id)
+            stops[1].append(arrival)
+            stops[2].append(departure)
+            stops[3].append(halt_id)
+
+        events = {}
+        for train_id, stops in self.stops.items():
+            for i, station_id in enumerate(stops[0]):
+                events.setdefault(station_id, []).append(
+                    (stops[2][i], train_id, i))
+        for station_id, station_events in events.items():
+            station_events.sort()
+            self.departures[station_id] = (
+                [e[0] for e in station_events],
+                [e[1:] for e in station_events])
+        self.longest_ride = max(
+            [stops[1][-1] - stops[2][0] for stops in self.stops.values()] or
+            [0])
+
+    @classmethod
+    def load(cls, generation):
+        """Charger depuis la base de données les horaires d'une génération,
+        sans les trains retirés ou importés depuis."""
+        timetable = cls(
+            Halt.objects.filter(Train.in_generation(generation, 'train__'))
+            .order_by('train_id', 'sequence').values_list(
+                'id', 'train_id', 'station_id', 'arrival_s', 'departure_s'),
+            Train.objects.filter(Train.in_generation(generation))
+            .values_list('id', 'period_id'))
+        timetable.generation = generation
+        return timetable
+
+    def running_trains(self, date):
+        """Obtenir l'ensemble des trains circulant à une date donnée, à l'aide
+        de la table des jours de service. Le résultat est conservé pour les
+        recherches suivantes à la même date.
+        Comme pour Train.runs, un train sans période circule tous les jours."""
+        if date not in self.running:
+            periods = set(ServiceDay.objects.filter(
+                generation_id=self.generation, date=date)
+                .values_list('period_id', flat=True))
+            self.running[date] = {t for t, p in self.train_period.items()
+                                  if p is None or p in periods}
+        return self.running[date]
+
+    def journeys(self, start_id, end_id, date, window, depart_after=True,
+                 max_transfers=1):
+        """Rechercher les itinéraires d'une gare à une autre, avec au plus
+        max_transfers correspondances.
+        window est un couple (début, fin) en secondes depuis le début du jour
+        de service, appliqué à l'heure de départ si depart_after vaut True, à
+        l'heure d'arrivée sinon.
+        Le travail effectué pour chaque départ croît linéairement avec le
+        nombre de correspondances autorisées. Quand la fenêtre porte sur
+        l'arrivée, seuls les départs assez tardifs pour atteindre la fenêtre
+        sont parcourus : un voyage ne dure pas plus de max_transfers + 1
+        trajets et max_transfers correspondances.
+        Renvoie une liste de voyages triés par heure de départ puis
+        d'arrivée ; chaque voyage est une liste de tuples
+        (arrêt de départ, arrêt d'arrivée)."""
+        if start_id not in self.departures:
+            return []
+        running = self.running_trains(date)
+        times, events = self.departures[start_id]
+        if depart_after:
+            first = bisect_left(times, window[0])
+            arrivals = None
+        else:
+            first = bisect_left(times, window[0] - (
+                (max_transfers + 1) * self.longest_ride +
+                max_transfers * MAX_TRANSFER_TIME))
+            arrivals = window
+        last = bisect_right(times, window[1])
+
+        results = {}
+        for train_id, index in events[first:last]:
+            if train_id not in running:
+                continue
+            found = self._earliest_arrival(
+                train_id, index, end_id, running, max_transfers, arrivals)
+            if found is None:
+                continue
+            arrival, legs = found
+            departure = self.stops[train_id][2][index]
+            results.setdefault(tuple(legs), (departure, arrival))
+        return [list(legs) for legs, _ in
+                sorted(results.items(), key=lambda r: r[1])]
+
+    def _earliest_arrival(self, train_id, index, end_id, running,
+                          max_transfers, window=None):
+        """Calculer, par tours successifs, l'arrivée au plus tôt en gare
+        d'arrivée en montant dans un train donné à un arrêt donné.
+        Chaque tour ajoute une correspondance ; le premier tour atteignant la
+        gare d'arrivée dans la fenêtre window (début, fin), si elle est
+        donnée, est retenu : une arrivée trop tardive n'empêche pas un tour
+        suivant d'arriver plus tôt. Renvoie (heure d'arrivée, étapes) ou
+        None.
+        Chaque tour ne parcourt que les trains au départ des gares améliorées
+        au tour précédent.
+        """
+        # Meilleure heure d'arrivée connue pour chaque gare, tous tours
+        # confondus, et étiquettes de chaque tour :
+        # gare -> (arrivée, gare précédente, train, montée, descente)
+        # La gare de départ est marquée pour ne jamais y revenir.
+        stations, _, departures, _ = self.stops[train_id]
+        best = {stations[index]: departures[index]}
+        rounds = [{}]
+        self._ride(train_id, index, None, rounds[0], best)
+        for k in range(max_transfers + 1):
+            if end_id in rounds[k]:
+                arrival = rounds[k][end_id][0]
+                if window is None or window[0] <= arrival <= window[1]:
+                    return arrival, self._legs(rounds, k, end_id)
+                if arrival < window[0]:
+                    # Les tours suivants ne peuvent qu'arriver plus tôt
+                    break
+            if k == max_transfers:
+                break
+            rounds.append({})
+            boarding = {}
+            for station_id, label in rounds[k].items():
+                self._boardings(station_id, label, running, boarding)
+            if not boarding:
+                break
+            for next_train, (board, from_station) in boarding.items():
+                self._ride(next_train, board, from_station, rounds[k + 1],
+                           best)
+        return None
+
+    def _boardings(self, station_id, label, running, boarding):
+        """Recenser les trains dans lesquels il est possible de monter depuis
+        une gare atteinte avec une étiquette donnée, en respectant le temps de
+        correspondance maximal. Seul l'arrêt de montée le plus tôt dans
+        l'itinéraire de chaque train est conservé."""
+        if station_id not in self.departures:
+            return
+        arrival, train_id = label[0], label[2]
+        times, events = self.departures[station_id]
+        first = bisect_right(times, arrival)
+        last = bisect_right(times, arrival + MAX_TRANSFER_TIME)
+        for next_train, index in events[first:last]:
+            if next_train == train_id or next_train not in running:
+                continue
+            if next_train not in boarding or boarding[next_train][0] > index:
+                boarding[next_train] = (index, station_id)
+
+    def _ride(self, train_id, board, from_station, labels, best):
+        """Parcourir un train depuis son arrêt de montée et améliorer les
+        étiquettes des gares desservies ensuite."""
+        stations, arrivals = self.stops[train_id][:2]
+        for i in range(board + 1, len(stations)):
+            station_id = stations[i]
+            if arrivals[i] < best.get(station_id, float('inf')):
+                best[station_id] = arrivals[i]
+                labels[station_id] = (
+                    arrivals[i], from_station, train_id, board, i)
+
+    def _legs(self, rounds, k, station_id):
+        """Reconstituer les étapes d'un voyage depuis les étiquettes."""
+        legs = []
+        while k >= 0:
+            _, from_station, train_id, board, alight = \
+                rounds[k][station_id]
+            halt_ids = self.stops[train_id][3]
+            legs.insert(0, (halt_ids[board], halt_ids[alight]))
+            station_id = from_station
+            k -= 1
+        return legs
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Mise à jour des données existantes après une migration.
+Les fonctions de ce module sont appelées après chaque « manage.py migrate »
+(signal post_migrate, voir MainConfig) et complètent les colonnes ajoutées
+par les nouvelles versions de l'application à partir des données déjà
+présentes. Elles ne modifient que les lignes qui n'ont pas encore été mises à
+jour : les appeler plusieurs fois est sans effet.
+"""
+from datetime import time
+from itertools import groupby
+from django.db import connections, transaction
+from django.db.models import Q
+from main.models import Train, ServiceDay, TimetableGeneration
+from main.utility import time_to_seconds
+
+## Nombre de trains dont les arrêts sont mis à jour dans chaque transaction.
+BATCH_SIZE = 500
+
+
+def backfill_halt_seconds(Halt, using='default'):
+    """Calculer les heures en secondes depuis le début du jour de service
+    (arrival_s et departure_s) des arrêts enregistrés avant leur ajout, à
+    partir des heures affichées (arrival et departure).
+    Les heures affichées reviennent à zéro après minuit : lorsqu'une heure est
+    antérieure à l'heure précédente du même train, le train a passé minuit et
+    24 heures sont ajoutées à cette heure et à toutes les suivantes.
+    Halt peut être le modèle historique fourni par le signal post_migrate.
+    Renvoie le nombre d'arrêts mis à jour."""
+    # Les colonnes ajoutées valent 0 ; un arrêt à minuit pile est déjà juste
+    pending = Halt.objects.using(using).filter(
+        Q(arrival__gt=time(0)) | Q(departure__gt=time(0)),
+        arrival_s=0, departure_s=0, train__isnull=False)
+    trains = sorted(set(pending.values_list('train_id', flat=True)))
+    sql = 'UPDATE ' + Halt._meta.db_table + \
+        ' SET arrival_s = %s, departure_s = %s WHERE id = %s'
+    updated = 0
+    for start in range(0, len(trains), BATCH_SIZE):
+        halts = Halt.objects.using(using).filter(
+            train_id__in=trains[start:start + BATCH_SIZE]).order_by(
+            'train_id', 'sequence').values_list(
+            'train_id', 'id', 'arrival', 'departure')
+        rows = []
+        for train_id, stops in groupby(halts, key=lambda h: h[0]):
+            offset = previous = 0
+            for _, halt_id, arrival, departure in stops:
+                times = []
+                for value in (arrival, departure):
+                    seconds = time_to_seconds(value) + offset
+                    if seconds < previous:
+                        offset += 86400
+                        seconds += 86400
+                    previous = seconds
+                    times.append(seconds)
+                rows.append(times + [halt_id])
+        with transaction.atomic(using=using):
+            with connections[using].cursor() as cursor:
+                cursor.executemany(sql, rows)
+        updated += len(rows)
+    return updated
+
+
+def backfill_service_days():
+    """Calculer les jours de service de la génération active des horaires
+    s'ils n'existent pas, par exemple pour des horaires importés avant
+    l'ajout des générations. Si des trains existent sans qu'aucune
+    génération ne soit active, une génération active est créée pour eux.
+    Renvoie le nombre de jours de service écrits."""
+    from main.gtfs_parser import build_service_days
+    generation = TimetableGeneration.current()
+    if not generation:
+        if not Train.objects.filter(first_generation=0).exists():
+            return 0
+        generation = TimetableGeneration.objects.create(
+            status=TimetableGeneration.ACTIVE).id
+    if ServiceDay.objects.filter(generation_id=generation).exists():
+        return 0
+    return build_service_days(generation)
+
+
+def upgrade(sender, apps, using='default', **kwargs):
+    """Compléter les données existantes après une migration (récepteur du
+    signal post_migrate). Les modèles historiques fournis par le signal sont
+    utilisés, pour ne pas lire de colonne qui n'aurait pas encore été créée
+    lors d'une migration partielle.
+    Les jours de service ne sont calculés que pour la base de données par
+    défaut, avec les modèles actuels, une fois toutes les tables créées."""
+    try:
+        Halt = apps.get_model('main', 'Halt')
+    except LookupError:
+        return
+    if 'arrival_s' in [f.name for f in Halt._meta.get_fields()]:
+        backfill_halt_seconds(Halt, using)
+    try:
+        apps.get_model('main', 'TimetableGeneration')
+        fields = apps.get_model('main', 'ServiceDay')._meta.get_fields()
+    except LookupError:
+        return
+    if using == 'default' and 'generation' in [f.name for f in fields]:
+        backfill_service_days()
@@ -7,15 +7,25 @@ from . import views
 urlpatterns = [
     url(r'^$', RedirectView.as_view(url='/train/search', permanent=False)),
     url(r'^search$', views.search, name='search'),
-    url(r'^stations.json$', views.stations_json, name='stations_json'),
+    url(r'^stations/complete.json$', views.stations_complete_json,
+        name='stations_complete_json'),
+    url(r'^stations/near.json$', views.stations_near_json,
+        name='stations_near_json'),
     url(r'^tickets$', views.tickets, name='tickets'),
     url(r'^map$', views.full_map, name='map'),
-    url(r'^stations.geojson$', views.full_map_geojson, name='map_geojson'),
+    url(r'^stations.([0-9a-f]+).geojson$', views.full_map_geojson,
+        name='map_geojson'),
+    url(r'^stations/map.geojson$', views.full_map_clusters,
+        name='map_clusters'),
     url(r'^map/travel/(\d+)$', views.travel_map, name='travel_map'),
     url(r'^travel(\d+).geojson', views.travel_map_geojson,
         name='travel_map_geojson'),
+    url(r'^map/itinerary/([\w.:-]+)$', views.itinerary_map,
+        name='itinerary_map'),
+    url(r'^itinerary/([\w.:-]+).geojson$', views.itinerary_map_geojson,
+        name='itinerary_map_geojson'),
     url(r'^cart$', views.cart_show, name='cart'),
-    url(r'^cart/add/(\d+)$', views.cart_add, name='cart_add'),
+    url(r'^cart/add/([\w.:-]+)$', views.cart_add, name='cart_add'),
     url(r'^cart/remove/(\d+)$', views.cart_remove, name='cart_remove'),
     url(r'^order$', views.order, name='order'),
     url(r'^passengers$', views.passengers, name='passengers'),
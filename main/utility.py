@@ -4,7 +4,12 @@
 Fonctions utilitaires pour l'application TchouTchouGo.
 """
 
+from collections import OrderedDict
+from datetime import time
 from math import radians, cos, sin, asin, sqrt
+from threading import Lock
+import numpy as np
+from django.core.management.color import no_style
 from django.db import connection
 
 
@@ -35,6 +40,65 @@ def haversine(lon1, lat1, lon2, lat2):
     return km
 
 
+def haversine_array(lon1, lat1, lon2, lat2):
+    """
+    Version vectorisée de haversine : calculer en un seul appel les distances
+    entre des tableaux de coordonnées GPS de même taille. Renvoie un tableau
+    NumPy des distances en kilomètres.
+    """
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(x, dtype=float))
+                              for x in (lon1, lat1, lon2, lat2)]
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    # Les erreurs d'arrondi peuvent faire légèrement dépasser 1
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    return 6367 * c
+
+
+def fares(start_coords, end_coords, km_prices, route_distances=None):
+    """Calculer en un seul appel vectorisé les distances et les prix d'une
+    série de trajets.
+    start_coords et end_coords sont des suites de tuples (latitude,
+    longitude), km_prices les prix kilométriques de chaque trajet, et
+    route_distances, facultatif, les distances le long de l'itinéraire des
+    trains, où None ou NaN désigne une distance inconnue, remplacée par la
+    distance à vol d'oiseau.
+    Renvoie un couple de tableaux NumPy (distances, prix)."""
+    start = np.asarray(start_coords, dtype=float).reshape(-1, 2)
+    end = np.asarray(end_coords, dtype=float).reshape(-1, 2)
+    distances = haversine_array(start[:, 1], start[:, 0],
+                                end[:, 1], end[:, 0])
+    if route_distances is not None:
+        route = np.array([np.nan if d is None else d
+                          for d in route_distances], dtype=float)
+        distances = np.where(np.isnan(route), distances, route)
+    return distances, distances * np.asarray(km_prices, dtype=float)
+
+
+def parse_gtfs_time(timestr):
+    """Convertir une heure GTFS (HH:MM:SS) en secondes depuis le début du jour
+    de service. Les heures peuvent dépasser 24:00:00 pour les trains
+    circulant après minuit."""
+    hours, minutes, secs = timestr.strip().split(':', 2)
+    return int(hours) * 3600 + int(minutes) * 60 + int(secs)
+
+
+def seconds_to_time(value):
+    """Convertir un nombre de secondes depuis le début du jour de service en
+    objet datetime.time, pour l'affichage. Les heures dépassant 24 heures
+    reviennent au jour suivant."""
+    return time(hour=value // 3600 % 24, minute=value // 60 % 60,
+                second=value % 60)
+
+
+def time_to_seconds(value):
+    """Convertir un objet datetime.time en nombre de secondes depuis minuit.
+    Opération inverse de seconds_to_time() pour les heures de moins de 24
+    heures."""
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
 def sql_query(sql, params=None):
     """Exécuter une requête SQL directement. Voir la page d'aide :
     https://docs.djangoproject.com/fr/1.11/topics/db/sql/"""
@@ -42,3 +106,75 @@ def sql_query(sql, params=None):
         cursor.execute(sql, params)
         rows = cursor.fetchall()
     return rows
+
+
+def bulk_batch_size(model, objs, batch_size):
+    """Limiter la taille des lots de bulk_create() au nombre de paramètres
+    accepté par la base de données. Django 1.11 n'applique pas cette limite
+    lorsqu'une taille de lot est fournie, ce qui échoue avec SQLite."""
+    return max(1, min(batch_size, connection.ops.bulk_batch_size(
+        model._meta.concrete_fields, objs)))
+
+
+def reset_sequences(*models):
+    """Mettre à jour les séquences d'identifiants des modèles donnés après
+    une insertion avec des identifiants explicites. Sans effet avec SQLite,
+    qui n'utilise pas de séquences."""
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+
+
+class LRUCache(object):
+    """Cache en mémoire de taille bornée. Quand le cache est plein, l'entrée
+    utilisée le moins récemment est évincée. Les succès et les échecs de
+    lecture sont comptés.
+    Le cache peut être partagé par plusieurs fils d'exécution, par exemple
+    ceux d'un serveur WSGI : chaque opération est protégée par un verrou."""
+
+    def __init__(self, maxsize):
+        """Créer un cache pouvant contenir au plus maxsize entrées.
+        Un cache de taille nulle ne conserve rien."""
+        ## Nombre maximal d'entrées.
+        self.maxsize = maxsize
+        ## Nombre de lectures ayant trouvé une entrée.
+        self.hits = 0
+        ## Nombre de lectures n'ayant pas trouvé d'entrée.
+        self.misses = 0
+        ## Entrées du cache, de la moins récemment utilisée à la plus
+        #  récemment utilisée.
+        self.entries = OrderedDict()
+        ## Verrou protégeant les entrées et les compteurs.
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        """Lire une entrée du cache, ou renvoyer default si elle n'existe
+        pas."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        """Ajouter ou remplacer une entrée du cache."""
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Vider le cache, sans remettre à zéro les compteurs."""
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        """Obtenir les statistiques du cache sous forme de dictionnaire."""
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        size=len(self.entries), maxsize=self.maxsize)
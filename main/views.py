@@ -2,20 +2,31 @@
 from __future__ import unicode_literals
 
 from .forms import SearchForm, SignUpForm, UserForm, PassengerForm
-from .models import Travel, Station, Passenger
-from .search import TimeOptions, search as search_trains
+from .models import Travel, Station, Passenger, SeatOccupancy
+from .search import TimeOptions, Itinerary, search as search_trains
+from .spatial import get_index as get_station_index
+from .autocomplete import get_index as get_station_names, \
+    invalidate as invalidate_station_names
+from .artifacts import get_artifact, ARTIFACTS
 
 from datetime import time
 from django.forms.models import model_to_dict
+from django.contrib import messages
 from django.contrib.auth import login, authenticate, update_session_auth_hash
 from django.contrib.auth.forms import UserCreationForm, PasswordChangeForm
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.shortcuts import \
     render, redirect, get_object_or_404, HttpResponseRedirect
-from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+from django.core.signing import BadSignature
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseBadRequest, \
+    HttpResponseNotModified, FileResponse, Http404
 import json
+import math
+import os
 import geojson
 from easycart import BaseCart
 
@@ -27,10 +38,9 @@ def search(request):
     if request.method == 'POST':
         form = SearchForm(request.POST, passengers=passengers)
         if form.is_valid():
-            start_station = Station.objects.get(
-                name=form.cleaned_data.get('startStation'))
-            end_station = Station.objects.get(
-                name=form.cleaned_data.get('endStation'))
+            start_station = _form_station(form, 'startStation')
+            end_station = _form_station(form, 'endStation')
+        if form.is_valid():
             ps = []
             if 'passengers' in dict(request.POST.lists()):
                 ps = [passengers.get(id=id)
@@ -45,18 +55,36 @@ def search(request):
                          form.cleaned_data.get('travelDate'),
                          time(hour=int(form.cleaned_data.get('hour'))), ps,
                          TimeOptions[form.cleaned_data.get('timeOptions')])))
+    else:
+        form = None
     passengers = ""
     if request.user.is_authenticated:
         passengers = request.user.passenger_set.filter(display=True)
     return render(request, 'main/search.html', dict(
-        active="search", passengers=passengers, hours=range(5, 23)))
+        active="search", passengers=passengers, hours=range(5, 23),
+        form=form))
+
+
+def _form_station(form, field):
+    """Obtenir la gare saisie dans un champ du formulaire de recherche.
+    Les noms saisis sont comparés sans accents ni casse. Si l'index des noms
+    ne correspond plus aux gares enregistrées, par exemple après un
+    nettoyage, une erreur est ajoutée au champ et l'index sera reconstruit
+    lors de la prochaine recherche."""
+    name = form.cleaned_data.get(field)
+    try:
+        return Station.objects.get(pk=get_station_names().lookup(name))
+    except (Station.DoesNotExist, ValueError, TypeError):
+        invalidate_station_names()
+        form.add_error(field, "La gare de " + name + " n'existe pas.")
 
 
 @login_required
 def tickets(request):
     return render(request, 'main/tickets.html', dict(
         active="list", travel_set=Travel.objects.filter(
-            booked=True, passengers_aboard__user=request.user).distinct()))
+            booked=True, passengers_aboard__user=request.user).distinct()
+        .with_tickets()))
 
 
 ###############################################################################
@@ -75,7 +103,8 @@ class Cart(BaseCart):
     def get_queryset(self, pks):
         """Obtenir un QuerySet correspondant aux billets pouvant se trouver
         dans le panier."""
-        return Travel.objects.filter(booked=False, pk__in=pks)
+        return Travel.objects.search_results().filter(
+            pk__in=pks).with_tickets()
 
 
 @login_required
@@ -86,8 +115,19 @@ def cart_show(request):
 
 
 @login_required
-def cart_add(request, travel_id):
-    Cart(request).add(travel_id)
+def cart_add(request, token):
+    # Le résultat de recherche n'est enregistré qu'à l'ajout au panier
+    try:
+        itinerary = Itinerary.from_token(
+            token, request.user.passenger_set.all())
+    except BadSignature:
+        return HttpResponseBadRequest()
+    except ObjectDoesNotExist:
+        raise Http404("Itinéraire introuvable.")
+    cart = Cart(request)
+    # Un itinéraire déjà présent dans le panier n'est pas enregistré à nouveau
+    if not any([itinerary.matches(i.obj) for i in cart.list_items()]):
+        cart.add(itinerary.save().pk)
     return redirect('/train/cart')
 
 
@@ -99,12 +139,32 @@ def cart_remove(request, travel_id):
 
 @login_required
 def order(request):
-    for i in Cart(request).list_items():
-        i.obj.booked = True
-        i.obj.save()
+    # Chaque voyage est réservé séparément : ceux dont un train est devenu
+    # complet restent dans le panier, avec un message
+    refused = [i.obj for i in Cart(request).list_items() if not i.obj.book()]
+    for travel in refused:
+        messages.error(request, _refusal_message(travel))
+    if refused:
+        return redirect('/train/cart')
     return redirect('/train/tickets')
 
 
+def _refusal_message(travel):
+    """Expliquer pourquoi un voyage du panier n'a pas pu être réservé, en
+    nommant les trains complets."""
+    tickets = list(travel.ticket_set.all())
+    fits = SeatOccupancy.can_hold(
+        [(t.start_halt, t.end_halt) for t in tickets], travel.date,
+        len(travel.passengers_aboard.all()))
+    full = [str(t.start_halt.train) for t, fit in zip(tickets, fits)
+            if not fit]
+    if not full:
+        return "Le voyage du " + str(travel.date) + \
+            " n'a pas pu être réservé : il a expiré."
+    return "Le voyage du " + str(travel.date) + " n'a pas pu être " \
+        "réservé : plus assez de places dans le " + ", le ".join(full) + "."
+
+
 ###############################################################################
 # Gestion des passagers
 ###############################################################################
@@ -207,30 +267,113 @@ def full_map(request):
     from TchouTchouGo.settings import GOOGLE_MAPS_API_KEY
     return render(request, 'main/map.html', {
         'active': 'map',
-        'api_key': GOOGLE_MAPS_API_KEY})
-
-
-def full_map_geojson(request):
-    points = geojson.FeatureCollection([
-        geojson.Feature(geometry=geojson.Point((s.lng, s.lat)),
-                        properties={"title": s.name})
-        for s in Station.objects.all()])
-    return HttpResponse(geojson.dumps(points), content_type='application/json')
+        'api_key': GOOGLE_MAPS_API_KEY,
+        'geojson_url': reverse('map_clusters'),
+        'download_url': reverse('map_geojson', args=[
+            get_artifact('stations.geojson')[0]])})
+
+
+def full_map_geojson(request, version):
+    return _serve_artifact(request, 'stations.geojson', version)
+
+
+def full_map_clusters(request):
+    # Seules les gares visibles sont envoyées, regroupées selon le zoom
+    try:
+        west, south, east, north = [
+            float(v) for v in request.GET['bbox'].split(',')]
+        zoom = int(request.GET['zoom'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("Zone de carte invalide.")
+    features = []
+    for lat, lng, count, station in get_station_index().clusters(
+            south, west, north, east, zoom):
+        if station is None:
+            properties = {"count": count}
+        else:
+            properties = {"count": 1, "id": station[0], "title": station[1]}
+        features.append(geojson.Feature(
+            geometry=geojson.Point((lng, lat)), properties=properties))
+    return HttpResponse(geojson.dumps(geojson.FeatureCollection(features)),
+                        content_type='application/json')
+
+
+def _serve_artifact(request, name, version):
+    # Les fichiers précalculés changent uniquement lors d'une importation :
+    # l'adresse de la version actuelle peut être conservée indéfiniment, les
+    # anciennes adresses sont revalidées à chaque fois grâce à l'ETag
+    digest, path = get_artifact(name)
+    if version == digest:
+        cache_control = 'public, max-age=' + str(getattr(
+            settings, 'STATION_ARTIFACTS_MAX_AGE', 31536000)) + \
+            ', immutable'
+    else:
+        cache_control = 'public, no-cache'
+    accepted = [e.split(';')[0].strip() for e in
+                request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')]
+    encoding, extension, tag = None, '', ''
+    for candidate in (('br', '.br', '-br'), ('gzip', '.gz', '-gz')):
+        if candidate[0] in accepted and os.path.exists(path + candidate[1]):
+            encoding, extension, tag = candidate
+            break
+    # Chaque codage est une représentation différente, avec son propre ETag
+    etag = '"' + digest + tag + '"'
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', '').split(', '):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            response = FileResponse(open(path + extension, 'rb'),
+                                    content_type='application/json')
+        except FileNotFoundError:
+            # Fichier supprimé depuis l'écriture du manifeste : la liste est
+            # construite à partir de la base de données
+            response = HttpResponse(ARTIFACTS[name](),
+                                    content_type='application/json')
+            response['Cache-Control'] = 'no-cache'
+            return response
+        if encoding:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    response['Vary'] = 'Accept-Encoding'
+    return response
 
 
 def travel_map(request, travel_id):
     from TchouTchouGo.settings import GOOGLE_MAPS_API_KEY
     return render(request, 'main/travel_map.html', {
-        'travel_id': travel_id,
+        'geojson_url': reverse('travel_map_geojson', args=[travel_id]),
         'api_key': GOOGLE_MAPS_API_KEY})
 
 
 def travel_map_geojson(request, travel_id):
-    from django.db.models import Q
     tr = get_object_or_404(Travel, id=travel_id)
-    stations = [t.start_halt.station for t in tr.ticket_set.all()]
-    stations.append(tr.ticket_set.reverse()[0].end_halt.station)
-    print(stations)
+    return _tickets_geojson(tr.ticket_set.all())
+
+
+def itinerary_map(request, token):
+    from TchouTchouGo.settings import GOOGLE_MAPS_API_KEY
+    return render(request, 'main/travel_map.html', {
+        'geojson_url': reverse('itinerary_map_geojson', args=[token]),
+        'api_key': GOOGLE_MAPS_API_KEY})
+
+
+def itinerary_map_geojson(request, token):
+    try:
+        itinerary = Itinerary.from_token(token, Passenger.objects.all())
+    except BadSignature:
+        return HttpResponseBadRequest()
+    except ObjectDoesNotExist:
+        raise Http404("Itinéraire introuvable.")
+    return _tickets_geojson(itinerary.tickets)
+
+
+def _tickets_geojson(tickets):
+    """Construire la réponse GeoJSON représentant le trajet d'une liste de
+    billets : les gares desservies et la ligne les reliant."""
+    tickets = list(tickets)
+    stations = [t.start_halt.station for t in tickets]
+    stations.append(tickets[-1].end_halt.station)
     data = [geojson.Feature(geometry=geojson.Point((s.lng, s.lat)),
                             properties={"title": s.name})
             for s in stations]
@@ -249,7 +392,8 @@ def travel_map_geojson(request, travel_id):
 @login_required
 def print_ticket(request, travel_id):
     """Vue permettant l'impression d'un ensemble de billets."""
-    travel = get_object_or_404(Travel.objects.distinct(), id=travel_id,
+    travel = get_object_or_404(Travel.objects.distinct().with_tickets(),
+                               id=travel_id,
                                passengers_aboard__user=request.user)
     if not travel.booked:
         return HttpResponseBadRequest()
@@ -291,7 +435,39 @@ def change_password(request):
     return render(request, 'registration/updatePassword.html')
 
 
-def stations_json(request):
+def stations_complete_json(request):
+    # Les k meilleures gares (10 par défaut, 20 au plus) pour le texte saisi
+    try:
+        k = min(int(request.GET.get('k', 10)), 20)
+    except ValueError:
+        return HttpResponseBadRequest("Nombre de gares invalide.")
+    return HttpResponse(json.dumps(
+        [{'id': station_id, 'label': name} for station_id, name
+         in get_station_names().complete(request.GET.get('q', ''), k)]),
+        content_type="application/json")
+
+
+def stations_near_json(request):
+    # Les k gares les plus proches (10 par défaut, 100 au plus), ou celles
+    # situées dans un rayon donné en kilomètres
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        k = min(int(request.GET.get('k', 10)), 100)
+        radius = request.GET.get('radius')
+        radius = float(radius) if radius else None
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("Position invalide.")
+    # NaN et l'infini donneraient des distances invalides en JSON
+    if not all([math.isfinite(v) for v in (lat, lng, radius or 1)]) or \
+            k <= 0 or (radius is not None and radius <= 0):
+        return HttpResponseBadRequest("Position invalide.")
+    index = get_station_index()
+    if radius is None:
+        stations = index.nearest(lat, lng, k)
+    else:
+        stations = index.within(lat, lng, radius)[:k]
     return HttpResponse(json.dumps(
-        [{'id': s.id, 'label': s.name, 'value': s.name}
-         for s in Station.objects.all()]), content_type="application/json")
+        [{'id': s[0], 'label': s[1], 'lat': s[2], 'lng': s[3],
+          'distance': round(s[4], 3)} for s in stations]),
+        content_type="application/json")